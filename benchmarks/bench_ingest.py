@@ -0,0 +1,98 @@
+"""
+Compares the update throughput of long polling with the webhook server,
+against a local fake Bot API running in its own process. Every update is a
+/ping command, and it counts as handled once the bot has sent its reply.
+
+Run it from the repository root with ``python -m benchmarks.bench_ingest``.
+"""
+
+import multiprocessing
+import time
+
+from telegram import Update
+from telegram.ext import CallbackContext, CommandHandler, Updater
+
+from benchmarks.fake_telegram import (
+    RemoteFakeBotApi,
+    free_port,
+    make_command_update,
+    serve,
+)
+from lyrix_telegram_bot.webhook import ALLOWED_UPDATES, WebhookServer
+
+UPDATES = 5_000
+USERS = 200
+WORKERS = 8
+
+
+def ping(update: Update, _: CallbackContext) -> None:
+    update.message.reply_text("pong")
+
+
+def make_updater(api: RemoteFakeBotApi) -> Updater:
+    updater = Updater(api.token, base_url=api.base_url, workers=WORKERS)
+    updater.dispatcher.add_handler(CommandHandler("ping", ping, run_async=True))
+    return updater
+
+
+def make_updates() -> list:
+    return [make_command_update(1 + i, 10_000 + i % USERS) for i in range(UPDATES)]
+
+
+def wait_for_replies(api: RemoteFakeBotApi) -> None:
+    if not api.wait_for_messages(UPDATES):
+        handled = api.stats()["sent"]
+        raise RuntimeError(f"only {handled} of {UPDATES} updates were handled")
+
+
+def bench_polling(api: RemoteFakeBotApi) -> float:
+    updater = make_updater(api)
+    api.queue_updates(make_updates())
+    start = time.perf_counter()
+    updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+    wait_for_replies(api)
+    elapsed = time.perf_counter() - start
+    updater.stop()
+    return elapsed
+
+
+def bench_webhook(api: RemoteFakeBotApi) -> float:
+    updater = make_updater(api)
+    port = free_port()
+    webhook = WebhookServer(
+        updater,
+        url=f"http://127.0.0.1:{port}/telegram",
+        listen="127.0.0.1",
+        port=port,
+        path="/telegram",
+        secret="benchmark-secret",
+    )
+    webhook.start()
+    updates = make_updates()
+    start = time.perf_counter()
+    api.push_updates(updates)
+    wait_for_replies(api)
+    elapsed = time.perf_counter() - start
+    webhook.stop()
+    return elapsed
+
+
+def main():
+    port = free_port()
+    fake = multiprocessing.Process(target=serve, args=(port,), daemon=True)
+    fake.start()
+    api = RemoteFakeBotApi(port)
+    api.wait_until_up()
+
+    print(f"{'mode':>8} {'updates':>8} {'seconds':>8} {'updates/s':>10}")
+    try:
+        for mode, bench in (("polling", bench_polling), ("webhook", bench_webhook)):
+            api.reset()
+            elapsed = bench(api)
+            print(f"{mode:>8} {UPDATES:>8} {elapsed:>8.2f} {UPDATES / elapsed:>10.0f}")
+    finally:
+        fake.terminate()
+
+
+if __name__ == "__main__":
+    main()
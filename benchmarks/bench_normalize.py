@@ -0,0 +1,92 @@
+"""
+Compares the memoized normalization module with the artist cleanup and key
+LyrixApp and LyricsCache used to compute on every lookup. The names come from
+``normalize_corpus``, whose expected keys are checked first.
+
+Run it from the repository root with ``python -m benchmarks.bench_normalize``.
+"""
+
+import random
+import sys
+import timeit
+
+from swaglyrics.cli import stripper
+
+from benchmarks.normalize_corpus import CORPUS, TRACK_INFO_CORPUS
+from lyrix_telegram_bot.normalize import (
+    clean_artist,
+    clean_track,
+    song_key,
+    track_info_key,
+)
+
+LOOKUPS = 10_000
+
+
+def previous_key(artist: str, track: str):
+    cleaned = artist
+    if "," in cleaned:
+        cleaned = cleaned.split(", ")[0]
+    cleaned = cleaned.replace("- Music", "")
+    cleaned = stripper("", cleaned).rstrip("-").replace("-", " ")
+    return " ".join(cleaned.casefold().split()), " ".join(track.casefold().split())
+
+
+def current_key(artist: str, track: str):
+    clean_artist(artist)
+    return song_key(artist, track)
+
+
+def clear_caches() -> None:
+    for func in (clean_artist, clean_track, song_key, track_info_key):
+        func.cache_clear()
+
+
+def check_corpus() -> bool:
+    ok = True
+    for artist, track, expected in CORPUS:
+        key = song_key(artist, track)
+        if key != expected:
+            print(f"{artist!r} {track!r}: got {key}, expected {expected}")
+            ok = False
+    for artist, track, expected in TRACK_INFO_CORPUS:
+        key = track_info_key(artist, track)
+        if key != expected:
+            print(f"{artist!r} {track!r}: got Last.fm key {key}, expected {expected}")
+            ok = False
+    return ok
+
+
+def main():
+    if not check_corpus():
+        sys.exit(1)
+    distinct = len({expected for _, _, expected in CORPUS})
+    print(f"{len(CORPUS)} names, {distinct} songs")
+
+    random.seed(0)
+    songs = [(artist, track) for artist, track, _ in CORPUS]
+    # a few songs are shared far more than the rest
+    lookups = random.choices(
+        songs, weights=[1 / (i + 1) for i in range(len(songs))], k=LOOKUPS
+    )
+
+    def cold():
+        clear_caches()
+        for artist, track in songs:
+            current_key(artist, track)
+
+    previous = min(
+        timeit.repeat(lambda: [previous_key(*s) for s in lookups], number=1, repeat=5)
+    )
+    first = min(timeit.repeat(cold, number=1, repeat=5)) / len(songs) * LOOKUPS
+    warm = min(
+        timeit.repeat(lambda: [current_key(*s) for s in lookups], number=1, repeat=5)
+    )
+    print(f"{'version':>22} {'us/lookup':>10}")
+    print(f"{'previous':>22} {previous / LOOKUPS * 1e6:>10.2f}")
+    print(f"{'normalize, uncached':>22} {first / LOOKUPS * 1e6:>10.2f}")
+    print(f"{'normalize, memoized':>22} {warm / LOOKUPS * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
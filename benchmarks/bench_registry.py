@@ -0,0 +1,58 @@
+"""
+Compares user lookups through the indexed UserRegistry with the linear scan
+LyrixApp used to do over ``db["users"]``.
+
+Run it from the repository root with ``python -m benchmarks.bench_registry``.
+"""
+
+import random
+import timeit
+
+from lyrix_telegram_bot.models.user import LyrixUser
+from lyrix_telegram_bot.registry import UserRegistry
+
+SIZES = (1_000, 10_000, 100_000)
+LOOKUPS = 1_000
+
+
+def make_records(count: int) -> list:
+    return [
+        {
+            "telegram_user_id": 10_000_000 + i,
+            "username": f"user{i}",
+            "homeserver": "lyrix.example.com",
+            "token": f"{i:032x}",
+        }
+        for i in range(count)
+    ]
+
+
+def linear_lookup(records: list, telegram_id: int):
+    for user in records:
+        if user.get("telegram_user_id") == telegram_id:
+            return LyrixUser.from_dict(user)
+    return None
+
+
+def main():
+    random.seed(0)
+    print(f"{'users':>8} {'linear (us)':>14} {'registry (us)':>14}")
+    for size in SIZES:
+        records = make_records(size)
+        registry = UserRegistry(records)
+        ids = [random.choice(records)["telegram_user_id"] for _ in range(LOOKUPS)]
+
+        linear = timeit.timeit(
+            lambda: [linear_lookup(records, i) for i in ids], number=1
+        )
+        indexed = min(
+            timeit.repeat(lambda: [registry.get(i) for i in ids], number=1, repeat=5)
+        )
+        print(
+            f"{size:>8} {linear / LOOKUPS * 1e6:>14.2f} "
+            f"{indexed / LOOKUPS * 1e6:>14.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
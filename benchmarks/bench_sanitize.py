@@ -0,0 +1,59 @@
+"""
+Compares the Last.fm wiki cleanup of ``markup.sanitize`` with the loop that
+LastFmClient used to run, which rebuilt the summary once for every link in it.
+
+Run it from the repository root with ``python -m benchmarks.bench_sanitize``.
+"""
+
+import timeit
+
+from lyrix_telegram_bot.markup import sanitize
+
+LINKS = (1, 10, 100, 1_000, 5_000)
+
+
+def make_summary(links: int) -> str:
+    paragraph = (
+        'The song was written by <a href="https://www.last.fm/music/Artist">'
+        "Artist</a> &amp; friends in 1999. "
+    )
+    return (
+        paragraph * links
+        + '<a href="https://www.last.fm/music/Artist/_/Song">Read more on Last.fm</a>.'
+        + " User-contributed text is available under the Creative Commons license."
+    )
+
+
+def previous_cleanup(wiki: str) -> str:
+    while wiki.find("<a href") != -1:
+        start_idx = wiki.find("<a href")
+        end_idx = wiki.find("</a>")
+        wiki = wiki[:start_idx] + wiki[end_idx + len("</a>") :]
+        if "<a href" not in wiki:
+            break
+    return wiki
+
+
+def main():
+    print(f"{'links':>6} {'chars':>8} {'previous (ms)':>14} {'sanitize (ms)':>14}")
+    for links in LINKS:
+        summary = make_summary(links)
+        repeat = max(1, 1_000 // links)
+        previous = min(
+            timeit.repeat(lambda: previous_cleanup(summary), number=repeat, repeat=3)
+        )
+        current = min(
+            timeit.repeat(
+                lambda: sanitize(summary, limit=None, drop_links=True),
+                number=repeat,
+                repeat=3,
+            )
+        )
+        print(
+            f"{links:>6} {len(summary):>8} {previous / repeat * 1e3:>14.3f} "
+            f"{current / repeat * 1e3:>14.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
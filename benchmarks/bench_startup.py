@@ -0,0 +1,211 @@
+"""
+Measures how long the bot takes from being started to answering its first
+updates, with the eager and the lazy startup (``LYRIX_STARTUP``) and users
+stores of growing size. The bot runs in a process of its own against the
+``fake_telegram`` stand-in, which has two updates waiting before the bot
+starts: a /ping, which needs no user, and a /who_am_i from a registered user,
+which has to wait for the users to be loaded.
+
+Every run reports the time to the first answer and to the answer to
+/who_am_i, both from the process being spawned, next to the steps of the
+startup the bot logs.
+
+Run it from the repository root with ``python -m benchmarks.bench_startup``.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from benchmarks.bench_registry import make_records
+from benchmarks.fake_telegram import TOKEN, FakeBotApi, make_command_update
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ("eager", "lazy")
+USER_COUNTS = (0, 10_000, 100_000)
+# the chat of the /ping, which belongs to no registered user
+PING_CHAT = 1
+STARTUP_MARKER = '{"startup": '
+
+
+class TimedBotApi(FakeBotApi):
+    """
+    Remembers when the first message to every chat was sent
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.first_sent: Dict[int, float] = {}
+
+    def handle(self, method: str, params: dict):
+        if method == "sendMessage":
+            self.first_sent.setdefault(int(params["chat_id"]), time.perf_counter())
+        return super().handle(method, params)
+
+    def reset(self) -> None:
+        super().reset()
+        self.first_sent.clear()
+
+
+def bot_env(api: FakeBotApi, tmp: str, mode: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update(
+        {
+            "PYTHONPATH": ROOT_DIR,
+            "TELEGRAM_BOT_TOKEN": TOKEN,
+            "SPOTIPY_CLIENT_ID": "bench-startup",
+            "SPOTIPY_CLIENT_SECRET": "bench-startup",
+            "LYRIX_BACKEND": "lyrix.example.com",
+            "LYRIX_BACKEND_TOKEN": "bench-startup",
+            "LYRIX_TELEGRAM_API_URL": api.base_url,
+            "LYRIX_STARTUP": mode,
+            "LYRIX_INGEST": "polling",
+            "LYRIX_CACHE_DIR": os.path.join(tmp, "cache"),
+            "LYRIX_STORAGE_BACKEND": "json",
+            "LYRIX_STORAGE_JSON_PATH": os.path.join(tmp, "spotify.json"),
+        }
+    )
+    env.pop("DEBUG", None)
+    return env
+
+
+def run_once(api: TimedBotApi, mode: str, records: List[dict], tmp: str) -> dict:
+    """
+    Starts the bot with the updates waiting, and returns when it answered
+    them, in milliseconds from the spawn
+    """
+    api.reset()
+    with open(os.path.join(tmp, "spotify.json"), "w") as fp:
+        json.dump({"version": 1, "users": records}, fp)
+    registered = records[0]["telegram_user_id"] if records else PING_CHAT + 1
+    api.queue_updates(
+        [
+            make_command_update(1, PING_CHAT, "/ping"),
+            make_command_update(2, registered, "/who_am_i"),
+        ]
+    )
+
+    startup: Optional[dict] = None
+    started = time.perf_counter()
+    bot = subprocess.Popen(
+        [sys.executable, "-m", "lyrix_telegram_bot.bot"],
+        cwd=tmp,
+        env=bot_env(api, tmp, mode),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+    def read_log():
+        nonlocal startup
+        for line in bot.stderr:
+            start = line.find(STARTUP_MARKER)
+            if start != -1:
+                startup = json.loads(line[start:])["startup"]
+
+    reader = threading.Thread(target=read_log, daemon=True)
+    reader.start()
+    try:
+        if not api.wait_for_messages(2, timeout=60):
+            raise RuntimeError(f"the bot did not answer, exit code {bot.poll()}")
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        reader.join(5)
+
+    steps = {}
+    if startup is not None:
+        # the users loaded in the background show in user_lookup_ms instead
+        steps = {
+            step["name"]: step["duration_ms"]
+            for step in startup["children"]
+            if not step.get("unfinished")
+        }
+    return {
+        "first_update_ms": (min(api.first_sent.values()) - started) * 1e3,
+        "user_lookup_ms": (api.first_sent[registered] - started) * 1e3,
+        "startup_ms": startup["duration_ms"] if startup is not None else None,
+        "steps_ms": steps,
+    }
+
+
+def summarize(runs: List[dict]) -> dict:
+    summary = {
+        key: statistics.median(run[key] for run in runs)
+        for key in ("first_update_ms", "user_lookup_ms", "startup_ms")
+        if all(run[key] is not None for run in runs)
+    }
+    names = {name for run in runs for name in run["steps_ms"]}
+    summary["steps_ms"] = {
+        name: statistics.median(run["steps_ms"].get(name, 0.0) for run in runs)
+        for name in sorted(names)
+    }
+    return summary
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument(
+        "--users",
+        default=",".join(str(count) for count in USER_COUNTS),
+        help="comma separated sizes of the users store",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("-o", "--output", help="write the results to this json file")
+    args = parser.parse_args(argv)
+
+    modes = args.modes.split(",")
+    user_counts = [int(count) for count in args.users.split(",")]
+    api = TimedBotApi().start()
+    results = {}
+    print(
+        f"{'mode':>6} {'users':>8} {'first update':>13} {'user lookup':>12} "
+        f"{'startup':>8}  steps (ms)"
+    )
+    try:
+        for users in user_counts:
+            records = make_records(users)
+            for mode in modes:
+                runs = []
+                for _ in range(args.repeat):
+                    tmp = tempfile.mkdtemp(prefix="lyrix-startup-")
+                    try:
+                        runs.append(run_once(api, mode, records, tmp))
+                    finally:
+                        shutil.rmtree(tmp, ignore_errors=True)
+                summary = summarize(runs)
+                results[f"{mode}[users={users}]"] = dict(
+                    summary, mode=mode, users=users, runs=runs
+                )
+                steps = " ".join(
+                    f"{name}={ms:.0f}" for name, ms in summary["steps_ms"].items()
+                )
+                print(
+                    f"{mode:>6} {users:>8} {summary['first_update_ms']:>10.0f} ms "
+                    f"{summary['user_lookup_ms']:>9.0f} ms "
+                    f"{summary.get('startup_ms', float('nan')):>5.0f} ms  {steps}"
+                )
+    finally:
+        api.stop()
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+            fp.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Measures how the throughput of the bot grows with its worker processes
+(``LYRIX_WORKERS``). Every run is a ``load_harness`` run: the bot is started
+against the stand-ins, which answer without waiting, and the synthetic users
+send their next command as soon as the last one is done, so that the bot is
+held back by the CPU it spends rather than by the upstreams. 0 workers is the
+bot handling the updates in the process that takes them.
+
+The stand-ins and the harness run on the same machine, and take some of its
+cores; the numbers only mean something with more cores than workers.
+
+Run it from the repository root with ``python -m benchmarks.bench_workers``.
+The arguments it does not know are passed to the harness, like
+``--updates 5000`` or ``--mix ping=0``.
+"""
+
+import argparse
+import json
+import statistics
+from typing import List, Optional
+
+from benchmarks.load_harness import PERCENTILES, UPSTREAMS, Harness, make_parser
+from benchmarks.load_harness import percentile
+
+WORKER_COUNTS = (0, 1, 2, 4, 8)
+# the rate limits of the outbound queue would be what the runs measure
+UNLIMITED_ENV = (
+    "LYRIX_OUTBOUND_GLOBAL_RATE=1000000",
+    "LYRIX_OUTBOUND_CHAT_RATE=1000000",
+    "LYRIX_OUTBOUND_GROUP_RATE=1000000",
+)
+HARNESS_ARGS = [
+    "--users",
+    "200",
+    "--updates",
+    "3000",
+    "--think",
+    "0",
+    "--jitter",
+    "0",
+    "--latency",
+    ",".join(f"{upstream}=0" for upstream in UPSTREAMS),
+]
+for variable in UNLIMITED_ENV:
+    HARNESS_ARGS += ["--env", variable]
+
+
+def run_once(workers: int, harness_argv: List[str]) -> dict:
+    args = make_parser().parse_args(
+        HARNESS_ARGS
+        + harness_argv
+        + [
+            "--env",
+            f"LYRIX_WORKERS={workers}",
+            # the workers share the users through it
+            "--env",
+            "LYRIX_STORAGE_BACKEND=sqlite",
+        ]
+    )
+    harness = Harness(args)
+    harness.start()
+    try:
+        report = harness.run()
+    finally:
+        harness.stop()
+    latencies = sorted(
+        p.finished - p.queued for p in harness.results if p.trace is not None
+    )
+    result = {
+        "updates_per_second": report["updates_per_second"],
+        "done": report["done"],
+        "timed_out": report["updates"] - report["done"],
+    }
+    for p in PERCENTILES:
+        result[f"p{p}_ms"] = percentile(latencies, p) * 1e3 if latencies else None
+    return result
+
+
+def format_ms(value: Optional[float]) -> str:
+    return f"{value:>5.0f} ms" if value is not None else f"{'-':>8}"
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        epilog="the other arguments are passed to benchmarks.load_harness",
+    )
+    parser.add_argument(
+        "--workers",
+        default=",".join(str(count) for count in WORKER_COUNTS),
+        help="comma separated worker counts",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("-o", "--output", help="write the results to this json file")
+    args, harness_argv = parser.parse_known_args(argv)
+
+    results = {}
+    baseline = None
+    print(
+        f"{'workers':>7} {'updates/s':>10} {'speedup':>8} "
+        + " ".join(f"{f'p{p}':>8}" for p in PERCENTILES)
+        + f" {'lost':>6}"
+    )
+    for workers in (int(count) for count in args.workers.split(",")):
+        runs = [run_once(workers, harness_argv) for _ in range(args.repeat)]
+        throughput = statistics.median(run["updates_per_second"] for run in runs)
+        baseline = baseline or throughput
+        summary = {
+            "workers": workers,
+            "updates_per_second": throughput,
+            "speedup": throughput / baseline,
+            "runs": runs,
+        }
+        for p in PERCENTILES:
+            values = [run[f"p{p}_ms"] for run in runs if run[f"p{p}_ms"] is not None]
+            summary[f"p{p}_ms"] = statistics.median(values) if values else None
+        results[f"workers={workers}"] = summary
+        latencies = " ".join(format_ms(summary[f"p{p}_ms"]) for p in PERCENTILES)
+        lost = sum(run["timed_out"] for run in runs)
+        print(
+            f"{workers:>7} {throughput:>10.1f} {summary['speedup']:>7.2f}x "
+            f"{latencies} {lost:>6}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+            fp.write("\n")
+
+
+if __name__ == "__main__":
+    main()
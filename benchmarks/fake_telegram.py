@@ -0,0 +1,330 @@
+"""
+A local stand-in for the Telegram Bot API, for the benchmarks. It serves
+queued updates through getUpdates, delivers them to the webhook set with
+setWebhook like Telegram does, and records the messages the bot sends.
+
+The replies of the bot can be slowed down and made to fail with ``Faults``,
+like the other stand-ins in ``fake_upstreams``.
+
+The fake can run in its own process, so that delivering the updates does not
+compete with the bot for the GIL. ``serve`` runs it there, and
+``RemoteFakeBotApi`` drives it through the ``/fake/`` control endpoints.
+"""
+
+import http.client
+import json
+import socket
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, List
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+from benchmarks.fake_upstreams import Faults
+
+TOKEN = "123456:fake-token"
+BOT_ID = 123456
+# longest a getUpdates call is held open, so that the Updater stops quickly
+MAX_LONG_POLL = 1.0
+# the methods the faults apply to, the ones the bot answers updates with
+REPLY_METHODS = {"sendMessage", "editMessageText", "answerInlineQuery"}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_command_update(update_id: int, user_id: int, text: str = "/ping") -> dict:
+    command = text.split()[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "user"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+
+class FakeBotApi:
+    def __init__(self, token: str = TOKEN, port: int = 0, faults: Faults = None):
+        self.token = token
+        self.faults = faults or Faults()
+        self.updates: List[dict] = []
+        self.sent: List[dict] = []
+        self.webhook: dict = {}
+        self.calls = 0
+        self.methods: Counter = Counter()
+        self.errors: Counter = Counter()
+        self._cond = threading.Condition()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fake-bot-api", daemon=True
+        )
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/bot"
+
+    def start(self) -> "FakeBotApi":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def queue_updates(self, updates: List[dict]) -> None:
+        """
+        Makes the updates available to getUpdates
+        """
+        with self._cond:
+            self.updates.extend(updates)
+            self._cond.notify_all()
+
+    def push_updates(self, updates: List[dict], concurrency: int = None) -> None:
+        """
+        POSTs the updates to the webhook, over at most ``max_connections``
+        connections, and delivers them again while the webhook answers 503
+        """
+        url = urlsplit(self.webhook["url"])
+        headers = {"Content-Type": "application/json"}
+        if self.webhook.get("secret_token"):
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook["secret_token"]
+        concurrency = concurrency or int(self.webhook.get("max_connections", 40))
+        local = threading.local()
+
+        def deliver(update: dict) -> None:
+            # http.client rather than requests, which is slow enough to be
+            # what the benchmark measures
+            if not hasattr(local, "conn"):
+                local.conn = http.client.HTTPConnection(url.hostname, url.port)
+            body = json.dumps(update)
+            delay = 0.01
+            while True:
+                local.conn.request("POST", url.path, body=body, headers=headers)
+                response = local.conn.getresponse()
+                response.read()
+                if response.status != 503:
+                    return
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(deliver, updates))
+
+    def wait_for_messages(self, count: int, timeout: float = 60) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self.sent) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def reset(self) -> None:
+        with self._cond:
+            self.updates.clear()
+            self.sent.clear()
+            self.webhook = {}
+            self.calls = 0
+            self.methods.clear()
+            self.errors.clear()
+
+    def handle(self, method: str, params: dict):
+        """
+        Returns the result of a Bot API method, or raises KeyError for the
+        methods it does not know
+        """
+        self.calls += 1
+        self.methods[method] += 1
+        if method == "getMe":
+            return {
+                "id": BOT_ID,
+                "is_bot": True,
+                "first_name": "Lyrix",
+                "username": "lyrix_bot",
+            }
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "setWebhook":
+            self.webhook = params
+            return True
+        if method == "deleteWebhook":
+            self.webhook = {}
+            return True
+        if method in ("sendMessage", "editMessageText"):
+            with self._cond:
+                self.sent.append(params)
+                self._cond.notify_all()
+                message_id = len(self.sent)
+            return {
+                "message_id": params.get("message_id", message_id),
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        if method in ("answerInlineQuery", "sendChatAction"):
+            return True
+        raise KeyError(method)
+
+    def control(self, action: str, params: dict) -> Any:
+        if action == "queue":
+            return self.queue_updates(params["updates"])
+        if action == "push":
+            return self.push_updates(params["updates"], params.get("concurrency"))
+        if action == "wait":
+            return self.wait_for_messages(params["count"], params.get("timeout", 60))
+        if action == "reset":
+            return self.reset()
+        if action == "stats":
+            return {"sent": len(self.sent), "calls": self.calls}
+        raise KeyError(action)
+
+    def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = min(float(params.get("timeout") or 0), MAX_LONG_POLL)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                # acknowledged updates are dropped, like Telegram does
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+                if self.updates:
+                    return self.updates[:limit]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+
+    def _make_handler(self):
+        api = self
+        prefix = f"/bot{self.token}/"
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    body = self.rfile.read(length)
+                    if self.headers.get("Content-Type", "").startswith(
+                        "application/json"
+                    ):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body.decode()))
+
+                try:
+                    if url.path.startswith("/fake/"):
+                        result = api.control(url.path[len("/fake/") :], params)
+                    elif url.path.startswith(prefix):
+                        method = url.path[len(prefix) :]
+                        if method in REPLY_METHODS:
+                            api.faults.delay()
+                            if api.faults.fails():
+                                api.errors[method] += 1
+                                return self._reply(
+                                    500,
+                                    {
+                                        "ok": False,
+                                        "error_code": 500,
+                                        "description": "Internal Server Error",
+                                    },
+                                )
+                        result = api.handle(method, params)
+                    else:
+                        raise KeyError(url.path)
+                except KeyError:
+                    return self._reply(
+                        404,
+                        {"ok": False, "error_code": 404, "description": "Not Found"},
+                    )
+                self._reply(200, {"ok": True, "result": result})
+
+            def _reply(self, status: int, data: dict):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def serve(port: int, token: str = TOKEN) -> None:
+    """
+    Runs the fake until the process is terminated
+    """
+    api = FakeBotApi(token, port)
+    api._server.serve_forever()
+
+
+class RemoteFakeBotApi:
+    """
+    The FakeBotApi interface, for a fake running in another process
+    """
+
+    def __init__(self, port: int, token: str = TOKEN):
+        self.token = token
+        self.url = f"http://127.0.0.1:{port}"
+        self._session = requests.Session()
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.url}/bot"
+
+    def wait_until_up(self, timeout: float = 10) -> None:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.stats()
+                return
+            except requests.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def queue_updates(self, updates: List[dict]) -> None:
+        self._control("queue", updates=updates)
+
+    def push_updates(self, updates: List[dict], concurrency: int = None) -> None:
+        self._control("push", updates=updates, concurrency=concurrency)
+
+    def wait_for_messages(self, count: int, timeout: float = 60) -> bool:
+        return self._control("wait", count=count, timeout=timeout)
+
+    def reset(self) -> None:
+        self._control("reset")
+
+    def stats(self) -> dict:
+        return self._control("stats")
+
+    def _control(self, action: str, **params) -> Any:
+        response = self._session.post(f"{self.url}/fake/{action}", json=params)
+        response.raise_for_status()
+        return response.json()["result"]
@@ -0,0 +1,353 @@
+"""
+Local stand-ins for the services the bot calls besides Telegram: the Spotify
+web api and its token endpoint, Last.fm, the Genius lyrics pages, the
+swaglyrics stripper api, and a lyrix homeserver. Each one answers after a
+configurable latency, fails a configurable share of its requests with a 503,
+and counts the requests it got by route.
+
+The songs they report come from ``CATALOGUE``, a few of them far more often
+than the rest, so that the caches of the bot see a realistic mix of hits and
+misses.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlsplit
+
+from swaglyrics.cli import stripper
+
+from lyrix_telegram_bot.constants import SCOPES
+
+# (artist, track, whether Genius has the lyrics)
+CATALOGUE = [(f"Artist {i % 40}", f"Song {i}", i % 10 != 9) for i in range(200)]
+# the verses of every lyrics page
+LYRICS_LINES = 60
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+Response = Tuple[int, Union[dict, str]]
+
+
+class Faults:
+    """
+    The latency and the errors of a stand-in
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self) -> None:
+        if not self.latency and not self.jitter:
+            return
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0.0, self.latency + jitter))
+
+    def fails(self) -> bool:
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+
+class Catalogue:
+    """
+    Picks songs from ``CATALOGUE``, the first ones far more often than the
+    last ones
+    """
+
+    def __init__(self, seed: int = 0):
+        self.songs = CATALOGUE
+        self._weights = [1 / (i + 1) for i in range(len(self.songs))]
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def pick(self) -> Tuple[str, str, bool]:
+        with self._lock:
+            return self._random.choices(self.songs, weights=self._weights)[0]
+
+
+class FakeUpstream:
+    """
+    An HTTP stand-in on a port of its own. Subclasses answer the requests in
+    ``respond``, with a status and either json or text.
+    """
+
+    name = "upstream"
+
+    def __init__(self, faults: Faults = None, catalogue: Catalogue = None):
+        self.faults = faults or Faults()
+        self.catalogue = catalogue or Catalogue()
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name=f"fake-{self.name}", daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "FakeUpstream":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def route(self, method: str, path: str) -> str:
+        """
+        The name the request is counted under
+        """
+        return path
+
+    def respond(self, method: str, path: str, params: dict, headers: dict) -> Response:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {
+                route: {"calls": calls, "errors": self.errors[route]}
+                for route, calls in sorted(self.calls.items())
+            }
+
+    def _serve(self, method: str, path: str, params: dict, headers: dict) -> Response:
+        route = self.route(method, path)
+        self.faults.delay()
+        failed = self.faults.fails()
+        with self._lock:
+            self.calls[route] += 1
+            if failed:
+                self.errors[route] += 1
+        if failed:
+            return 503, {"error": {"status": 503, "message": "Service Unavailable"}}
+        return self.respond(method, path, params, headers)
+
+    def _make_handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+            def _dispatch(self, method: str):
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    body = self.rfile.read(length)
+                    if self.headers.get("Content-Type", "").startswith(
+                        "application/json"
+                    ):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body.decode()))
+                status, payload = upstream._serve(
+                    method, url.path, params, self.headers
+                )
+                if isinstance(payload, str):
+                    body, content_type = payload.encode(), "text/html; charset=utf-8"
+                else:
+                    body, content_type = (
+                        json.dumps(payload).encode(),
+                        "application/json",
+                    )
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def _bearer(headers: dict) -> Optional[str]:
+    authorization = headers.get("Authorization") or ""
+    if not authorization.startswith("Bearer "):
+        return None
+    return authorization[len("Bearer ") :]
+
+
+class FakeSpotify(FakeUpstream):
+    """
+    The token endpoint of accounts.spotify.com and the currently playing
+    track of the web api, under ``/v1/``
+    """
+
+    name = "spotify"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with open(os.path.join(FIXTURES_DIR, "spotify_currently_playing.json")) as fp:
+            self.currently_playing = json.load(fp)
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.url}/v1/"
+
+    def route(self, method: str, path: str) -> str:
+        if path == "/api/token":
+            return "token"
+        if path == "/v1/me/player/currently-playing":
+            return "currently_playing"
+        return "unknown"
+
+    def respond(self, method, path, params, headers) -> Response:
+        if path == "/api/token":
+            code = params.get("code") or params.get("refresh_token") or ""
+            return 200, {
+                "access_token": f"access-{code}",
+                "token_type": "Bearer",
+                "expires_in": 3600,
+                "refresh_token": f"refresh-{code}",
+                "scope": SCOPES,
+            }
+        if path == "/v1/me/player/currently-playing":
+            if _bearer(headers) is None:
+                return 401, {"error": {"status": 401, "message": "No token"}}
+            artist, track, _ = self.catalogue.pick()
+            item = dict(self.currently_playing["item"])
+            item["name"] = track
+            item["artists"] = [dict(item["artists"][0], name=artist)]
+            return 200, dict(self.currently_playing, item=item)
+        return 404, {"error": {"status": 404, "message": "Not found"}}
+
+
+class FakeLastFm(FakeUpstream):
+    """
+    track.getInfo, with the recorded answer for every track
+    """
+
+    name = "lastfm"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        with open(os.path.join(FIXTURES_DIR, "lastfm_track_info.json")) as fp:
+            self.track_info = json.load(fp)
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.url}/2.0/"
+
+    def route(self, method: str, path: str) -> str:
+        return "track.getInfo"
+
+    def respond(self, method, path, params, headers) -> Response:
+        if params.get("method") != "track.getInfo":
+            return 400, {"error": 3, "message": "Invalid Method"}
+        track = dict(self.track_info["track"], name=params.get("track", ""))
+        return 200, {"track": track}
+
+
+class FakeGenius(FakeUpstream):
+    """
+    The lyrics pages of the songs in the catalogue that have lyrics
+    """
+
+    name = "genius"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pages = {
+            f"/{stripper(track, artist)}-lyrics": (artist, track)
+            for artist, track, has_lyrics in self.catalogue.songs
+            if has_lyrics
+        }
+
+    def route(self, method: str, path: str) -> str:
+        return "page" if path in self.pages else "missing_page"
+
+    def respond(self, method, path, params, headers) -> Response:
+        song = self.pages.get(path)
+        if song is None:
+            return 404, "<html><body>Page not found</body></html>"
+        artist, track = song
+        verses = "<br/>".join(
+            f"Line {i} of {track} by {artist}, la la la" for i in range(LYRICS_LINES)
+        )
+        return 200, (
+            f"<html><head><title>{artist} - {track} Lyrics</title></head><body>"
+            f'<div class="Lyrics__Container-sc-1ynbvzw-6">{verses}</div>'
+            "</body></html>"
+        )
+
+
+class FakeSwaglyrics(FakeUpstream):
+    """
+    The ``/stripper`` endpoint of the swaglyrics api, which the bot asks for
+    the page of a song Genius has no page for. It knows no other pages.
+    """
+
+    name = "swaglyrics"
+
+    def route(self, method: str, path: str) -> str:
+        return "stripper"
+
+    def respond(self, method, path, params, headers) -> Response:
+        return 200, ""
+
+
+class FakeHomeserver(FakeUpstream):
+    """
+    The parts of a lyrix homeserver the bot uses: the spotify authorization
+    code of a user, and the song their lyrixd is playing
+    """
+
+    name = "lyrix_backend"
+
+    @property
+    def homeserver(self) -> str:
+        return f"127.0.0.1:{self._server.server_address[1]}"
+
+    def route(self, method: str, path: str) -> str:
+        if path == "/user/player/spotify/token":
+            return f"spotify_token_{method.lower()}"
+        if path == "/user/player/local/current_song":
+            return "current_song"
+        return "unknown"
+
+    def respond(self, method, path, params, headers) -> Response:
+        token = _bearer(headers)
+        if token is None:
+            return 401, {"error": "unauthorized"}
+        if path == "/user/player/spotify/token":
+            if method == "POST":
+                return 200, {"ok": True}
+            return 200, {"token": f"code-{token}"}
+        if path == "/user/player/local/current_song":
+            artist, track, _ = self.catalogue.pick()
+            return 200, {
+                "artist": artist,
+                "track": track,
+                "source": "music.youtube.com",
+                "url": "https://music.youtube.com/watch?v=4NRXx6U8ABQ",
+            }
+        return 404, {"error": "not found"}
@@ -0,0 +1,472 @@
+"""
+Load tests the whole bot without touching a real service. The stand-ins of
+``fake_telegram`` and ``fake_upstreams`` take the place of the Bot API,
+Spotify, Last.fm, Genius and a lyrix homeserver, and ``bot.main()`` runs in a
+process of its own, pointed at them through the ``LYRIX_*_URL`` variables,
+and at the Genius and swaglyrics ones by ``run_bot``.
+
+Every synthetic user sends a command from the mix, waits until the bot is
+done with it, thinks for a while, and sends the next one. The bot logs the span tree of every
+update (``LYRIX_SLOW_TRACE_SECONDS=0``), which tells when an update was done,
+whether it failed, and which upstreams it called. The report has the
+throughput, the latency percentiles from the update being queued to its
+handler returning, and the upstream calls per command, next to the requests
+every stand-in counted, which include the ones made in the background.
+
+Run it from the repository root with ``python -m benchmarks.load_harness``.
+"""
+
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from typing import Dict, List, Optional
+
+from benchmarks.fake_telegram import TOKEN, FakeBotApi, make_command_update
+from benchmarks.fake_upstreams import (
+    CATALOGUE,
+    Catalogue,
+    FakeGenius,
+    FakeHomeserver,
+    FakeLastFm,
+    FakeSpotify,
+    FakeSwaglyrics,
+    Faults,
+)
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the share of every command in the traffic
+DEFAULT_MIX = {
+    "ping": 10,
+    "lyrics": 25,
+    "share": 20,
+    "local_lyrics": 15,
+    "local_share": 10,
+    "lyrix": 5,
+    "inline": 15,
+}
+# seconds every stand-in waits before answering
+DEFAULT_LATENCY = {
+    "telegram": 0.03,
+    "spotify": 0.08,
+    "lastfm": 0.1,
+    "genius": 0.25,
+    "swaglyrics": 0.1,
+    "lyrix_backend": 0.05,
+}
+# the span names the upstream calls are traced under
+UPSTREAMS = tuple(DEFAULT_LATENCY)
+# the stand-ins have no flood limits, and the global one of telegram would
+# make the harness measure the outbound queue rather than the bot
+DEFAULT_ENV = {"LYRIX_OUTBOUND_GLOBAL_RATE": "1000"}
+PERCENTILES = (50, 90, 95, 99)
+# the bot only answers the inline queries that ask for a source
+INLINE_QUERIES = ("spot", "loc", "spot loc")
+TRACE_MARKER = '{"slow_update": '
+
+
+def parse_pairs(text: str, cast=float) -> Dict[str, float]:
+    pairs = {}
+    for pair in filter(None, text.split(",")):
+        name, _, value = pair.partition("=")
+        pairs[name.strip()] = cast(value)
+    return pairs
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    # nearest rank, like /stats
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+
+def make_update(command: str, update_id: int, user_id: int, rng: random.Random):
+    artist, track, _ = rng.choice(CATALOGUE)
+    if command == "inline":
+        return {
+            "update_id": update_id,
+            "inline_query": {
+                "id": str(update_id),
+                "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+                "query": rng.choice(INLINE_QUERIES),
+                "offset": "",
+            },
+        }
+    if command == "ping":
+        return make_command_update(update_id, user_id, "/ping")
+    if command == "lyrix":
+        return make_command_update(update_id, user_id, f"/lyrix {track} $by {artist}")
+    text = {
+        "lyrics": "$lx",
+        "share": "$lx share",
+        "local_lyrics": "$lx local",
+        "local_share": "$lx local share",
+    }[command]
+    update = make_command_update(update_id, user_id, text)
+    del update["message"]["entities"]
+    return update
+
+
+class Pending:
+    __slots__ = ("command", "queued", "done", "trace", "finished")
+
+    def __init__(self, command: str):
+        self.command = command
+        self.queued = time.monotonic()
+        self.done = threading.Event()
+        self.trace: Optional[dict] = None
+        self.finished: Optional[float] = None
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.tmp = tempfile.mkdtemp(prefix="lyrix-load-")
+        self.catalogue = Catalogue(seed=args.seed)
+        latency = dict(DEFAULT_LATENCY, **parse_pairs(args.latency))
+        errors = parse_pairs(args.errors)
+
+        def faults(name: str) -> Faults:
+            return Faults(
+                latency=latency.get(name, 0.0),
+                jitter=latency.get(name, 0.0) * args.jitter,
+                error_rate=errors.get(name, 0.0),
+                seed=args.seed,
+            )
+
+        self.telegram = FakeBotApi(faults=faults("telegram"))
+        self.upstreams = {
+            "spotify": FakeSpotify(faults("spotify"), self.catalogue),
+            "lastfm": FakeLastFm(faults("lastfm"), self.catalogue),
+            "genius": FakeGenius(faults("genius"), self.catalogue),
+            "swaglyrics": FakeSwaglyrics(faults("swaglyrics"), self.catalogue),
+            "lyrix_backend": FakeHomeserver(faults("lyrix_backend"), self.catalogue),
+        }
+        self.pending: Dict[int, Pending] = {}
+        self.results: List[Pending] = []
+        self.log_tail = deque(maxlen=50)
+        self._next_update_id = 1
+        self._issued = 0
+        self._lock = threading.Lock()
+        self.bot: Optional[subprocess.Popen] = None
+
+    def bot_env(self) -> Dict[str, str]:
+        homeserver = self.upstreams["lyrix_backend"]
+        env = dict(os.environ)
+        env.update(DEFAULT_ENV)
+        env.update(
+            {
+                "PYTHONPATH": ROOT_DIR,
+                "TELEGRAM_BOT_TOKEN": TOKEN,
+                "SPOTIPY_CLIENT_ID": "load-harness",
+                "SPOTIPY_CLIENT_SECRET": "load-harness",
+                "SPOTIPY_REDIRECT_URI": "http://127.0.0.1/callback",
+                "LYRIX_BACKEND": homeserver.homeserver,
+                "LYRIX_BACKEND_TOKEN": "load-harness",
+                "LAST_FM_API_KEY": "load-harness",
+                "LYRIX_TELEGRAM_API_URL": self.telegram.base_url,
+                "LYRIX_SPOTIFY_API_URL": self.upstreams["spotify"].api_url,
+                "LYRIX_SPOTIFY_ACCOUNTS_URL": self.upstreams["spotify"].url,
+                "LYRIX_LAST_FM_API_URL": self.upstreams["lastfm"].api_url,
+                "HARNESS_GENIUS_URL": self.upstreams["genius"].url,
+                "HARNESS_SWAGLYRICS_URL": self.upstreams["swaglyrics"].url,
+                "LYRIX_HOMESERVER_SCHEME": "http",
+                "LYRIX_RUNTIME": self.args.runtime,
+                "LYRIX_INGEST": "polling",
+                "LYRIX_CACHE_DIR": os.path.join(self.tmp, "cache"),
+                "LYRIX_STORAGE_BACKEND": "json",
+                "LYRIX_STORAGE_JSON_PATH": os.path.join(self.tmp, "spotify.json"),
+                "LYRIX_SLOW_TRACE_SECONDS": "0",
+            }
+        )
+        env.pop("DEBUG", None)
+        for pair in self.args.env:
+            name, _, value = pair.partition("=")
+            env[name] = value
+        return env
+
+    def write_users(self) -> None:
+        homeserver = self.upstreams["lyrix_backend"].homeserver
+        users = [
+            {
+                "telegram_user_id": self.user_id(i),
+                "username": f"user{i}",
+                "homeserver": homeserver,
+                "token": f"token-{i}",
+            }
+            for i in range(self.args.users)
+        ]
+        with open(os.path.join(self.tmp, "spotify.json"), "w") as fp:
+            json.dump({"users": users}, fp)
+
+    @staticmethod
+    def user_id(i: int) -> int:
+        return 10_000_000 + i
+
+    def start(self) -> None:
+        self.telegram.start()
+        for upstream in self.upstreams.values():
+            upstream.start()
+        self.write_users()
+        self.bot = subprocess.Popen(
+            # the bot, with swaglyrics sent to the stand-ins
+            [sys.executable, "-m", "benchmarks.run_bot"],
+            cwd=self.tmp,
+            env=self.bot_env(),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+        threading.Thread(target=self._read_log, name="bot-log", daemon=True).start()
+        deadline = time.monotonic() + 60
+        while not self.telegram.methods["getUpdates"]:
+            if self.bot.poll() is not None or time.monotonic() > deadline:
+                self.fail("the bot did not start polling")
+            time.sleep(0.05)
+
+    def stop(self) -> None:
+        if self.bot is not None and self.bot.poll() is None:
+            self.bot.send_signal(signal.SIGINT)
+            try:
+                self.bot.wait(30)
+            except subprocess.TimeoutExpired:
+                self.bot.kill()
+        self.telegram.stop()
+        for upstream in self.upstreams.values():
+            upstream.stop()
+
+    def fail(self, reason: str) -> None:
+        print(f"{reason}, the last lines the bot logged:", file=sys.stderr)
+        for line in self.log_tail:
+            print(f"  {line}", file=sys.stderr)
+        self.stop()
+        sys.exit(1)
+
+    def _read_log(self) -> None:
+        for line in self.bot.stderr:
+            start = line.find(TRACE_MARKER)
+            if start == -1:
+                self.log_tail.append(line.rstrip())
+                continue
+            finished = time.monotonic()
+            trace = json.loads(line[start:])["slow_update"]
+            update_id = trace.get("attrs", {}).get("update_id")
+            with self._lock:
+                pending = self.pending.pop(update_id, None)
+            if pending is not None:
+                pending.trace = trace
+                pending.finished = finished
+                pending.done.set()
+
+    def _user(self, index: int) -> None:
+        rng = random.Random(self.args.seed * 100_003 + index)
+        commands, weights = zip(*self.mix.items())
+        user_id = self.user_id(index)
+        while True:
+            command = rng.choices(commands, weights=weights)[0]
+            with self._lock:
+                if self._issued >= self.args.updates:
+                    return
+                self._issued += 1
+                update_id = self._next_update_id
+                self._next_update_id += 1
+                pending = self.pending[update_id] = Pending(command)
+                # queued under the lock, so that the update ids only go up
+                self.telegram.queue_updates(
+                    [make_update(command, update_id, user_id, rng)]
+                )
+            pending.done.wait(self.args.timeout)
+            with self._lock:
+                self.pending.pop(update_id, None)
+                self.results.append(pending)
+            if self.args.think:
+                time.sleep(rng.expovariate(1 / self.args.think))
+
+    def run(self) -> dict:
+        self.mix = dict(DEFAULT_MIX, **parse_pairs(self.args.mix))
+        self.mix = {name: weight for name, weight in self.mix.items() if weight > 0}
+        users = [
+            threading.Thread(target=self._user, args=(i,), daemon=True)
+            for i in range(self.args.users)
+        ]
+        start = time.monotonic()
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.monotonic() - start
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> dict:
+        by_command = defaultdict(list)
+        for pending in self.results:
+            by_command[pending.command].append(pending)
+
+        commands = {}
+        for command, results in sorted(by_command.items()):
+            done = [p for p in results if p.trace is not None]
+            latencies = sorted(p.finished - p.queued for p in done)
+            calls = Counter()
+            errors = Counter()
+            for p in done:
+                count_upstream_calls(p.trace, calls, errors)
+            stats = {
+                "sent": len(results),
+                "done": len(done),
+                "timed_out": len(results) - len(done),
+                "failed": sum("error" in p.trace for p in done),
+            }
+            for p in PERCENTILES:
+                stats[f"p{p}_ms"] = percentile(latencies, p) * 1e3 if done else None
+            stats["max_ms"] = latencies[-1] * 1e3 if done else None
+            stats["upstream_calls"] = {
+                name: {
+                    "per_update": calls[name] / len(done),
+                    "errors": errors[name],
+                }
+                for name in sorted(calls)
+            }
+            commands[command] = stats
+
+        done = sum(stats["done"] for stats in commands.values())
+        upstreams = {
+            name: upstream.stats() for name, upstream in self.upstreams.items()
+        }
+        upstreams["telegram"] = {
+            method: {"calls": calls, "errors": self.telegram.errors[method]}
+            for method, calls in sorted(self.telegram.methods.items())
+        }
+        return {
+            "users": self.args.users,
+            "updates": len(self.results),
+            "done": done,
+            "seconds": elapsed,
+            "updates_per_second": done / elapsed,
+            "runtime": self.args.runtime,
+            "mix": self.mix,
+            "commands": commands,
+            "upstream_requests": upstreams,
+        }
+
+
+def count_upstream_calls(span: dict, calls: Counter, errors: Counter) -> None:
+    for child in span.get("children", ()):
+        if child["name"] in UPSTREAMS:
+            calls[child["name"]] += 1
+            if "error" in child or child.get("attrs", {}).get("status", 0) >= 400:
+                errors[child["name"]] += 1
+        count_upstream_calls(child, calls, errors)
+
+
+def print_report(report: dict) -> None:
+    print(
+        f"{report['done']} of {report['updates']} updates from {report['users']} "
+        f"users in {report['seconds']:.1f}s, "
+        f"{report['updates_per_second']:.1f} updates/s ({report['runtime']})"
+    )
+    columns = ["sent", "done", "failed"] + [f"p{p}_ms" for p in PERCENTILES]
+    width = max(len(command) for command in report["commands"])
+    print(f"\n{'command':<{width}} " + " ".join(f"{c:>8}" for c in columns))
+    for command, stats in report["commands"].items():
+        values = [
+            f"{stats[c]:>8.0f}" if stats[c] is not None else f"{'-':>8}"
+            for c in columns
+        ]
+        print(f"{command:<{width}} " + " ".join(values))
+
+    print(f"\n{'calls per update':<{width}} " + " ".join(f"{u:>13}" for u in UPSTREAMS))
+    for command, stats in report["commands"].items():
+        calls = stats["upstream_calls"]
+        values = [
+            f"{calls[u]['per_update']:>13.2f}" if u in calls else f"{'-':>13}"
+            for u in UPSTREAMS
+        ]
+        print(f"{command:<{width}} " + " ".join(values))
+
+    print("\nrequests the stand-ins got, background work included")
+    for name, routes in report["upstream_requests"].items():
+        counts = ", ".join(
+            f"{route} {stats['calls']}"
+            + (f" ({stats['errors']} failed)" if stats["errors"] else "")
+            for route, stats in routes.items()
+        )
+        print(f"  {name}: {counts}")
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--updates", type=int, default=2_000)
+    parser.add_argument(
+        "--mix",
+        default="",
+        help="command weights to change, like lyrics=50,inline=0, "
+        f"out of {','.join(DEFAULT_MIX)}",
+    )
+    parser.add_argument(
+        "--latency",
+        default="",
+        help=f"seconds the stand-ins answer in, like genius=0.5, "
+        f"out of {','.join(UPSTREAMS)}",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.5,
+        help="how much the latency varies, as a share of it",
+    )
+    parser.add_argument(
+        "--errors",
+        default="",
+        help="the share of the requests a stand-in fails, like spotify=0.05",
+    )
+    parser.add_argument(
+        "--think",
+        type=float,
+        default=3.0,
+        help="mean seconds a user waits between two commands, the replies to "
+        "a user who does not wait are held back by the rate limit of the chat",
+    )
+    parser.add_argument("--runtime", choices=("sync", "asyncio"), default="sync")
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="seconds after which an update counts as lost",
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        help="an extra variable for the bot, like LYRIX_SLOW_WORKERS=32",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="write the report to this json file")
+    return parser
+
+
+def main(argv: List[str] = None):
+    args = make_parser().parse_args(argv)
+
+    harness = Harness(args)
+    harness.start()
+    try:
+        report = harness.run()
+    finally:
+        harness.stop()
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+            fp.write("\n")
+
+
+if __name__ == "__main__":
+    main()
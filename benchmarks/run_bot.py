@@ -0,0 +1,54 @@
+"""
+Runs the bot for the load harness. swaglyrics scrapes Genius and asks its api
+with ``requests.get`` on urls it has built in, so the harness cannot point
+the bot at the stand-ins of those two through the environment like it does
+for the others. Here the ``requests`` of ``swaglyrics.cli`` is swapped for one
+that sends those urls to ``HARNESS_GENIUS_URL`` and
+``HARNESS_SWAGLYRICS_URL``; the bot itself runs unchanged.
+
+The swap is done when the module is imported, so that it also holds in the
+worker processes, which are spawned and import it again.
+"""
+
+import os
+from typing import Dict
+
+import requests
+import swaglyrics.cli
+from swaglyrics import backend_url
+
+GENIUS_URL = "https://genius.com"
+
+
+class RedirectedRequests:
+    """
+    The ``requests`` module, with the urls that start with a key of
+    ``redirects`` sent to its value instead
+    """
+
+    def __init__(self, redirects: Dict[str, str]):
+        self.redirects = redirects
+
+    def __getattr__(self, name: str):
+        return getattr(requests, name)
+
+    def get(self, url: str, *args, **kwargs) -> requests.Response:
+        for real, fake in self.redirects.items():
+            if url.startswith(real):
+                url = fake + url[len(real) :]
+                break
+        return requests.get(url, *args, **kwargs)
+
+
+swaglyrics.cli.requests = RedirectedRequests(
+    {
+        GENIUS_URL: os.environ["HARNESS_GENIUS_URL"],
+        backend_url: os.environ["HARNESS_SWAGLYRICS_URL"],
+    }
+)
+
+
+if __name__ == "__main__":
+    from lyrix_telegram_bot.bot import main
+
+    main()
@@ -0,0 +1,402 @@
+"""
+The offline benchmarks of the bot's hot paths, the ones that only spend CPU:
+parsing what Spotify and lyrixd report, building the song cards, the Last.fm
+cleanup, parsing the prefixed commands, and the user lookups. The upstreams
+are replaced by the responses recorded in ``benchmarks/fixtures``, so nothing
+goes over the network and the numbers can be compared between versions.
+
+Run it from the repository root with ``python -m benchmarks.suite``. With
+``--output`` the results are written as JSON, and with ``--compare`` they are
+checked against an earlier report, exiting with 1 when one of them regressed.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import timeit
+from collections import namedtuple
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+# LyrixApp creates its lyrics cache on start, it is kept out of the tree
+os.environ.setdefault("LYRIX_CACHE_DIR", tempfile.mkdtemp(prefix="lyrix-bench-"))
+
+from telegram import User
+
+from benchmarks.bench_registry import make_records
+from lyrix_telegram_bot.app import LyrixApp
+from lyrix_telegram_bot.commands import CommandInterface, lyrix_id_match
+from lyrix_telegram_bot.fetch import _parse_current_playing, parse_spotify_data
+from lyrix_telegram_bot.lastfm import LastFmClient
+from lyrix_telegram_bot.models.song import Song
+from lyrix_telegram_bot.normalize import (
+    clean_artist,
+    clean_track,
+    song_key,
+    track_info_key,
+)
+from lyrix_telegram_bot.storage import Storage
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+USER_COUNTS = (1_000, 10_000, 100_000)
+# users looked up by every call of the lookup benchmarks
+LOOKUPS = 1_000
+REPORT_VERSION = 1
+# a benchmark is a regression once it is this much slower than the baseline,
+# the runs of the same tree differ by 10 to 20% on a busy machine
+REGRESSION_THRESHOLD = 0.25
+
+Benchmark = namedtuple("Benchmark", "name setup params")
+BENCHMARKS: List[Benchmark] = []
+
+
+def benchmark(name: str, **params):
+    """
+    Registers a setup function, which prepares the fixtures and returns the
+    call to time. The call goes through all of its fixtures every time, so
+    that every sample does the same work.
+    """
+
+    def register(setup: Callable[[], Callable[[], object]]):
+        BENCHMARKS.append(Benchmark(name, setup, params))
+        return setup
+
+    return register
+
+
+def load_fixture(name: str, raw: bool = False):
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as fp:
+        return fp.read() if raw else json.load(fp)
+
+
+class FixtureResponse:
+    def __init__(self, body: str):
+        self.text = body
+        self.status_code = 200
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FixtureSession:
+    """
+    Answers every GET with the same recorded body, in place of the transport
+    """
+
+    def __init__(self, body: str):
+        self.body = body
+
+    def get(self, url: str, **kwargs) -> FixtureResponse:
+        return FixtureResponse(self.body)
+
+
+class FixtureStorage(Storage):
+    def __init__(self, records: List[dict] = None):
+        self.records = records or []
+
+    def load(self) -> List[dict]:
+        return self.records
+
+    def upsert(self, record: dict) -> None:
+        pass
+
+    def write(self, records: List[dict]) -> None:
+        pass
+
+
+class DispatchOnly(CommandInterface):
+    """
+    Runs the command parsing of ``general_command``, and only records which
+    command it dispatched to
+    """
+
+    def __init__(self, la: LyrixApp):
+        super().__init__(la)
+        self.dispatched = None
+
+    def get_lyrics(self, update, ctx):
+        self.dispatched = "get_lyrics"
+
+    def share_song(self, update, ctx):
+        self.dispatched = "share_song"
+
+    def ping_command(self, update, ctx):
+        self.dispatched = "ping_command"
+
+    def get_local_lyrics(self, update, ctx):
+        self.dispatched = "get_local_lyrics"
+
+    def share_local_song(self, update, ctx):
+        self.dispatched = "share_local_song"
+
+
+def make_app(records: List[dict] = None) -> LyrixApp:
+    la = LyrixApp(storage=FixtureStorage(records))
+    la.prefetcher.stop()
+    la.lastfm = LastFmClient(
+        api_key="benchmark",
+        session=FixtureSession(load_fixture("lastfm_track_info.json", raw=True)),
+    )
+    la.load()
+    return la
+
+
+def make_user() -> User:
+    return User(id=10_000_001, first_name="Ada <3", is_bot=False)
+
+
+def local_songs() -> List[Song]:
+    return [Song.from_json(data) for data in load_fixture("local_songs.json")]
+
+
+def clear_normalize_caches() -> None:
+    for func in (clean_artist, clean_track, song_key, track_info_key):
+        func.cache_clear()
+
+
+@benchmark("spotify.parse_current_playing")
+def setup_parse_current_playing():
+    track, user = load_fixture("spotify_currently_playing.json"), make_user()
+    return lambda: _parse_current_playing(track, user)
+
+
+@benchmark("spotify.parse_spotify_data")
+def setup_parse_spotify_data():
+    user = make_user()
+    song = _parse_current_playing(load_fixture("spotify_currently_playing.json"), user)
+    return lambda: parse_spotify_data(song, user)
+
+
+@benchmark("local.song_markup", wiki=False)
+def setup_song_markup():
+    ci, user, songs = CommandInterface(make_app()), make_user(), local_songs()
+    return lambda: [
+        ci.get_current_playing_local_song_markup(song, user, False) for song in songs
+    ]
+
+
+@benchmark("local.song_markup", wiki=True)
+def setup_song_markup_wiki():
+    ci, user, songs = CommandInterface(make_app()), make_user(), local_songs()
+    return lambda: [
+        ci.get_current_playing_local_song_markup(song, user, True) for song in songs
+    ]
+
+
+@benchmark("lastfm.track_info", cached=False)
+def setup_track_info():
+    la, songs = make_app(), local_songs()
+
+    def track_info():
+        # the parsed response and the cleaned names are cached, a new song
+        # has neither
+        la.lastfm.cache.clear()
+        clear_normalize_caches()
+        return [la.get_track_info(song, show_info=True) for song in songs]
+
+    return track_info
+
+
+@benchmark("lastfm.track_info", cached=True)
+def setup_track_info_cached():
+    la, songs = make_app(), local_songs()
+    return lambda: [la.get_track_info(song, show_info=True) for song in songs]
+
+
+@benchmark("commands.is_valid_command")
+def setup_is_valid_command():
+    ci = CommandInterface(make_app())
+    texts = load_fixture("commands.json")
+    return lambda: [ci.is_valid_command(text) for text in texts]
+
+
+@benchmark("commands.general_command")
+def setup_general_command():
+    ci = DispatchOnly(make_app())
+    updates = [
+        SimpleNamespace(message=SimpleNamespace(text=text))
+        for text in load_fixture("commands.json")
+    ]
+    return lambda: [ci.general_command(update, None) for update in updates]
+
+
+@benchmark("commands.lyrix_id_match")
+def setup_lyrix_id_match():
+    user = make_user()
+    song = _parse_current_playing(load_fixture("spotify_currently_playing.json"), user)
+    shared, _ = parse_spotify_data(song, user)
+    # the replies are mostly to shared songs, and some to anything else
+    texts = [shared, shared, shared] + load_fixture("commands.json")
+    return lambda: [lyrix_id_match.findall(text) for text in texts]
+
+
+def setup_users(size: int, lookup: str):
+    random.seed(0)
+    records = make_records(size)
+    la = make_app(records)
+    picked = random.sample(records, LOOKUPS)
+    if lookup == "telegram_id":
+        ids = [r["telegram_user_id"] for r in picked]
+        return lambda: [la.get_user(i) for i in ids]
+    handles = [(r["username"], r["homeserver"]) for r in picked]
+    return lambda: [la.get_user_by_handle(*handle) for handle in handles]
+
+
+def setup_users_load(size: int):
+    la = make_app(make_records(size))
+    return la.load
+
+
+for _size in USER_COUNTS:
+    for _lookup in ("telegram_id", "handle"):
+        BENCHMARKS.append(
+            Benchmark(
+                "users.get",
+                lambda size=_size, lookup=_lookup: setup_users(size, lookup),
+                {"users": _size, "by": _lookup},
+            )
+        )
+    BENCHMARKS.append(
+        Benchmark(
+            "users.load",
+            lambda size=_size: setup_users_load(size),
+            {"users": _size},
+        )
+    )
+
+
+def benchmark_id(bench: Benchmark) -> str:
+    if not bench.params:
+        return bench.name
+    params = ",".join(f"{key}={value}" for key, value in bench.params.items())
+    return f"{bench.name}[{params}]"
+
+
+def run(bench: Benchmark, repeat: int, min_time: float) -> dict:
+    timer = timeit.Timer(bench.setup())
+    number = 1
+    # as many calls per sample as take min_time, like timeit.autorange
+    while timer.timeit(number) < min_time:
+        number *= 2 if number < 8 else 10
+    samples = sorted(t / number for t in timer.repeat(repeat=repeat, number=number))
+    return {
+        "name": bench.name,
+        "params": bench.params,
+        "number": number,
+        "repeat": repeat,
+        "min_ns": samples[0] * 1e9,
+        "median_ns": samples[len(samples) // 2] * 1e9,
+        "max_ns": samples[-1] * 1e9,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(FIXTURES_DIR),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_report(results: Dict[str, dict]) -> dict:
+    return {
+        "version": REPORT_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def compare(results: Dict[str, dict], baseline: dict, threshold: float) -> List[str]:
+    """
+    Prints the change of every benchmark against the baseline report, and
+    returns the ones that regressed by more than ``threshold``
+    """
+    regressions = []
+    width = max(len(name) for name in results)
+    print(f"\n{'benchmark':<{width}} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:<{width}} {'-':>12} {result['min_ns']:>12.0f} {'new':>8}")
+            continue
+        change = result["min_ns"] / before["min_ns"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = " regressed"
+        print(
+            f"{name:<{width}} {before['min_ns']:>12.0f} {result['min_ns']:>12.0f} "
+            f"{change:>+8.1%}{flag}"
+        )
+    return regressions
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-o", "--output", help="write the report to this json file")
+    parser.add_argument("--compare", help="an earlier report to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help="the slowdown that counts as a regression, 0.25 is 25%%",
+    )
+    parser.add_argument(
+        "-k",
+        "--filter",
+        default="",
+        help="only run the benchmarks with this in the name",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.1,
+        help="the seconds every sample runs for at least",
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    selected = [b for b in BENCHMARKS if args.filter in benchmark_id(b)]
+    width = max((len(benchmark_id(b)) for b in selected), default=0)
+    print(f"{'benchmark':<{width}} {'min (ns)':>12} {'median (ns)':>12}")
+    for bench in selected:
+        result = run(bench, args.repeat, args.min_time)
+        name = benchmark_id(bench)
+        results[name] = result
+        print(f"{name:<{width}} {result['min_ns']:>12.0f} {result['median_ns']:>12.0f}")
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(make_report(results), fp, indent=2)
+            fp.write("\n")
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(
+                f"\n{len(regressions)} benchmarks regressed: {', '.join(regressions)}"
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
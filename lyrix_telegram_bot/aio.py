@@ -0,0 +1,126 @@
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Coroutine, Optional
+from urllib.parse import urlsplit
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httputil import url_concat
+
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.metrics import track_upstream, upstream_name
+from lyrix_telegram_bot.tracing import span
+from lyrix_telegram_bot.transport import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+
+# "sync" runs the handlers on the python-telegram-bot thread pool, "asyncio"
+# runs the network heavy handlers as coroutines on an AsyncRuntime
+RUNTIME = os.getenv("LYRIX_RUNTIME", "sync")
+# maximum number of concurrent upstream requests in the asyncio runtime
+ASYNC_MAX_CLIENTS = int(os.getenv("LYRIX_ASYNC_MAX_CLIENTS", "1000"))
+# threads for the calls that have no async api (telegram, swaglyrics, spotipy)
+ASYNC_BLOCKING_WORKERS = int(os.getenv("LYRIX_ASYNC_BLOCKING_WORKERS", "16"))
+
+
+class AsyncRuntime:
+    """
+    Runs an asyncio event loop on its own thread, along with tornado's async
+    http client. Handlers scheduled on it wait for their upstream requests
+    without holding a thread, so thousands of requests can be in flight at
+    once. Calls to libraries without an async api go through ``run_blocking``
+    on a bounded thread pool.
+    """
+
+    logger = make_logger("aio")
+
+    def __init__(
+        self,
+        max_clients: int = ASYNC_MAX_CLIENTS,
+        blocking_workers: int = ASYNC_BLOCKING_WORKERS,
+        connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+        read_timeout: float = HTTP_READ_TIMEOUT,
+    ):
+        self.max_clients = max_clients
+        self.connect_timeout = connect_timeout
+        self.request_timeout = connect_timeout + read_timeout
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(
+            blocking_workers, thread_name_prefix="lyrix-blocking"
+        )
+        self.http: Optional[AsyncHTTPClient] = None
+        self._thread = threading.Thread(
+            target=self._run, name="lyrix-asyncio", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self.loop).result()
+        self.logger.info("asyncio runtime started")
+
+    def stop(self) -> None:
+        if self.http is not None:
+            self.loop.call_soon_threadsafe(self.http.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.executor.shutdown(wait=False)
+
+    def submit(self, coro: Coroutine) -> Future:
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_exception)
+        return future
+
+    async def run_blocking(self, func: Callable, *args, **kwargs) -> Any:
+        # the call is traced as part of the coroutine that waits for it
+        context = contextvars.copy_context()
+        return await self.loop.run_in_executor(
+            self.executor, functools.partial(context.run, func, *args, **kwargs)
+        )
+
+    async def fetch_json(
+        self,
+        url: str,
+        method: str = "GET",
+        headers: dict = None,
+        params: dict = None,
+        body: dict = None,
+    ) -> Optional[Any]:
+        """
+        Sends the request and decodes the json response. Returns None for
+        empty responses, and raises ``tornado.httpclient.HTTPClientError``
+        for non 2xx responses.
+        """
+        request = HTTPRequest(
+            url_concat(url, params) if params else url,
+            method=method,
+            headers=headers,
+            body=json.dumps(body) if body is not None else None,
+            connect_timeout=self.connect_timeout,
+            request_timeout=self.request_timeout,
+        )
+        upstream = upstream_name(url)
+        with span(upstream, method=method, path=urlsplit(url).path):
+            with track_upstream(upstream):
+                response = await self.http.fetch(request)
+        if response.code == 204 or not response.body:
+            return None
+        return json.loads(response.body)
+
+    async def _setup(self) -> None:
+        self.http = AsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _log_exception(self, future: Future) -> None:
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            self.logger.error(
+                "Unhandled error in async handler",
+                exc_info=(type(exc), exc, exc.__traceback__),
+            )
@@ -1,104 +1,227 @@
-import json
-import urllib.parse
-
-from swaglyrics.cli import stripper
+from lyrix_telegram_bot.cache import SWRCache
+from lyrix_telegram_bot.lastfm import LastFmClient
 from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.lyrics import LyricsCache
 from lyrix_telegram_bot.models.song import Song
+import contextvars
 import os
+import threading
+import time
 from typing import Optional, Tuple
-import requests
 
 from lyrix_telegram_bot.models.user import LyrixUser
+from lyrix_telegram_bot.normalize import clean_artist
+from lyrix_telegram_bot.playlist import PlaylistWriter
+from lyrix_telegram_bot.prefetch import LyricsPrefetcher
+from lyrix_telegram_bot.registry import UserRegistry
+from lyrix_telegram_bot.singleflight import SingleFlight
+from lyrix_telegram_bot.storage import Storage, make_storage
+from lyrix_telegram_bot.tokens import spotify_client
+from lyrix_telegram_bot.tracing import span
 
-STORAGE_JSON_PATH = os.getenv("LYRIX_STORAGE_JSON_PATH", "spotify.json")
-DEFAULT_DATA = {"version": 1, "users": []}
 CACHE_DIR = os.getenv("LYRIX_CACHE_DIR", ".cache")
+# how long the now playing song of a user is reused by inline queries, and
+# for how long after that it is served while being refreshed
+NOW_PLAYING_TTL = float(os.getenv("LYRIX_NOW_PLAYING_TTL", "5"))
+NOW_PLAYING_STALE_TTL = float(os.getenv("LYRIX_NOW_PLAYING_STALE_TTL", "25"))
+# how long a command waits for the users being loaded in the background
+USERS_LOAD_TIMEOUT = float(os.getenv("LYRIX_USERS_LOAD_TIMEOUT", "60"))
+
+PLAYLIST_NAME = "lyrix 🎧"
 
 
 class LyrixApp:
     logger = make_logger("lyrix_app")
 
-    def __init__(self):
-        self.db = DEFAULT_DATA.copy()
+    def __init__(self, storage: Storage = None, read_through: bool = False):
+        self.storage = storage or make_storage()
+        # the users unknown to this process are looked up in the storage,
+        # where the other replicas of the bot add theirs
+        self.read_through = read_through
+        self.users = UserRegistry()
         os.makedirs(CACHE_DIR, exist_ok=True)
+        self.lyrics = LyricsCache()
+        self.prefetcher = LyricsPrefetcher(self.lyrics)
+        self.lastfm = LastFmClient()
+        self.now_playing = SWRCache(
+            ttl=NOW_PLAYING_TTL, stale_ttl=NOW_PLAYING_STALE_TTL, name="now_playing"
+        )
+        self._playlist_flight = SingleFlight()
+        self.playlists = PlaylistWriter(self.open_playlist, self.forget_playlist)
 
     def load(self):
-        if not os.path.exists(STORAGE_JSON_PATH):
-            with open(STORAGE_JSON_PATH, "w") as fp:
-                json.dump(DEFAULT_DATA, fp)
-
-        with open(STORAGE_JSON_PATH) as fp:
-            self.db.update(json.load(fp))
+        self.users.load(self.storage.load())
+
+    def load_in_background(self) -> threading.Thread:
+        """
+        Loads the users on a thread of its own, so that the bot can start
+        taking updates meanwhile. The commands that look a user up wait for
+        them.
+        """
+        self.users.begin_load(USERS_LOAD_TIMEOUT)
+        thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(self._load_users,),
+            name="lyrix-load-users",
+            daemon=True,
+        )
+        thread.start()
+        return thread
 
     def write(self):
-        with open(STORAGE_JSON_PATH, "w") as fp:
-            json.dump(self.db, fp)
+        try:
+            records = self.users.records()
+        except TimeoutError:
+            # the load may still finish, the next write stores the users then
+            self.logger.error("Not writing the users, they are still being loaded")
+            return
+        except RuntimeError:
+            # writing would replace the stored users with none
+            self.logger.error("Not writing the users, they were never loaded")
+            return
+        self.storage.write(records)
+
+    def _load_users(self) -> None:
+        start = time.perf_counter()
+        try:
+            with span("load_users"):
+                self.load()
+        except Exception as e:
+            self.logger.exception("Couldn't load the users")
+            self.users.fail_load(e)
+            return
+        elapsed = time.perf_counter() - start
+        self.logger.info(f"Loaded {len(self.users)} users in {elapsed * 1e3:.0f}ms")
 
     def add_user(self, user: LyrixUser):
-        for u in self.db["users"]:
-            if u.get("telegram_user_id") == user.telegram_user_id:
-                u.update(user.parse_to_dict())
-                return
-        self.db["users"].append(user.parse_to_dict())
+        self.storage.upsert(self.users.upsert(user))
 
     def get_spotify_user_from_telegram_user(
         self, telegram_id: int
     ) -> Optional[LyrixUser]:
-        for user in self.db["users"]:
-            if user.get("telegram_user_id") == telegram_id:
-                return LyrixUser.from_dict(user)
-        return None
+        return self.get_user(telegram_id)
 
     def get_user(self, telegram_id: int) -> Optional[LyrixUser]:
-        for user in self.db["users"]:
-            if user.get("telegram_user_id") == telegram_id:
-                return LyrixUser.from_dict(user)
+        user = self.users.get(telegram_id)
+        if user is None and self.read_through:
+            record = self.storage.get(telegram_id)
+            if record is not None:
+                user = self.users.add(record)
+        return user
+
+    def get_user_by_handle(self, username: str, homeserver: str) -> Optional[LyrixUser]:
+        user = self.users.get_by_handle(username, homeserver)
+        if user is None and self.read_through:
+            record = self.storage.get_by_handle(username, homeserver)
+            if record is not None:
+                user = self.users.add(record)
+        return user
+
+    def get_spotify_profile(self, user: LyrixUser, sp) -> Tuple[str, str]:
+        """
+        Returns the spotify user id and display name of the user. Spotify is
+        only asked the first time, after that they are read from the storage.
+        """
+        if user.spotify_user_id is None:
+            me = sp.me()
+            user.set_spotify_profile(me["id"], me.get("display_name"))
+            self.add_user(user)
+        return user.spotify_user_id, user.spotify_display_name
+
+    def get_playlist_id(self, user: LyrixUser, sp) -> str:
+        """
+        Returns the id of the user's lyrix playlist, creating it the first
+        time. Concurrent calls for the same user create one playlist.
+        """
+        if user.playlist_id is not None:
+            return user.playlist_id
+        return self._playlist_flight.do(
+            user.telegram_user_id, self._find_or_create_playlist, user, sp
+        )
+
+    def open_playlist(self, user: LyrixUser) -> Tuple["spotipy.Spotify", str]:
+        """
+        Returns a spotify client for the user, and the id of their playlist
+        """
+        sp = spotify_client(user.get_access_token())
+        return sp, self.get_playlist_id(user, sp)
+
+    def forget_playlist(self, user: LyrixUser) -> None:
+        """
+        Drops the stored id of the user's playlist, when it was deleted in
+        spotify, so that another one is created
+        """
+        user.set_user_playlist_queue(None)
+        self.add_user(user)
+
+    def forget_spotify_account(self, user: LyrixUser) -> None:
+        """
+        Drops the cached spotify profile and playlist, when the user connects
+        another spotify account
+        """
+        user.set_spotify_profile(None, None)
+        user.set_user_playlist_queue(None)
+        self.add_user(user)
+        self.playlists.invalidate(user.telegram_user_id)
+
+    def _find_or_create_playlist(self, user: LyrixUser, sp) -> str:
+        spotify_user_id, _ = self.get_spotify_profile(user, sp)
+        playlist_id = self._find_playlist(sp, spotify_user_id)
+        if playlist_id is None:
+            self.logger.info(f"Creating a playlist for {spotify_user_id}")
+            playlist_id = sp.user_playlist_create(
+                spotify_user_id,
+                PLAYLIST_NAME,
+                public=False,
+                collaborative=False,
+                description="Lyrix song queue",
+            )["id"]
+        user.set_user_playlist_queue(playlist_id)
+        self.add_user(user)
+        return playlist_id
+
+    @staticmethod
+    def _find_playlist(sp, spotify_user_id: str) -> Optional[str]:
+        # the playlist ids were not stored before, so the users who already
+        # have a lyrix playlist get it back instead of another one
+        page = sp.current_user_playlists(limit=50)
+        while page:
+            for playlist in page["items"]:
+                if (
+                    playlist["name"] == PLAYLIST_NAME
+                    and playlist["owner"]["id"] == spotify_user_id
+                ):
+                    return playlist["id"]
+            page = sp.next(page) if page.get("next") else None
         return None
 
+    def get_lyrics(self, track: str, artist: str) -> Optional[str]:
+        return self.lyrics.get(track, artist)
+
     def get_track_info(self, song: Song, show_info: bool = False) -> Tuple[str, str]:
-        last_fm_api_key = os.getenv("LAST_FM_API_KEY")
-        if not last_fm_api_key:
+        if not self.lastfm.api_key:
+            return "", ""
+        if not song.track or not song.artist:
+            return "", ""
+
+        album_art, wiki = self.lastfm.get_track_info(
+            clean_artist(song.artist), song.track
+        )
+        if not show_info:
+            wiki = ""
+        return album_art, wiki
+
+    async def get_track_info_async(
+        self, rt, song: Song, show_info: bool = False
+    ) -> Tuple[str, str]:
+        if not self.lastfm.api_key:
             return "", ""
         if not song.track or not song.artist:
             return "", ""
-        self.logger.info("Requesting Track information from Last.fm api")
-        artist = song.artist
-        if "," in artist:
-            artist = artist.split(", ")[0]
-
-        # clean the artist names with some popular substitutions
-        artist = artist.replace("- Music", "")
-        artist = stripper("", artist).rstrip("-").replace("-", " ")
-        self.logger.info(f"Cleaned artist name from {song.artist} to {artist}")
-
-        info = requests.get(
-            "https://ws.audioscrobbler.com/2.0/?method=track.getInfo"
-            "&api_key={API_KEY}&artist={artist}&track={track}&autocorrect=1"
-            "&format=json".format(
-                API_KEY=last_fm_api_key,
-                artist=urllib.parse.quote_plus(artist),
-                track=urllib.parse.quote_plus(song.track),
-            )
-        ).json()
-
-        image_infographics = info.get("track", {}).get("album", {}).get("image", [])
-
-        album_art = ""
-        for image_info in image_infographics[::-1]:
-            if image_info.get("#text"):
-                album_art = image_info.get("#text")
-                self.logger.info("Received Album Art for song")
-                break
-
-        wiki = ""
-        if show_info:
-            wiki = info.get("track", {}).get("wiki", {}).get("summary", "")
-            while wiki.find("<a href") != -1:
-                start_idx = wiki.find("<a href")
-                end_idx = wiki.find("</a>")
-                wiki = wiki[:start_idx] + wiki[end_idx + len("</a>") :]
-                self.logger.info("Received Wiki information for the song")
-                if "<a href" not in wiki:
-                    break
 
+        album_art, wiki = await self.lastfm.get_track_info_async(
+            rt, clean_artist(song.artist), song.track
+        )
+        if not show_info:
+            wiki = ""
         return album_art, wiki
@@ -0,0 +1,109 @@
+import os
+
+from lyrix_api.meta import Song
+from requests import Response
+
+from lyrix_telegram_bot.singleflight import AsyncSingleFlight, SingleFlight
+from lyrix_telegram_bot.transport import transport
+
+# the homeservers are reached over https, plain http is only for stand-ins
+HOMESERVER_SCHEME = os.getenv("LYRIX_HOMESERVER_SCHEME", "https")
+
+_local_song_flight = SingleFlight()
+_local_song_async_flight = AsyncSingleFlight()
+
+
+class LyrixBackend:
+    """
+    The parts of the lyrix backend api the bot uses. It mirrors
+    ``lyrix_api.api.Api``, but sends the requests through the shared
+    transport, so that connections to the homeservers are kept alive.
+    """
+
+    @staticmethod
+    def _get(user, endpoint: str, auth: bool = False) -> Response:
+        headers = {"Content-Type": "application/json"}
+        if auth:
+            headers["Authorization"] = f"Bearer {user.token}"
+        return transport.session.get(
+            f"{HOMESERVER_SCHEME}://{user.homeserver}{endpoint}", headers=headers
+        )
+
+    @staticmethod
+    def _post(user, endpoint: str, data: dict, auth: bool = False) -> Response:
+        headers = {"Content-Type": "application/json"}
+        if auth:
+            headers["Authorization"] = f"Bearer {user.token}"
+        return transport.session.post(
+            f"{HOMESERVER_SCHEME}://{user.homeserver}{endpoint}",
+            headers=headers,
+            json=data,
+        )
+
+    @staticmethod
+    def get_current_local_listening_song(user) -> Song:
+        """
+        GET /user/player/local/current_song
+
+        Concurrent calls for the same user share one request
+        """
+        return _local_song_flight.do(
+            user.telegram_user_id, LyrixBackend._get_current_local_listening_song, user
+        )
+
+    @staticmethod
+    def _get_current_local_listening_song(user) -> Song:
+        data = LyrixBackend._get(
+            user, "/user/player/local/current_song", auth=True
+        ).json()
+        return Song(
+            data["track"], data["artist"], data.get("source"), data.get("url"), data
+        )
+
+    @staticmethod
+    async def get_current_local_listening_song_async(rt, user) -> Song:
+        """
+        GET /user/player/local/current_song, on an AsyncRuntime
+        """
+        return await _local_song_async_flight.do(
+            user.telegram_user_id,
+            LyrixBackend._get_current_local_listening_song_async,
+            rt,
+            user,
+        )
+
+    @staticmethod
+    async def _get_current_local_listening_song_async(rt, user) -> Song:
+        data = await rt.fetch_json(
+            f"{HOMESERVER_SCHEME}://{user.homeserver}/user/player/local/current_song",
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {user.token}",
+            },
+        )
+        return Song(
+            data["track"], data["artist"], data.get("source"), data.get("url"), data
+        )
+
+    @staticmethod
+    def get_spotify_token(user) -> str:
+        """
+        GET /user/player/spotify/token
+
+        Returns the saved spotify token
+        """
+        data = LyrixBackend._get(user, "/user/player/spotify/token", auth=True).json()
+        return data["token"]
+
+    @staticmethod
+    def send_spotify_token(user, spotify_token: str) -> bool:
+        """
+        POST /user/player/spotify/token
+        """
+        data = LyrixBackend._post(
+            user,
+            "/user/player/spotify/token",
+            auth=True,
+            data={"spotify_token": spotify_token},
+        )
+        return 200 <= data.status_code <= 210
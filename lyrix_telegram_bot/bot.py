@@ -1,7 +1,20 @@
+import json
 import os
+import time
+from multiprocessing.connection import Connection
+from typing import Optional
+
+# taken before the other imports, so that the startup report counts them
+IMPORTS_STARTED = time.perf_counter()
 
 from dotenv import load_dotenv
+
+# the modules of the bot read their settings when they are imported, so .env
+# is loaded before any of them
+load_dotenv()
+
 from telegram import (
+    Bot,
     Update,
 )
 from telegram.ext import (
@@ -11,30 +24,149 @@ from telegram.ext import (
     Filters,
     CallbackContext,
     InlineQueryHandler,
+    MessageFilter,
+    TypeHandler,
 )
+from telegram.utils.request import Request
 
+from lyrix_telegram_bot.aio import RUNTIME, AsyncRuntime
 from lyrix_telegram_bot.app import LyrixApp
-from lyrix_telegram_bot.commands import CommandInterface
+from lyrix_telegram_bot.commands import CommandInterface, AsyncCommandInterface
+from lyrix_telegram_bot.lazy import preload
 from lyrix_telegram_bot.logger import setup_logging, make_logger
+from lyrix_telegram_bot.metrics import (
+    METRICS_PORT,
+    MetricsServer,
+    instrument_handler,
+    metrics,
+)
+from lyrix_telegram_bot.outbound import (
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_WORKERS,
+    TELEGRAM_API_URL,
+    OutboundBot,
+    OutboundQueue,
+)
+from lyrix_telegram_bot.replicas import REPLICAS, ReplicaNode
+from lyrix_telegram_bot.scheduler import Scheduler
+from lyrix_telegram_bot.shared import SHARED_STORE, shared_store
+from lyrix_telegram_bot.storage import STORAGE_BACKEND
+from lyrix_telegram_bot.tracing import Span, add_span, detach, span, start_trace
+from lyrix_telegram_bot.transport import transport
+from lyrix_telegram_bot.webhook import ALLOWED_UPDATES, INGEST, WebhookServer
+from lyrix_telegram_bot.workers import WORKERS, WorkerInbox, WorkerPool
 
-try:
-    from lyrix_telegram_bot.external_commands import ExternalCommandInterface
+# "eager" loads the users and imports every library before taking updates,
+# "lazy" takes updates right away, loads the users in the background, and
+# imports the slow libraries the first time a command needs them
+STARTUP = os.getenv("LYRIX_STARTUP", "eager")
+# the variables the bot does not start without
+REQUIRED_ENV = (
+    "TELEGRAM_BOT_TOKEN",
+    "SPOTIPY_CLIENT_ID",
+    "SPOTIPY_CLIENT_SECRET",
+    "LYRIX_BACKEND",
+    "LYRIX_BACKEND_TOKEN",
+)
 
-    external_commands = True
-except ModuleNotFoundError:
-    external_commands = False
+t_logger = make_logger("tg")
 
-load_dotenv()
+# the commands that answer without touching the storage or an upstream
+# service, they run on the scheduler's fast pool and everything else on the
+# slow one
+FAST_COMMANDS = {
+    "ping",
+    "telegram_id",
+    "who_am_i",
+    "start",
+    "help",
+    "stats",
+}
 
-client_id = os.environ["SPOTIPY_CLIENT_ID"]
-client_secret = os.environ["SPOTIPY_CLIENT_SECRET"]
-lyrix_backend = os.environ["LYRIX_BACKEND"]
 
-lyrix_backend_token = os.environ["LYRIX_BACKEND_TOKEN"]
+class PrefixFilter(MessageFilter):
+    """
+    Matches the messages starting with the command prefix, so that the other
+    messages in a group never reach the scheduler
+    """
 
-setup_logging()
+    def __init__(self, ci: CommandInterface):
+        super().__init__()
+        self.ci = ci
 
-t_logger = make_logger("tg")
+    def filter(self, message) -> bool:
+        return message.text is not None and self.ci.is_valid_command(message.text)
+
+
+def register_gauges(
+    updater: Updater, scheduler: Scheduler, outbound: OutboundQueue, la: LyrixApp
+) -> None:
+    """
+    Exposes the depth of the queues, the outbound queue stats, the cache
+    counters and the connection pools on /metrics
+    """
+    metrics.gauge(
+        "lyrix_queue_depth",
+        "Jobs waiting in a queue",
+        ("queue",),
+        lambda: {
+            ("updates",): updater.dispatcher.update_queue.qsize(),
+            ("fast",): scheduler.fast.stats()["queued"],
+            ("slow",): scheduler.slow.stats()["queued"],
+            ("outbound",): outbound.stats()["queued"],
+            ("prefetch",): la.prefetcher.stats()["waiting"],
+        },
+    )
+    metrics.gauge(
+        "lyrix_outbound",
+        "Messages sent and retried by the outbound queue, and how long they "
+        "waited in it",
+        ("stat",),
+        lambda: {(stat,): value for stat, value in outbound.stats().items()},
+    )
+    caches = {
+        "lyrics": la.lyrics,
+        "lastfm": la.lastfm.cache,
+        "now_playing": la.now_playing,
+    }
+    metrics.gauge(
+        "lyrix_cache",
+        "Size, hits and misses of the caches",
+        ("cache", "stat"),
+        lambda: {
+            (name, stat): value
+            for name, cache in caches.items()
+            for stat, value in cache.stats().items()
+        },
+    )
+    metrics.gauge(
+        "lyrix_http_pool",
+        "Connections of the upstream pools, and how saturated they are",
+        ("pool", "stat"),
+        lambda: {
+            (pool, stat): value
+            for pool, stats in transport.stats().items()
+            for stat, value in stats.items()
+        },
+    )
+
+
+def register_replica_gauge(node: ReplicaNode) -> None:
+    metrics.gauge(
+        "lyrix_replica",
+        "Updates routed between the replicas, and whether this one polls",
+        ("stat",),
+        lambda: {(stat,): value for stat, value in node.stats().items()},
+    )
+
+
+def register_webhook_gauge(webhook: WebhookServer) -> None:
+    metrics.gauge(
+        "lyrix_webhook",
+        "Updates the webhook took, refused and asked Telegram to send again",
+        ("stat",),
+        lambda: {(stat,): value for stat, value in webhook.stats().items()},
+    )
 
 
 def send_commands(
@@ -46,22 +178,204 @@ def send_commands(
     update.message.reply_text(text_message, parse_mode="html")
 
 
-def main() -> None:
-    """Start the bot."""
-    # Create the Updater and pass it your bot's token.
+def log_startup(startup: Span) -> None:
+    """
+    Logs how long every step of the startup took, and exposes them on
+    /metrics. With the lazy startup the users may still be loading.
+    """
+    logger = make_logger("main")
+    steps = ", ".join(
+        f"{step.name} {step.duration * 1e3:.0f}ms"
+        + ("" if step.end is not None else " (still running)")
+        for step in startup.children
+    )
+    logger.info(f"Started in {startup.duration * 1e3:.0f}ms: {steps}")
+    logger.info(json.dumps({"startup": startup.to_dict()}, default=str))
+    metrics.gauge(
+        "lyrix_startup_seconds",
+        "Time spent on every step of the startup",
+        ("step",),
+        lambda: {
+            (step.name,): step.duration
+            for step in startup.children
+            if step.end is not None
+        },
+    )
+
+
+def start_ingest(
+    updater: Updater, node: Optional[ReplicaNode]
+) -> Optional[WebhookServer]:
+    """
+    Starts taking the updates, through the webhook or by polling
+    """
+    webhook = None
+    if INGEST == "webhook":
+        make_logger("main").info("Receiving updates through the webhook")
+        webhook = WebhookServer(
+            updater, forward=node.router.forward if node is not None else None
+        )
+        webhook.start()
+        if node is not None:
+            node.start(poll=False)
+    elif node is not None:
+        node.start(poll=True)
+    else:
+        updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+    return webhook
+
+
+def run_front(startup: Span, token) -> None:
+    """
+    Takes the updates and hands them to the worker processes, which run the
+    handlers, each for its own share of the users
+    """
+    logger = make_logger("main")
+    with span("updater"):
+        # the front never answers, the workers send the replies
+        updater = Updater(
+            bot=Bot(os.environ["TELEGRAM_BOT_TOKEN"], base_url=TELEGRAM_API_URL)
+        )
+
+    node = None
+    if REPLICAS > 1:
+        node = ReplicaNode(updater, shared_store)
+    pool = WorkerPool()
+    updater.dispatcher.add_handler(TypeHandler(Update, pool.dispatch))
+    with span("workers", workers=WORKERS):
+        pool.start()
 
+    metrics_server = None
+    if metrics.enabled:
+        metrics.gauge(
+            "lyrix_worker",
+            "Updates waiting for and sent to every worker, and its restarts",
+            ("worker", "stat"),
+            lambda: {
+                (str(i), stat): value
+                for i, stats in enumerate(pool.stats())
+                for stat, value in stats.items()
+            },
+        )
+        if node is not None:
+            register_replica_gauge(node)
+        metrics_server = MetricsServer()
+        metrics_server.start()
+
+    with span("ingest", ingest=INGEST):
+        webhook = start_ingest(updater, node)
+    if webhook is not None and metrics.enabled:
+        register_webhook_gauge(webhook)
+    startup.finish()
+    detach(token)
+    log_startup(startup)
+
+    updater.idle()
+    logger.info("Received terminate. Stopping")
+
+    if webhook is not None:
+        webhook.stop()
+    if node is not None:
+        node.stop()
+    logger.info("Stopping the workers")
+    pool.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+    logger.info("Exiting")
+
+
+def main(
+    worker: Optional[int] = None, conn: Optional[Connection] = None, ready=None
+) -> None:
+    """
+    Start the bot. With LYRIX_WORKERS, this process takes the updates and
+    starts the workers, which call it again with ``worker``, ``conn`` to get
+    their updates from and ``ready`` to set once they take them.
+    """
+    imported = time.perf_counter()
+    startup, token = start_trace("startup", mode=STARTUP)
+    if worker is not None:
+        startup.attrs["worker"] = worker
+    startup.start = IMPORTS_STARTED
+    add_span("imports", IMPORTS_STARTED, imported)
+
+    with span("config"):
+        missing = [name for name in REQUIRED_ENV if not os.getenv(name)]
+        if missing:
+            raise SystemExit(f"Missing environment variables: {', '.join(missing)}")
+        setup_logging()
+        if STARTUP not in ("eager", "lazy"):
+            raise ValueError(f"Unknown LYRIX_STARTUP {STARTUP!r}")
+        if RUNTIME not in ("sync", "asyncio"):
+            raise ValueError(f"Unknown LYRIX_RUNTIME {RUNTIME!r}")
+        if INGEST not in ("polling", "webhook"):
+            raise ValueError(f"Unknown LYRIX_INGEST {INGEST!r}")
+        if REPLICAS > 1 and (SHARED_STORE == "local" or STORAGE_BACKEND != "sqlite"):
+            raise ValueError(
+                "LYRIX_REPLICAS needs a LYRIX_SHARED_STORE and the sqlite "
+                "LYRIX_STORAGE_BACKEND the replicas share"
+            )
+        if WORKERS > 0 and STORAGE_BACKEND != "sqlite":
+            raise ValueError(
+                "LYRIX_WORKERS needs the sqlite LYRIX_STORAGE_BACKEND the workers share"
+            )
+
+    if WORKERS > 0 and worker is None:
+        run_front(startup, token)
+        return
+
+    if STARTUP == "eager":
+        with span("preload"):
+            preload()
+
+    # Create the Updater and pass it your bot's token.
     logger = make_logger("main")
     logger.info("Trying to login to telegram with token")
-    updater = Updater(os.environ["TELEGRAM_BOT_TOKEN"])
+    with span("updater"):
+        # the replicas and their workers share the rate Telegram allows the
+        # bot, the chats are only ever sent to by the one that owns the user
+        outbound = OutboundQueue(
+            global_rate=OUTBOUND_GLOBAL_RATE / REPLICAS / max(WORKERS, 1)
+        )
+        bot = OutboundBot(
+            os.environ["TELEGRAM_BOT_TOKEN"],
+            outbound,
+            base_url=TELEGRAM_API_URL,
+            request=Request(con_pool_size=OUTBOUND_WORKERS + 4),
+        )
+        updater = Updater(bot=bot)
     logger.info("Login successful")
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
-    la = LyrixApp()
+    node = None
+    # the front process of the workers routes between the replicas
+    if REPLICAS > 1 and worker is None:
+        # the updates of another replica's users are routed as they are taken
+        # from Telegram, and never reach this dispatcher
+        node = ReplicaNode(updater, shared_store)
+
+    with span("app"):
+        # the users registered through another replica or worker are read
+        # from the storage the first time this one sees them
+        la = LyrixApp(read_through=node is not None or worker is not None)
+    if STARTUP == "lazy":
+        la.load_in_background()
+    else:
+        with span("load_users"):
+            la.load()
     prefix = os.getenv("LYRIX_PREFIX") or "$lx"
     suffix = os.getenv("LYRIX_SUFFIX") or ""
 
-    ci = CommandInterface(la, prefix=prefix)
+    rt = None
+    if RUNTIME == "asyncio":
+        logger.info("Using the asyncio runtime")
+        with span("runtime"):
+            rt = AsyncRuntime()
+            rt.start()
+        ci = AsyncCommandInterface(la, rt, prefix=prefix)
+    else:
+        ci = CommandInterface(la, prefix=prefix)
 
     commands = [
         [("ping", ci.ping_command), "👀 Ping the bot to see its alive"],
@@ -104,47 +418,135 @@ def main() -> None:
         [("clearplaylist", ci.clear_playlist), "🗑 Clear the lyrix spotify playlist"],
     ]
 
-    if external_commands:
+    try:
+        from lyrix_telegram_bot.external_commands import ExternalCommandInterface
+    except ModuleNotFoundError:
+        pass
+    else:
         external_ci = ExternalCommandInterface()
         commands += external_ci.commands()
 
+    scheduler = Scheduler()
+    # the lyrics are only prefetched while the requests are not queueing up
+    la.prefetcher.busy = scheduler.slow.busy
+
     # on different commands - answer in Telegram
     print("Available commands are:")
     for command, help_message in commands:
         command_text, command_func = command
+        slow = command_text not in FAST_COMMANDS
         command_text = command_text + suffix
         print(f"{command_text} - {help_message}")
         dispatcher.add_handler(
-            CommandHandler(command_text, command_func, run_async=True)
+            CommandHandler(
+                command_text,
+                scheduler.handler(
+                    instrument_handler(command_text, command_func), slow=slow
+                ),
+            )
         )
     dispatcher.add_handler(
         CommandHandler(
             f"help{suffix}",
-            lambda update, ctx: send_commands(update, ctx, commands, suffix),
-            run_async=True,
+            scheduler.handler(
+                instrument_handler(
+                    "help",
+                    lambda update, ctx: send_commands(update, ctx, commands, suffix),
+                )
+            ),
+        )
+    )
+
+    # left out of the help, it only answers the admins
+    dispatcher.add_handler(
+        CommandHandler(
+            f"stats{suffix}",
+            scheduler.handler(instrument_handler(f"stats{suffix}", ci.stats)),
         )
     )
 
     # on non command i.e message - general_command the message on Telegram
     dispatcher.add_handler(
-        MessageHandler(Filters.text & ~Filters.command, ci.general_command)
+        MessageHandler(
+            Filters.text & ~Filters.command & PrefixFilter(ci),
+            scheduler.handler(
+                instrument_handler("general_command", ci.general_command), slow=True
+            ),
+        )
     )
 
-    dispatcher.add_handler(InlineQueryHandler(ci.inline_query))
+    dispatcher.add_handler(
+        InlineQueryHandler(
+            scheduler.handler(
+                instrument_handler("inline_query", ci.inline_query),
+                slow=True,
+                latest=True,
+            )
+        )
+    )
+
+    metrics_server = None
+    if metrics.enabled:
+        register_gauges(updater, scheduler, outbound, la)
+        if node is not None:
+            register_replica_gauge(node)
+        port = int(METRICS_PORT)
+        if worker is not None:
+            # the workers serve theirs on the ports after the one of the front
+            port += 1 + worker
+        metrics_server = MetricsServer(port=port)
+        metrics_server.start()
     logger.info("Bot is up, and is ready to receive commands.")
 
     # Start the Bot
-    updater.start_polling()
+    webhook = None
+    inbox = None
+    if worker is not None:
+        with span("ingest", ingest="worker"):
+            inbox = WorkerInbox(updater, conn, ready, worker)
+            inbox.start()
+    else:
+        with span("ingest", ingest=INGEST):
+            webhook = start_ingest(updater, node)
+        if webhook is not None and metrics.enabled:
+            register_webhook_gauge(webhook)
+    startup.finish()
+    detach(token)
+    log_startup(startup)
 
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    if inbox is not None:
+        # the front stops the workers
+        inbox.wait()
+        updater.stop()
+    else:
+        # Run the bot until you press Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        updater.idle()
     logger.info("Received terminate. Stopping")
     logger.info("Completing exit")
 
-    logger.info("Writing files")
-    la.write()
+    if webhook is not None:
+        webhook.stop()
+
+    if node is not None:
+        node.stop()
+
+    if metrics_server is not None:
+        metrics_server.stop()
+
+    scheduler.stop()
+    la.prefetcher.stop()
+    outbound.stop()
+
+    if rt is not None:
+        rt.stop()
+
+    # every change was written as it was made, and writing all the users of
+    # this process would undo the changes the others made since it loaded them
+    if node is None and worker is None:
+        logger.info("Writing files")
+        la.write()
     logger.info("Exiting")
 
 
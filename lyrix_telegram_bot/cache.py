@@ -0,0 +1,190 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.tracing import span
+
+# returned by TTLCache.get when nothing is cached, so that None can be cached
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread safe, in-memory LRU cache whose entries expire after a TTL
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """
+        Whether the key has a live entry, without counting a hit or a miss and
+        without moving it up the LRU order, for the speculative checks
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class SWRCache:
+    """
+    Cache whose entries are fresh for ``ttl`` seconds, and then served stale
+    for ``stale_ttl`` more seconds while they are revalidated in the
+    background (stale-while-revalidate)
+    """
+
+    logger = make_logger("cache")
+
+    def __init__(
+        self,
+        ttl: float,
+        stale_ttl: float,
+        maxsize: int = 4096,
+        revalidate_workers: int = 4,
+        name: str = "swr",
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl + stale_ttl)
+        self._revalidating = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            revalidate_workers, thread_name_prefix="lyrix-revalidate"
+        )
+
+    def lookup(self, key: Hashable) -> Tuple[Any, bool]:
+        """
+        Returns the cached value and whether it is still fresh, or MISSING
+        """
+        with span(f"cache.{self.name}") as current:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                result = MISSING, False
+            else:
+                fetched_at, value = entry
+                fresh = time.monotonic() - fetched_at < self.ttl
+                if fresh:
+                    self.hits += 1
+                else:
+                    self.stale_hits += 1
+                result = value, fresh
+            if current is not None:
+                current.attrs["result"] = (
+                    "miss" if entry is None else "fresh" if fresh else "stale"
+                )
+        return result
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._entries.set(key, (time.monotonic(), value))
+
+    def pop(self, key: Hashable) -> None:
+        self._entries.pop(key)
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        value, fresh = self.lookup(key)
+        if value is MISSING:
+            value = loader()
+            self.set(key, value)
+        elif not fresh and self._start_revalidation(key):
+            self._executor.submit(self._revalidate, key, loader)
+        return value
+
+    async def get_async(
+        self, key: Hashable, loader: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        value, fresh = self.lookup(key)
+        if value is MISSING:
+            value = await loader()
+            self.set(key, value)
+        elif not fresh and self._start_revalidation(key):
+            asyncio.ensure_future(self._revalidate_async(key, loader))
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+        }
+
+    def _start_revalidation(self, key: Hashable) -> bool:
+        with self._lock:
+            if key in self._revalidating:
+                return False
+            self._revalidating.add(key)
+            return True
+
+    def _finish_revalidation(self, key: Hashable) -> None:
+        with self._lock:
+            self._revalidating.discard(key)
+
+    def _revalidate(self, key: Hashable, loader: Callable[[], Any]) -> None:
+        try:
+            self.set(key, loader())
+        except Exception as e:
+            self.logger.warning(f"Couldn't revalidate {key}: {e}")
+        finally:
+            self._finish_revalidation(key)
+
+    async def _revalidate_async(
+        self, key: Hashable, loader: Callable[[], Awaitable[Any]]
+    ) -> None:
+        try:
+            self.set(key, await loader())
+        except Exception as e:
+            self.logger.warning(f"Couldn't revalidate {key}: {e}")
+        finally:
+            self._finish_revalidation(key)
@@ -1,16 +1,17 @@
+import hashlib
 import os
 import re
 import random
 import urllib.parse
 from collections import namedtuple
+from concurrent.futures import Future
 from datetime import datetime
-from typing import Tuple
-from uuid import uuid4
+from html import escape
+from typing import Optional, Tuple
 
-from spotipy import CacheFileHandler, SpotifyOAuth
-
-from lyrix_api.api import Api
-from lyrix_telegram_bot.app import LyrixApp
+from lyrix_telegram_bot.aio import AsyncRuntime
+from lyrix_telegram_bot.app import LyrixApp, NOW_PLAYING_TTL
+from lyrix_telegram_bot.backend import LyrixBackend
 from telegram import (
     Update,
     InlineKeyboardMarkup,
@@ -23,7 +24,6 @@ from telegram import (
 from telegram.ext import (
     CallbackContext,
 )
-import swaglyrics.cli as sl
 
 from lyrix_telegram_bot.constants import (
     NO_LYRICS_ERROR,
@@ -34,22 +34,57 @@ from lyrix_telegram_bot.constants import (
     SCOPES,
     LOGIN_INTRO_MESSAGE,
 )
+from lyrix_telegram_bot.fanout import (
+    INLINE_DEADLINE,
+    TRACK_INFO_DEADLINE,
+    FanOut,
+    fan_out_async,
+)
 from lyrix_telegram_bot.fetch import (
+    LyrixSpotifyMetadata,
     share_song_for_user,
     get_lyrics_for_user,
     clear_playlist_from_spotify,
     share_playlist_from_spotify,
     play_song_with_spotify,
     _get_current_playing_song,
+    _get_current_playing_song_async,
+    get_lyrics_for_user_async,
     parse_spotify_data,
+    prefetch_lyrics,
+    share_song_for_user_async,
 )
+from lyrix_telegram_bot.lazy import lazy_import
 from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.markup import MESSAGE_LIMIT, sanitize, truncate_text
 from lyrix_telegram_bot.models.song import Song
 from lyrix_telegram_bot.models.user import LyrixUser
+from lyrix_telegram_bot.normalize import clean_artist
+from lyrix_telegram_bot.tokens import token_manager
+from lyrix_telegram_bot.tracing import PERCENTILES, command_stats
+
 
+spotipy = lazy_import("spotipy")
 
 CACHE_DIR = os.getenv("LYRIX_CACHE_DIR", ".cache")
 lyrix_id_match = re.compile(r"lyrix@\((.*)\)")
+# the answers are personal, so telegram only reuses them for the same user
+INLINE_CACHE_TIME = int(NOW_PLAYING_TTL)
+GENIUS_CREDIT = "\n\n<i>Lyrics provided by Genius</i>"
+# comma separated telegram ids of the users allowed to run /stats
+ADMIN_IDS = {
+    int(admin_id)
+    for admin_id in os.getenv("LYRIX_ADMIN_IDS", "").split(",")
+    if admin_id.strip()
+}
+
+
+def inline_result_id(*parts: str) -> str:
+    """
+    Inline results of the same track get the same id, so that telegram can
+    reuse them
+    """
+    return hashlib.md5("\x1f".join(parts).encode()).hexdigest()
 
 
 def get_username_and_homeserver(user_id: str) -> Tuple[str, str]:
@@ -59,14 +94,37 @@ def get_username_and_homeserver(user_id: str) -> Tuple[str, str]:
 LyrixMarkup = namedtuple("LyrixMarkup", "markup image_url")
 
 
+def local_song_reply_markup(song: Song) -> InlineKeyboardMarkup:
+    slug = f"{song.track} {song.artist}"
+    slug_encoded = urllib.parse.quote(slug)
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    text="▶️ YT Music",
+                    url=f"https://music.youtube.com/search?q={slug_encoded}",
+                ),
+                InlineKeyboardButton(
+                    text="▶️ Spotify",
+                    url=f"https://open.spotify.com/search/{slug_encoded}",
+                ),
+                InlineKeyboardButton(
+                    text="▶️ Soundcloud",
+                    url=f"https://soundcloud.com/search?q={slug_encoded}",
+                ),
+            ]
+        ]
+    )
+
+
 class CommandInterface:
     logger = make_logger("commands")
 
     def __init__(self, la: LyrixApp, prefix: str = "$lx"):
 
         self.la = la
-        self.la.load()
         self.command_prefix = prefix
+        self.fanout = FanOut()
 
     def ping_command(self, update: Update, _: CallbackContext) -> None:
         """Send a message when the command /ping is issued."""
@@ -108,7 +166,7 @@ class CommandInterface:
             update.message.reply_text("You haven't logged in yet 👀")
             return
         try:
-            song = Api.get_current_local_listening_song(user)
+            song = LyrixBackend.get_current_local_listening_song(user)
         except Exception as e:
             ctx.bot.send_message(
                 update.message.chat_id,
@@ -116,38 +174,49 @@ class CommandInterface:
             )
             return
 
-        ctx.bot.send_message(
-            update.message.chat_id,
-            f"Getting lyrics for <b>{song.track}</b> by <b>{song.artist}</b>",
-            parse_mode="html",
+        artist = clean_artist(song.artist)
+        fetched = self.fanout.run(
+            {
+                "intro": lambda: ctx.bot.send_message(
+                    update.message.chat_id,
+                    f"Getting lyrics for <b>{escape(song.track)}</b> "
+                    f"by <b>{escape(song.artist)}</b>",
+                    parse_mode="html",
+                ),
+                "lyrics": lambda: self.la.get_lyrics(song.track, artist),
+            }
         )
-
-        artist = (
-            sl.stripper("", song.artist.replace(" - Music", ""))
-            .rstrip("-")
-            .replace("-", " ")
-        )
-        lyrics = sl.get_lyrics(song.track, artist)
+        lyrics = fetched.get("lyrics")
 
         if lyrics is None or not lyrics:
             self.logger.warning(f"Couldn't get the lyrics for {song.track} by {artist}")
             ctx.bot.send_message(update.message.chat_id, NO_LYRICS_ERROR)
             return
 
-        ctx.bot.send_message(update.message.chat_id, lyrics)
+        ctx.bot.send_bulk_message(update.message.chat_id, truncate_text(lyrics))
 
     def share_local_song(self, update: Update, ctx: CallbackContext) -> None:
         """Share the information of the current listening song from local music player"""
-        msg = ctx.bot.send_message(
-            update.message.chat_id,
-            f"Getting {update.message.from_user.first_name}'s current playing song 🚀",
-        )
-
         self.logger.info(
             f"{update.message.from_user.first_name}({update.message.from_user.id})"
             f" issues local share song command"
         )
         user = self.la.get_user(update.message.from_user.id)
+
+        # the placeholder is sent while the song is fetched
+        calls = {
+            "msg": lambda: ctx.bot.send_message(
+                update.message.chat_id,
+                f"Getting {update.message.from_user.first_name}'s current playing song 🚀",
+            )
+        }
+        if user is not None:
+            calls["song"] = lambda: LyrixBackend.get_current_local_listening_song(user)
+        fetched = self.fanout.run(calls)
+        if "msg" in fetched.errors:
+            raise fetched.errors["msg"]
+        msg = fetched["msg"]
+
         if user is None:
             ctx.bot.edit_message_text(
                 chat_id=update.message.chat_id,
@@ -155,14 +224,13 @@ class CommandInterface:
                 text="You haven't logged in yet 👀",
             )
             return
-        try:
-            song = Api.get_current_local_listening_song(user)
-        except Exception as e:
+        if "song" in fetched.errors:
             ctx.bot.send_message(
                 update.message.chat_id,
-                f"🙅, I couldn't get your current listening song. Maybe you should log-in again? \n\nError: {e}",
+                f"🙅, I couldn't get your current listening song. Maybe you should log-in again? \n\nError: {fetched.errors['song']}",
             )
             return
+        song = fetched["song"]
 
         if not song.track or not song.artist:
             ctx.bot.edit_message_text(
@@ -173,45 +241,33 @@ class CommandInterface:
             return
 
         show_fact = bool(random.randint(0, 1))
+        track_info = self.fanout.run(
+            {"info": lambda: self.la.get_track_info(song, show_info=show_fact)},
+            deadline=TRACK_INFO_DEADLINE,
+        )
         html_parsed_message = self.get_current_playing_local_song_markup(
             song=song,
             from_user=update.message.from_user,
             show_fact=show_fact,
-        )
-        slug = f"{song.track} {song.artist}"
-        slug_encoded = urllib.parse.quote(slug)
-        reply_markup = InlineKeyboardMarkup(
-            [
-                [
-                    InlineKeyboardButton(
-                        text="▶️ YT Music",
-                        url=f"https://music.youtube.com/search?q={slug_encoded}",
-                    ),
-                    InlineKeyboardButton(
-                        text="▶️ Spotify",
-                        url=f"https://open.spotify.com/search/{slug_encoded}",
-                    ),
-                    InlineKeyboardButton(
-                        text="▶️ Soundcloud",
-                        url=f"https://soundcloud.com/search?q={slug_encoded}",
-                    ),
-                ]
-            ]
+            album_info=track_info.get("info", ("", "")),
         )
         ctx.bot.edit_message_text(
             chat_id=update.message.chat_id,
             message_id=msg.message_id,
             text=html_parsed_message.markup,
             parse_mode="html",
-            reply_markup=reply_markup,
+            reply_markup=local_song_reply_markup(song),
         )
 
     @staticmethod
     def show_telegram_id(update: Update, _: CallbackContext) -> None:
         update.message.reply_text(f"{update.message.from_user.id}")
 
-    def general_command(self, update: Update, ctx: CallbackContext) -> None:
-        """Echo the user message."""
+    def general_command(self, update: Update, ctx: CallbackContext) -> Optional[Future]:
+        """
+        Echo the user message. Returns what the command it runs returns, so
+        that the future of a scheduled command can be waited on.
+        """
         try:
             if not self.is_valid_command(update.message.text):
                 return
@@ -219,21 +275,18 @@ class CommandInterface:
             return
         commands = update.message.text.strip().split(" ")
         if len(commands) == 1:
-            get_lyrics_for_user(self.la, update.message, ctx)
-            return
+            return self.get_lyrics(update, ctx)
         if len(commands) == 2:
             args = commands[-1].strip()
             if args == "share":
-                share_song_for_user(self.la, update.message, ctx)
-                return
+                return self.share_song(update, ctx)
             elif args == "ping":
-                self.ping_command(update, ctx)
-                return
+                return self.ping_command(update, ctx)
             elif args == "local":
-                self.get_local_lyrics(update, ctx)
+                return self.get_local_lyrics(update, ctx)
         elif len(commands) == 3:
             if "local" in commands and "share" in commands:
-                self.share_local_song(update, ctx)
+                return self.share_local_song(update, ctx)
 
     def clear_playlist(self, update: Update, ctx: CallbackContext) -> None:
         clear_playlist_from_spotify(self.la, update.message, ctx)
@@ -253,7 +306,10 @@ class CommandInterface:
             return
         if spotify_token:
             pass
-        is_success = Api.send_spotify_token(user=user, spotify_token=spotify_token)
+        is_success = LyrixBackend.send_spotify_token(
+            user=user, spotify_token=spotify_token
+        )
+        token_manager.invalidate(user.telegram_user_id)
         update.message.reply_text(f"Spotify token updated?: {is_success}")
 
     def who_am_i(self, update: Update, _: CallbackContext) -> None:
@@ -262,12 +318,37 @@ class CommandInterface:
             update.message.reply_text("You haven't logged in yet 👀")
             return
         update.message.reply_text(
-            f"<b>User:</b> {user.username}\n"
-            f"<b>Homeserver:</b> {user.homeserver}\n"
+            f"<b>User:</b> {escape(str(user.username))}\n"
+            f"<b>Homeserver:</b> {escape(str(user.homeserver))}\n"
             f"<b>Telegram Id:</b> {user.telegram_user_id}",
             parse_mode="html",
         )
 
+    def stats(self, update: Update, _: CallbackContext) -> None:
+        """
+        The latency of every command over the stats window, for the admins
+        """
+        if update.message.from_user.id not in ADMIN_IDS:
+            return
+        summary = command_stats.summary()
+        if not summary:
+            update.message.reply_text("No commands handled yet 💤")
+            return
+        width = max(len(name) for name in summary)
+        columns = ["count", "errors"] + [f"p{p}" for p in PERCENTILES]
+        lines = [f"{'command':<{width}} " + " ".join(f"{c:>7}" for c in columns)]
+        for name, stats in summary.items():
+            values = [f"{stats['count']:>7}", f"{stats['errors']:>7}"] + [
+                f"{stats[f'p{p}'] * 1e3:>7.0f}" for p in PERCENTILES
+            ]
+            lines.append(f"{name:<{width}} " + " ".join(values))
+        table = escape("\n".join(lines))
+        update.message.reply_text(
+            f"<b>Latency (ms), last {command_stats.window / 60:g} min</b>\n"
+            f"<pre>{table}</pre>",
+            parse_mode="html",
+        )
+
     def lyrix(self, update: Update, _: CallbackContext) -> None:
         self.logger.info(
             f"{update.message.from_user.name} ({update.message.from_user.id}) requested lyrics for song {update.message.text}"
@@ -281,15 +362,25 @@ class CommandInterface:
                 "You should use {song} $by {artist} format to get the lyrics of a song"
             )
             return
-        msg = update.message.reply_text(
-            f"Fetching lyrics for the song {song[0]} by {song[1]} 🎸"
+        fetched = self.fanout.run(
+            {
+                "msg": lambda: update.message.reply_text(
+                    f"Fetching lyrics for the song {song[0]} by {song[1]} 🎸"
+                ),
+                "lyrics": lambda: self.la.get_lyrics(song[0], song[1]),
+            }
         )
-        lx = sl.get_lyrics(song[0], song[1])
+        if "msg" in fetched.errors:
+            raise fetched.errors["msg"]
+        msg = fetched["msg"]
+        lx = fetched.get("lyrics")
         if lx == "" or lx is None:
             msg.edit_text("Sorry, couldn't fetch the lyrics for that song 😭")
             return
         msg.edit_text(
-            lx + "\n\n<i>Lyrics provided by Genius</i>", parse_mode=ParseMode.HTML
+            escape(truncate_text(lx, MESSAGE_LIMIT - len(GENIUS_CREDIT)))
+            + GENIUS_CREDIT,
+            parse_mode=ParseMode.HTML,
         )
 
     def telegram_id(self, update: Update, _: CallbackContext) -> None:
@@ -423,8 +514,7 @@ class CommandInterface:
             ),
         )
 
-    @staticmethod
-    def connect_spotify(update: Update, _: CallbackContext) -> None:
+    def connect_spotify(self, update: Update, _: CallbackContext) -> None:
         """Gets the token of a user"""
         cache_path = os.path.join(CACHE_DIR, f"cache-{update.message.from_user.id}")
 
@@ -434,8 +524,14 @@ class CommandInterface:
                 os.remove(cache_path)
         except Exception:
             pass
+        token_manager.invalidate(update.message.from_user.id)
+        user = self.la.get_user(update.message.from_user.id)
+        if user is not None:
+            # the account being connected may not be the one the playlist
+            # was created on
+            self.la.forget_spotify_account(user)
 
-        handler = CacheFileHandler(
+        handler = spotipy.CacheFileHandler(
             username=str(update.message.from_user.id),
             cache_path=cache_path,
         )
@@ -446,7 +542,7 @@ class CommandInterface:
                     [
                         InlineKeyboardButton(
                             text="Authorize Spotify",
-                            url=SpotifyOAuth(
+                            url=spotipy.SpotifyOAuth(
                                 cache_handler=handler, scope=SCOPES
                             ).get_authorize_url(),
                         )
@@ -456,24 +552,31 @@ class CommandInterface:
         )
 
     def get_current_playing_local_song_markup(
-        self, song: Song, from_user, show_fact: bool
+        self, song: Song, from_user, show_fact: bool, album_info: Tuple[str, str] = None
     ) -> LyrixMarkup:
-        album_info = self.la.get_track_info(song, show_info=show_fact)
+        if album_info is None:
+            album_info = self.la.get_track_info(song, show_info=show_fact)
         album_art_info = ""
         if album_info[0]:
-            album_art_info = f"<a href='{album_info[0]}'>🎵</a>"
+            album_art_info = f"<a href='{escape(album_info[0])}'>🎵</a>"
 
         if album_info[1] and show_fact:
             album_art_info = f"{album_art_info}\n\n<b>Wiki 🧠</b>: {album_info[1]}"
 
         html_parsed_message = (
-            f"{from_user.first_name} is now playing \n"
-            f"<b>{song.track}</b>\nby <b>{song.artist}</b> {album_art_info}"
+            f"{escape(from_user.first_name)} is now playing \n"
+            f"<b>{escape(song.track)}</b>\nby <b>{escape(song.artist)}</b> "
+            f"{album_art_info}"
         )
         if song.source == "music.youtube.com":
             html_parsed_message += "\n"
-            html_parsed_message += f"On <a href='{song.url}'>Youtube Music</a>"
-        return LyrixMarkup(markup=html_parsed_message, image_url=album_info[0])
+            html_parsed_message += (
+                f"On <a href='{escape(song.url or '')}'>Youtube Music</a>"
+            )
+        # the wiki can make it longer than a message
+        return LyrixMarkup(
+            markup=sanitize(html_parsed_message), image_url=album_info[0]
+        )
 
     def inline_query(self, update: Update, _: CallbackContext) -> None:
         """Handle the inline query."""
@@ -490,75 +593,348 @@ class CommandInterface:
         )
 
         user = self.la.get_user(from_user.id)
-        results = []
         if not user:
             return
 
+        # the sources are fetched concurrently, and the query is answered with
+        # the ones that are ready by the deadline
+        calls = {}
         if "loc" in query:
-            self.logger.info(f"{from_user.first_name} triggered local song query")
-            try:
-                song = Api.get_current_local_listening_song(user)
-            except Exception as e:
-                return
-            if not song.track or not song.artist:
-                return
+            calls["loc"] = lambda: self._local_inline_result(user, from_user)
+        if "spot" in query:
+            calls["spot"] = lambda: self._spotify_inline_result(from_user)
+        answers = self.fanout.run(calls, deadline=INLINE_DEADLINE)
+
+        results = [answers[x] for x in ("loc", "spot") if answers.get(x) is not None]
+        if not results:
+            return
+        update.inline_query.answer(
+            results, cache_time=INLINE_CACHE_TIME, is_personal=True
+        )
+
+    def _local_inline_result(
+        self, user: LyrixUser, from_user
+    ) -> Optional[InlineQueryResultArticle]:
+        self.logger.info(f"{from_user.first_name} triggered local song query")
+        song = self.la.now_playing.get(
+            ("loc", from_user.id),
+            lambda: LyrixBackend.get_current_local_listening_song(user),
+        )
+        if not song.track or not song.artist:
+            return None
+        return self._local_song_article(
+            song, from_user, self.la.get_track_info(song, show_info=False)
+        )
 
-            show_fact = False
-            html_parsed_message = self.get_current_playing_local_song_markup(
-                song=song,
-                from_user=from_user,
-                show_fact=show_fact,
+    def _spotify_inline_result(self, from_user) -> Optional[InlineQueryResultArticle]:
+        song = self.la.now_playing.get(
+            ("spot", from_user.id),
+            lambda: _get_current_playing_song(self.la, from_user=from_user),
+        )
+        return self._spotify_article(song, from_user)
+
+    def _local_song_article(
+        self, song: Song, from_user, album_info: Tuple[str, str]
+    ) -> InlineQueryResultArticle:
+        html_parsed_message = self.get_current_playing_local_song_markup(
+            song=song,
+            from_user=from_user,
+            show_fact=False,
+            album_info=album_info,
+        )
+        return InlineQueryResultArticle(
+            id=inline_result_id("loc", song.track, song.artist),
+            thumb_url=html_parsed_message.image_url,
+            title=f"{song.track} by {song.artist}",
+            description="From your local player, powered by Lyrix",
+            input_message_content=InputTextMessageContent(
+                html_parsed_message.markup,
+                parse_mode=ParseMode.HTML,
+            ),
+        )
+
+    def _spotify_article(
+        self, song: LyrixSpotifyMetadata, from_user
+    ) -> Optional[InlineQueryResultArticle]:
+        if song.error_message:
+            return InlineQueryResultArticle(
+                id=inline_result_id("error", song.error_message),
+                title=f"🚧 {song.error_message}",
+                input_message_content=InputTextMessageContent(
+                    f"Couldn't get the song: {escape(song.error_message)}",
+                    parse_mode=ParseMode.HTML,
+                ),
             )
+        if not song.song or not song.song.track:
+            return None
+
+        thumb_url = song.track_info["item"]["album"].get("images", [{}])[0].get("url")
+        reply_text, inline_keyboard = parse_spotify_data(song=song, from_user=from_user)
+        prefetch_lyrics(self.la, song)
+        return InlineQueryResultArticle(
+            id=inline_result_id("spot", song.track_info["item"]["uri"]),
+            thumb_url=thumb_url,
+            title=f"{song.song.track} by {song.song.track}",
+            description="From your Spotify, powered by Lyrix.",
+            input_message_content=InputTextMessageContent(
+                message_text=reply_text,
+                reply_markup=inline_keyboard,
+                parse_mode=ParseMode.HTML,
+            ),
+        )
 
-            results.append(
-                InlineQueryResultArticle(
-                    id=str(uuid4()),
-                    thumb_url=html_parsed_message.image_url,
-                    title=f"{song.track} by {song.artist}",
-                    description="From your local player, powered by Lyrix",
-                    input_message_content=InputTextMessageContent(
-                        html_parsed_message.markup,
-                        parse_mode=ParseMode.HTML,
-                    ),
-                )
+
+class AsyncCommandInterface(CommandInterface):
+    """
+    Runs the network heavy commands as coroutines on an AsyncRuntime, and the
+    instant ones like CommandInterface does. Selected with LYRIX_RUNTIME=asyncio.
+    """
+
+    def __init__(self, la: LyrixApp, rt: AsyncRuntime, prefix: str = "$lx"):
+        super().__init__(la, prefix=prefix)
+        self.rt = rt
+
+    def get_lyrics(self, update: Update, ctx: CallbackContext) -> Future:
+        return self.rt.submit(
+            get_lyrics_for_user_async(self.la, self.rt, update.message, ctx)
+        )
+
+    def share_song(self, update: Update, ctx: CallbackContext) -> Future:
+        return self.rt.submit(
+            share_song_for_user_async(self.la, self.rt, update.message, ctx)
+        )
+
+    def get_local_lyrics(self, update: Update, ctx: CallbackContext) -> Future:
+        return self.rt.submit(self._get_local_lyrics(update, ctx))
+
+    def share_local_song(self, update: Update, ctx: CallbackContext) -> Future:
+        return self.rt.submit(self._share_local_song(update, ctx))
+
+    def lyrix(self, update: Update, ctx: CallbackContext) -> Future:
+        return self.rt.submit(self._lyrix(update, ctx))
+
+    def inline_query(self, update: Update, ctx: CallbackContext) -> Future:
+        return self.rt.submit(self._inline_query(update, ctx))
+
+    async def _get_local_lyrics(self, update: Update, ctx: CallbackContext) -> None:
+        self.logger.info(
+            f"{update.message.from_user.first_name}({update.message.from_user.id}) "
+            f"issues local lyrics song command"
+        )
+        user = self.la.get_user(telegram_id=update.message.from_user.id)
+        if user is None:
+            await self.rt.run_blocking(
+                update.message.reply_text, "You haven't logged in yet 👀"
+            )
+            return
+        try:
+            song = await LyrixBackend.get_current_local_listening_song_async(
+                self.rt, user
+            )
+        except Exception as e:
+            await self.rt.run_blocking(
+                ctx.bot.send_message,
+                update.message.chat_id,
+                f"🙅, I couldn't get your current listening song. Maybe you should log-in again? \n\nError: {e}",
             )
+            return
 
-        if "spot" in query:
-            song = _get_current_playing_song(self.la, from_user=from_user)
-            if song.error_message:
-                results.append(
-                    InlineQueryResultArticle(
-                        id=str(uuid4()),
-                        title=f"🚧 {song.error_message}",
-                        input_message_content=InputTextMessageContent(
-                            f"Couldn't get the song: {song.error_message}",
-                            parse_mode=ParseMode.HTML,
-                        ),
-                    )
-                )
-                update.inline_query.answer(results)
-                return
-            if not song.song or not song.song.track:
-                return
+        artist = clean_artist(song.artist)
+        fetched = await fan_out_async(
+            {
+                "intro": lambda: self.rt.run_blocking(
+                    ctx.bot.send_message,
+                    update.message.chat_id,
+                    f"Getting lyrics for <b>{escape(song.track)}</b> "
+                    f"by <b>{escape(song.artist)}</b>",
+                    parse_mode="html",
+                ),
+                "lyrics": lambda: self.rt.run_blocking(
+                    self.la.get_lyrics, song.track, artist
+                ),
+            }
+        )
+        lyrics = fetched.get("lyrics")
+
+        if lyrics is None or not lyrics:
+            self.logger.warning(f"Couldn't get the lyrics for {song.track} by {artist}")
+            await self.rt.run_blocking(
+                ctx.bot.send_message, update.message.chat_id, NO_LYRICS_ERROR
+            )
+            return
+
+        await self.rt.run_blocking(
+            ctx.bot.send_bulk_message, update.message.chat_id, truncate_text(lyrics)
+        )
+
+    async def _share_local_song(self, update: Update, ctx: CallbackContext) -> None:
+        self.logger.info(
+            f"{update.message.from_user.first_name}({update.message.from_user.id})"
+            f" issues local share song command"
+        )
+        user = self.la.get_user(update.message.from_user.id)
+
+        calls = {
+            "msg": lambda: self.rt.run_blocking(
+                ctx.bot.send_message,
+                update.message.chat_id,
+                f"Getting {update.message.from_user.first_name}'s current playing song 🚀",
+            )
+        }
+        if user is not None:
+            calls["song"] = lambda: LyrixBackend.get_current_local_listening_song_async(
+                self.rt, user
+            )
+        fetched = await fan_out_async(calls)
+        if "msg" in fetched.errors:
+            raise fetched.errors["msg"]
+        msg = fetched["msg"]
 
-            thumb_url = (
-                song.track_info["item"]["album"].get("images", [{}])[0].get("url")
+        if user is None:
+            await self.rt.run_blocking(
+                ctx.bot.edit_message_text,
+                chat_id=update.message.chat_id,
+                message_id=msg.message_id,
+                text="You haven't logged in yet 👀",
             )
-            reply_text, inline_keyboard = parse_spotify_data(
-                song=song, from_user=from_user
+            return
+        if "song" in fetched.errors:
+            await self.rt.run_blocking(
+                ctx.bot.send_message,
+                update.message.chat_id,
+                f"🙅, I couldn't get your current listening song. Maybe you should log-in again? \n\nError: {fetched.errors['song']}",
             )
-            results.append(
-                InlineQueryResultArticle(
-                    id=str(uuid4()),
-                    thumb_url=thumb_url,
-                    title=f"{song.song.track} by {song.song.track}",
-                    description="From your Spotify, powered by Lyrix.",
-                    input_message_content=InputTextMessageContent(
-                        message_text=reply_text,
-                        reply_markup=inline_keyboard,
-                        parse_mode=ParseMode.HTML,
-                    ),
+            return
+        song = fetched["song"]
+
+        if not song.track or not song.artist:
+            await self.rt.run_blocking(
+                ctx.bot.edit_message_text,
+                chat_id=update.message.chat_id,
+                message_id=msg.message_id,
+                text=f"{update.message.from_user.first_name} is not playing any local song",
+            )
+            return
+
+        show_fact = bool(random.randint(0, 1))
+        track_info = await fan_out_async(
+            {
+                "info": lambda: self.la.get_track_info_async(
+                    self.rt, song, show_info=show_fact
                 )
+            },
+            deadline=TRACK_INFO_DEADLINE,
+        )
+        html_parsed_message = self.get_current_playing_local_song_markup(
+            song=song,
+            from_user=update.message.from_user,
+            show_fact=show_fact,
+            album_info=track_info.get("info", ("", "")),
+        )
+        await self.rt.run_blocking(
+            ctx.bot.edit_message_text,
+            chat_id=update.message.chat_id,
+            message_id=msg.message_id,
+            text=html_parsed_message.markup,
+            parse_mode="html",
+            reply_markup=local_song_reply_markup(song),
+        )
+
+    async def _lyrix(self, update: Update, _: CallbackContext) -> None:
+        self.logger.info(
+            f"{update.message.from_user.name} ({update.message.from_user.id}) requested lyrics for song {update.message.text}"
+        )
+
+        song = [
+            x.strip() for x in update.message.text.replace("/lyrix", "").split("$by")
+        ]
+        if len(song) != 2:
+            await self.rt.run_blocking(
+                update.message.reply_text,
+                "You should use {song} $by {artist} format to get the lyrics of a song",
+            )
+            return
+        fetched = await fan_out_async(
+            {
+                "msg": lambda: self.rt.run_blocking(
+                    update.message.reply_text,
+                    f"Fetching lyrics for the song {song[0]} by {song[1]} 🎸",
+                ),
+                "lyrics": lambda: self.rt.run_blocking(
+                    self.la.get_lyrics, song[0], song[1]
+                ),
+            }
+        )
+        if "msg" in fetched.errors:
+            raise fetched.errors["msg"]
+        msg = fetched["msg"]
+        lx = fetched.get("lyrics")
+        if lx == "" or lx is None:
+            await self.rt.run_blocking(
+                msg.edit_text, "Sorry, couldn't fetch the lyrics for that song 😭"
             )
+            return
+        await self.rt.run_blocking(
+            msg.edit_text,
+            escape(truncate_text(lx, MESSAGE_LIMIT - len(GENIUS_CREDIT)))
+            + GENIUS_CREDIT,
+            parse_mode=ParseMode.HTML,
+        )
 
-        update.inline_query.answer(results, cache_time=1)
+    async def _inline_query(self, update: Update, _: CallbackContext) -> None:
+        query = update.inline_query.query
+        from_user = update.inline_query.from_user
+
+        if query == "":
+            return
+
+        if "loc" not in query and "spot" not in query:
+            return
+        self.logger.info(
+            f"{update.inline_query.from_user.first_name} triggered inline query with {query}"
+        )
+
+        user = self.la.get_user(from_user.id)
+        if not user:
+            return
+
+        calls = {}
+        if "loc" in query:
+            calls["loc"] = lambda: self._local_inline_result_async(user, from_user)
+        if "spot" in query:
+            calls["spot"] = lambda: self._spotify_inline_result_async(from_user)
+        answers = await fan_out_async(calls, deadline=INLINE_DEADLINE)
+
+        results = [answers[x] for x in ("loc", "spot") if answers.get(x) is not None]
+        if not results:
+            return
+        await self.rt.run_blocking(
+            update.inline_query.answer,
+            results,
+            cache_time=INLINE_CACHE_TIME,
+            is_personal=True,
+        )
+
+    async def _local_inline_result_async(
+        self, user: LyrixUser, from_user
+    ) -> Optional[InlineQueryResultArticle]:
+        self.logger.info(f"{from_user.first_name} triggered local song query")
+        song = await self.la.now_playing.get_async(
+            ("loc", from_user.id),
+            lambda: LyrixBackend.get_current_local_listening_song_async(self.rt, user),
+        )
+        if not song.track or not song.artist:
+            return None
+        album_info = await self.la.get_track_info_async(self.rt, song, show_info=False)
+        return self._local_song_article(song, from_user, album_info)
+
+    async def _spotify_inline_result_async(
+        self, from_user
+    ) -> Optional[InlineQueryResultArticle]:
+        song = await self.la.now_playing.get_async(
+            ("spot", from_user.id),
+            lambda: _get_current_playing_song_async(
+                self.la, self.rt, from_user=from_user
+            ),
+        )
+        return self._spotify_article(song, from_user)
@@ -0,0 +1,92 @@
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Dict, List
+
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.transport import set_deadline
+
+FANOUT_WORKERS = int(os.getenv("LYRIX_FANOUT_WORKERS", "32"))
+# inline queries are answered with whatever is ready by then
+INLINE_DEADLINE = float(os.getenv("LYRIX_INLINE_DEADLINE", "5"))
+# shares are sent without the album art and wiki if Last.fm is slower
+TRACK_INFO_DEADLINE = float(os.getenv("LYRIX_TRACK_INFO_DEADLINE", "3"))
+
+logger = make_logger("fanout")
+
+
+class FanOutResult(dict):
+    """
+    The values of the calls that completed in time, by name. The calls that
+    raised are in ``errors``, and the ones that missed the deadline in
+    ``timed_out``.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.errors: Dict[str, Exception] = {}
+        self.timed_out: List[str] = []
+
+
+class FanOut:
+    """
+    Runs independent upstream calls concurrently, under a shared deadline.
+    A thread cannot be stopped, so the requests a call makes through the
+    transport are cut short at the deadline instead, and a call that missed
+    it gives its worker back soon after.
+    """
+
+    def __init__(self, max_workers: int = FANOUT_WORKERS):
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="lyrix-fanout"
+        )
+
+    def run(
+        self, calls: Dict[str, Callable[[], Any]], deadline: float = None
+    ) -> FanOutResult:
+        futures = {}
+        for name, func in calls.items():
+            # the calls are traced as part of the update that made them
+            context = contextvars.copy_context()
+            if deadline is not None:
+                context.run(set_deadline, time.monotonic() + deadline)
+            futures[self._executor.submit(context.run, func)] = name
+        done, pending = wait(futures, timeout=deadline)
+        result = FanOutResult()
+        for future in done:
+            _collect(result, futures[future], future)
+        for future in pending:
+            # a call that started keeps running until its requests time out,
+            # but nobody waits for it anymore
+            future.cancel()
+            result.timed_out.append(futures[future])
+            logger.warning(f"{futures[future]} missed the {deadline}s deadline")
+        return result
+
+
+async def fan_out_async(
+    calls: Dict[str, Callable[[], Awaitable]], deadline: float = None
+) -> FanOutResult:
+    """
+    FanOut.run for coroutines
+    """
+    tasks = {asyncio.ensure_future(func()): name for name, func in calls.items()}
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    result = FanOutResult()
+    for task in done:
+        _collect(result, tasks[task], task)
+    for task in pending:
+        task.cancel()
+        result.timed_out.append(tasks[task])
+        logger.warning(f"{tasks[task]} missed the {deadline}s deadline")
+    return result
+
+
+def _collect(result: FanOutResult, name: str, future) -> None:
+    try:
+        result[name] = future.result()
+    except Exception as e:
+        logger.info(f"{name} failed: {e}")
+        result.errors[name] = e
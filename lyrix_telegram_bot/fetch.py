@@ -1,20 +1,30 @@
+import functools
+from concurrent.futures import Future
 from html import escape
 from typing import Tuple, Optional, Union
 
-import spotipy
 import telegram
 import urllib.parse
 
-from swaglyrics.cli import get_lyrics
 from telegram import Message, InlineKeyboardMarkup, InlineKeyboardButton, User
 from telegram.ext import CallbackContext
 
+from lyrix_telegram_bot.aio import AsyncRuntime
 from lyrix_telegram_bot.app import LyrixApp
+from lyrix_telegram_bot.lazy import lazy_import
 from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.markup import truncate_text
 from lyrix_telegram_bot.models.song import Song
+from lyrix_telegram_bot.singleflight import AsyncSingleFlight, SingleFlight
+from lyrix_telegram_bot.tokens import SPOTIFY_API_URL, spotify_client, token_manager
+
+spotipy = lazy_import("spotipy")
 
 logger = make_logger("core")
 
+_now_playing_flight = SingleFlight()
+_now_playing_async_flight = AsyncSingleFlight()
+
 
 class LyrixSpotifyMetadata:
     def __init__(
@@ -50,7 +60,7 @@ def add_song_to_playlist(la: LyrixApp, message: Message, ctx: CallbackContext) -
         f"{message.from_user.last_name} with id {message.from_user.id}"
     )
     try:
-        sp = spotipy.Spotify(auth=user.get_access_token())
+        sp = spotify_client(user.get_access_token())
         sp.start_playback(context_uri=spotify_track_uri)
         ctx.bot.send_message(message.chat_id, "🚀 Ok oki. 😌👍")
         return
@@ -67,6 +77,16 @@ def add_song_to_playlist(la: LyrixApp, message: Message, ctx: CallbackContext) -
 def _get_current_playing_song(
     la: LyrixApp,
     from_user: User,
+) -> Optional[LyrixSpotifyMetadata]:
+    # concurrent commands of the same user share one spotify lookup
+    return _now_playing_flight.do(
+        from_user.id, _fetch_current_playing_song, la, from_user
+    )
+
+
+def _fetch_current_playing_song(
+    la: LyrixApp,
+    from_user: User,
 ) -> Optional[LyrixSpotifyMetadata]:
     user = la.get_spotify_user_from_telegram_user(from_user.id)
 
@@ -80,14 +100,19 @@ def _get_current_playing_song(
         return LyrixSpotifyMetadata(
             error_message=f"🙅, I couldn't authenticate with Spotify. {e}",
         )
-    sp = spotipy.Spotify(auth=spotify_auth_token)
+    sp = spotify_client(spotify_auth_token)
     logger.info(
         f"{from_user.first_name}({from_user.id}) " f"Authenticated with Spotify"
     )
 
     logger.info("Getting currently playing track on spotify")
     track = sp.current_user_playing_track()
+    return _parse_current_playing(track, from_user)
+
 
+def _parse_current_playing(
+    track: Optional[dict], from_user: User
+) -> LyrixSpotifyMetadata:
     if track is None or not track["is_playing"]:
         logger.info(f"{from_user.first_name} is not playing anything on Spotify.")
         return LyrixSpotifyMetadata(
@@ -115,8 +140,8 @@ def parse_spotify_data(song: LyrixSpotifyMetadata, from_user: User):
 
     try:
         url = song.track_info["item"]["external_urls"]["spotify"]
-        right_now = f"""{from_user.first_name} is currently playing 
-<a href='{url}'><b>{escape(song.song.track)}</b> by {artist_names_str}</a>
+        right_now = f"""{escape(from_user.first_name)} is currently playing 
+<a href='{escape(url)}'><b>{escape(song.song.track)}</b> by {artist_names_str}</a>
 
 <i>lyrix@({track_id})</i>"""
 
@@ -150,12 +175,21 @@ def parse_spotify_data(song: LyrixSpotifyMetadata, from_user: User):
     except Exception:
         reply_markup = None
         right_now = (
-            f"{from_user.first_name} is currently playing "
+            f"{escape(from_user.first_name)} is currently playing "
             f"{escape(song.song.track)} by {artist_names_str}"
         )
     return right_now, reply_markup
 
 
+def prefetch_lyrics(la: LyrixApp, song: LyrixSpotifyMetadata) -> None:
+    """
+    Starts scraping the lyrics of a song that is being shared, since its card
+    is usually followed by requests for them
+    """
+    if song.song and song.song.track and song.song.artist:
+        la.prefetcher.submit(song.song.track, song.song.artist[0])
+
+
 def share_song_for_user(la: LyrixApp, message: Message, ctx: CallbackContext) -> None:
     logger.info(
         f"{message.from_user.first_name}({message.from_user.id}) "
@@ -174,6 +208,7 @@ def share_song_for_user(la: LyrixApp, message: Message, ctx: CallbackContext) ->
     right_now, reply_markup = parse_spotify_data(
         from_user=message.from_user, song=currently_playing
     )
+    prefetch_lyrics(la, currently_playing)
     ctx.bot.send_message(
         message.chat_id,
         right_now,
@@ -183,6 +218,19 @@ def share_song_for_user(la: LyrixApp, message: Message, ctx: CallbackContext) ->
     return
 
 
+def _lyrics_intro(spot_song: LyrixSpotifyMetadata) -> str:
+    song = spot_song.song
+    artist_names_str = escape(", ".join(song.artist))
+    try:
+        url = spot_song.track_info["item"]["external_urls"]["spotify"]
+        return (
+            f"Getting lyrics for <a href='{escape(url)}'>"
+            f"{escape(song.track)} by {artist_names_str}</a>"
+        )
+    except Exception:
+        return f"Getting lyrics for {escape(song.track)} by {artist_names_str}"
+
+
 def get_lyrics_for_user(la: LyrixApp, message: Message, ctx: CallbackContext) -> None:
     logger.info(
         f"{message.from_user.first_name}({message.from_user.id}) "
@@ -197,30 +245,22 @@ def get_lyrics_for_user(la: LyrixApp, message: Message, ctx: CallbackContext) ->
     if not spot_song.song.track:
         return
 
-    track = spot_song.track_info
     song = spot_song.song
+    ctx.bot.send_message(
+        message.chat_id,
+        _lyrics_intro(spot_song),
+        parse_mode=telegram.ParseMode.HTML,
+    )
 
-    artist_names_str = escape(", ".join(song.artist))
-
-    try:
-        url = track["item"]["external_urls"]["spotify"]
-        right_now = (
-            f"Getting lyrics for <a href='{url}'>{song.track} by {artist_names_str}</a>"
-        )
-    except Exception:
-        right_now = f"Getting lyrics for {song.track} by {artist_names_str}"
-
-    ctx.bot.send_message(message.chat_id, right_now, parse_mode=telegram.ParseMode.HTML)
-
-    logger.debug(f"Trying to get the lyrics for {song.track} by {artist_names_str}")
-    lyrics = get_lyrics(song.track, song.artist[0])
+    logger.debug(f"Trying to get the lyrics for {song.track} by {song.artist[0]}")
+    lyrics = la.get_lyrics(song.track, song.artist[0])
 
     if lyrics is None or not lyrics:
         logger.warn(f"Couldn't get the lyrics for {song.track} by {song.artist[0]}")
         ctx.bot.send_message(message.chat_id, "Couldn't find the lyrics. 😔😔😔")
         return
 
-    ctx.bot.send_message(message.chat_id, lyrics)
+    ctx.bot.send_bulk_message(message.chat_id, truncate_text(lyrics))
     logger.info("Lyrics sent successfully.")
 
 
@@ -237,7 +277,7 @@ def play_song_with_spotify(
         return
 
     try:
-        sp = spotipy.Spotify(auth=user.get_access_token())
+        user.get_access_token()
     except spotipy.oauth2.SpotifyOauthError as e:
         ctx.bot.send_message(
             message.chat_id,
@@ -247,43 +287,30 @@ def play_song_with_spotify(
 
     logger.info(
         f"{message.from_user.first_name}({message.from_user.id}) "
-        f"Authenticated with Spotify"
+        f"Attempting to add to playlist {song}"
+    )
+    # the songs are written in batches, the requester is answered once the
+    # batch with their song is written
+    la.playlists.add(user, song).add_done_callback(
+        functools.partial(_confirm_playlist_add, message, song)
     )
 
-    if user.playlist_id is None:
-        logger.info(
-            f"{message.from_user.first_name}({message.from_user.id}) "
-            f"Attempting to create playlist"
-        )
-        playlist = sp.user_playlist_create(
-            sp.me()["id"],
-            "lyrix 🎧",
-            public=False,
-            collaborative=False,
-            description="Lyrix song queue",
-        )
-        user.set_user_playlist_queue(playlist["id"])
-        logger.info(
-            f"{message.from_user.first_name}({message.from_user.id}) "
-            f"Readding the user with the new playlist"
-        )
-        la.add_user(user)
-        logger.info(
+
+def _confirm_playlist_add(message: Message, song: str, added: Future) -> None:
+    try:
+        is_new = added.result()
+    except Exception as e:
+        logger.warning(
             f"{message.from_user.first_name}({message.from_user.id}) "
-            f"Playlist creation successful. Created with id {user.playlist_id}"
+            f"Couldn't add {song} to the playlist: {e}"
         )
-
-    logger.info(
-        f"{message.from_user.first_name}({message.from_user.id}) "
-        f"Attempting to add to playlist {song}"
-    )
-    sp.playlist_add_items(user.playlist_id, [song])
+        message.reply_text(f"🙅, I couldn't add the song to your playlist. {e}")
+        return
     logger.info(
         f"{message.from_user.first_name}({message.from_user.id}) "
-        f"Added {song} to playlist {user.playlist_id}"
+        f"Added {song} to the playlist"
     )
-
-    message.reply_text("Added to queue 👌")
+    message.reply_text("Added to queue 👌" if is_new else "Already in the queue 👌")
 
 
 def clear_playlist_from_spotify(
@@ -299,7 +326,7 @@ def clear_playlist_from_spotify(
         return
 
     try:
-        sp = spotipy.Spotify(auth=user.get_access_token())
+        sp = spotify_client(user.get_access_token())
         logger.info(
             f"{message.from_user.first_name}({message.from_user.id}) "
             f"Authenticated with Spotify"
@@ -311,37 +338,16 @@ def clear_playlist_from_spotify(
         )
         return
 
-    if user.playlist_id is None:
-        logger.info(
-            f"{message.from_user.first_name}({message.from_user.id}) "
-            f"Attempting to create playlist"
-        )
-        playlist = sp.user_playlist_create(
-            sp.me()["id"],
-            "lyrix 🎧",
-            public=False,
-            collaborative=False,
-            description="Lyrix song queue",
-        )
-        user.set_user_playlist_queue(playlist["id"])
-        logger.info(
-            f"{message.from_user.first_name}({message.from_user.id}) "
-            f"Readding the user with the new playlist"
-        )
-        la.add_user(user)
-        logger.info(
-            f"{message.from_user.first_name}({message.from_user.id}) "
-            f"Playlist creation successful. Created with id {user.playlist_id}"
-        )
+    playlist_id = la.get_playlist_id(user, sp)
 
     logger.info(
         f"{message.from_user.first_name}({message.from_user.id}) "
-        f"Attempting to clear playlist {user.playlist_id}"
+        f"Attempting to clear playlist {playlist_id}"
     )
-    sp.playlist_replace_items(user.playlist_id, [])
+    la.playlists.clear(user, sp, playlist_id)
     logger.info(
         f"{message.from_user.first_name}({message.from_user.id}) "
-        f"Cleared playlist {user.playlist_id}"
+        f"Cleared playlist {playlist_id}"
     )
 
     message.reply_text("Cleared queue 🗑")
@@ -361,7 +367,7 @@ def share_playlist_from_spotify(
 
     if user.playlist_id is None:
         try:
-            sp = spotipy.Spotify(auth=user.get_access_token())
+            sp = spotify_client(user.get_access_token())
         except spotipy.oauth2.SpotifyOauthError as e:
             ctx.bot.send_message(
                 message.chat_id,
@@ -372,29 +378,115 @@ def share_playlist_from_spotify(
             f"{message.from_user.first_name}({message.from_user.id}) "
             f"Authenticated with Spotify"
         )
-        logger.info(
-            f"{message.from_user.first_name}({message.from_user.id}) "
-            f"Attempting to create playlist"
+        la.get_playlist_id(user, sp)
+
+    message.reply_text(
+        f"{message.from_user.first_name}'s playlist: "
+        f"https://open.spotify.com/playlist/{user.playlist_id}"
+    )
+
+
+async def _get_current_playing_song_async(
+    la: LyrixApp, rt: AsyncRuntime, from_user: User
+) -> LyrixSpotifyMetadata:
+    return await _now_playing_async_flight.do(
+        from_user.id, _fetch_current_playing_song_async, la, rt, from_user
+    )
+
+
+async def _fetch_current_playing_song_async(
+    la: LyrixApp, rt: AsyncRuntime, from_user: User
+) -> LyrixSpotifyMetadata:
+    user = la.get_spotify_user_from_telegram_user(from_user.id)
+
+    if user is None:
+        return LyrixSpotifyMetadata(
+            error_message="😔, I couldn't find you in my database. Have you registered yet?"
         )
-        playlist = sp.user_playlist_create(
-            sp.me()["id"],
-            "lyrix 🎧",
-            public=False,
-            collaborative=False,
-            description="Lyrix song queue",
+    try:
+        spotify_auth_token = token_manager.get_cached_access_token(
+            user
+        ) or await rt.run_blocking(user.get_access_token)
+    except spotipy.oauth2.SpotifyOauthError as e:
+        return LyrixSpotifyMetadata(
+            error_message=f"🙅, I couldn't authenticate with Spotify. {e}",
         )
-        user.set_user_playlist_queue(playlist["id"])
-        logger.info(
-            f"{message.from_user.first_name}({message.from_user.id}) "
-            f"Readding the user with the new playlist"
+
+    logger.info("Getting currently playing track on spotify")
+    track = await rt.fetch_json(
+        f"{SPOTIFY_API_URL}me/player/currently-playing",
+        headers={"Authorization": f"Bearer {spotify_auth_token}"},
+    )
+    return _parse_current_playing(track, from_user)
+
+
+async def share_song_for_user_async(
+    la: LyrixApp, rt: AsyncRuntime, message: Message, ctx: CallbackContext
+) -> None:
+    logger.info(
+        f"{message.from_user.first_name}({message.from_user.id}) "
+        f"requested to share the currently playing song."
+    )
+
+    currently_playing = await _get_current_playing_song_async(
+        la, rt, from_user=message.from_user
+    )
+    if currently_playing.error_message:
+        await rt.run_blocking(
+            ctx.bot.send_message, message.chat_id, currently_playing.error_message
         )
-        la.add_user(user)
-        logger.info(
-            f"{message.from_user.first_name}({message.from_user.id}) "
-            f"Playlist creation successful. Created with id {user.playlist_id}"
+        return
+    if not currently_playing.song or not currently_playing.song.track:
+        return
+
+    right_now, reply_markup = parse_spotify_data(
+        from_user=message.from_user, song=currently_playing
+    )
+    prefetch_lyrics(la, currently_playing)
+    await rt.run_blocking(
+        ctx.bot.send_message,
+        message.chat_id,
+        right_now,
+        parse_mode=telegram.ParseMode.HTML,
+        reply_markup=reply_markup,
+    )
+
+
+async def get_lyrics_for_user_async(
+    la: LyrixApp, rt: AsyncRuntime, message: Message, ctx: CallbackContext
+) -> None:
+    logger.info(
+        f"{message.from_user.first_name}({message.from_user.id}) "
+        f"requested for lyrics of the currently playing song."
+    )
+
+    spot_song = await _get_current_playing_song_async(
+        la, rt, from_user=message.from_user
+    )
+    if spot_song.error_message:
+        await rt.run_blocking(
+            ctx.bot.send_message, message.chat_id, spot_song.error_message
         )
+    if not spot_song.song or not spot_song.song.track:
+        return
 
-    message.reply_text(
-        f"{message.from_user.first_name}'s playlist: "
-        f"https://open.spotify.com/playlist/{user.playlist_id}"
+    song = spot_song.song
+    await rt.run_blocking(
+        ctx.bot.send_message,
+        message.chat_id,
+        _lyrics_intro(spot_song),
+        parse_mode=telegram.ParseMode.HTML,
+    )
+
+    lyrics = await rt.run_blocking(la.get_lyrics, song.track, song.artist[0])
+    if lyrics is None or not lyrics:
+        logger.warning(f"Couldn't get the lyrics for {song.track} by {song.artist[0]}")
+        await rt.run_blocking(
+            ctx.bot.send_message, message.chat_id, "Couldn't find the lyrics. 😔😔😔"
+        )
+        return
+
+    await rt.run_blocking(
+        ctx.bot.send_bulk_message, message.chat_id, truncate_text(lyrics)
     )
+    logger.info("Lyrics sent successfully.")
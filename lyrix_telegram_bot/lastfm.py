@@ -0,0 +1,145 @@
+import json
+import os
+from typing import Optional, Tuple
+
+import requests
+from tornado.httpclient import HTTPClientError
+
+from lyrix_telegram_bot.cache import TTLCache
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.markup import sanitize
+from lyrix_telegram_bot.metrics import register_upstream
+from lyrix_telegram_bot.normalize import track_info_key
+from lyrix_telegram_bot.tracing import span
+from lyrix_telegram_bot.transport import transport
+
+LAST_FM_API_URL = os.getenv(
+    "LYRIX_LAST_FM_API_URL", "https://ws.audioscrobbler.com/2.0/"
+)
+LAST_FM_CACHE_SIZE = int(os.getenv("LYRIX_LAST_FM_CACHE_SIZE", "2048"))
+LAST_FM_CACHE_TTL = float(os.getenv("LYRIX_LAST_FM_CACHE_TTL", str(24 * 3600)))
+# how long a track Last.fm does not know is remembered. The other errors,
+# like the rate limit, are not cached at all.
+LAST_FM_NOT_FOUND_TTL = float(os.getenv("LYRIX_LAST_FM_NOT_FOUND_TTL", "3600"))
+
+# the error code of track.getInfo for a track Last.fm does not know
+TRACK_NOT_FOUND = 6
+
+register_upstream(LAST_FM_API_URL, "lastfm")
+
+
+class LastFmClient:
+    """
+    Last.fm track.getInfo client over the shared keep-alive transport. The
+    parsed album art and wiki of a track are cached, so that repeated shares
+    of the same song do not hit Last.fm again. Only the answers with the
+    track are cached for the whole TTL, and the tracks Last.fm does not know
+    for a shorter one; the other errors are tried again on the next share.
+    """
+
+    logger = make_logger("lastfm")
+
+    def __init__(
+        self,
+        api_key: str = None,
+        session: requests.Session = None,
+        maxsize: int = LAST_FM_CACHE_SIZE,
+        ttl: float = LAST_FM_CACHE_TTL,
+        not_found_ttl: float = LAST_FM_NOT_FOUND_TTL,
+    ):
+        self.api_key = api_key or os.getenv("LAST_FM_API_KEY")
+        self.not_found_ttl = not_found_ttl
+        self.session = session or transport.session
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get_track_info(self, artist: str, track: str) -> Tuple[str, str]:
+        """
+        Returns the album art url and the wiki summary of the track. The
+        artist is expected to be cleaned already.
+        """
+        key = track_info_key(artist, track)
+        cached = self._cached(key)
+        if cached is not None:
+            self.logger.debug(f"Using cached track information for {track}")
+            return cached
+
+        self.logger.info("Requesting Track information from Last.fm api")
+        response = self.session.get(LAST_FM_API_URL, params=self._params(artist, track))
+        return self._store(key, response.status_code, _parse(response.content))
+
+    async def get_track_info_async(
+        self, rt, artist: str, track: str
+    ) -> Tuple[str, str]:
+        """
+        Same as get_track_info, on an AsyncRuntime
+        """
+        key = track_info_key(artist, track)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
+        self.logger.info("Requesting Track information from Last.fm api")
+        try:
+            info = await rt.fetch_json(
+                LAST_FM_API_URL, params=self._params(artist, track)
+            )
+        except HTTPClientError as e:
+            body = e.response.body if e.response is not None else b""
+            return self._store(key, e.code, _parse(body))
+        return self._store(key, 200, info if isinstance(info, dict) else {})
+
+    def _cached(self, key: Tuple[str, str]) -> Optional[Tuple[str, str]]:
+        with span("cache.lastfm") as current:
+            cached = self.cache.get(key)
+            if current is not None:
+                current.attrs["result"] = "miss" if cached is None else "hit"
+        return cached
+
+    def _params(self, artist: str, track: str) -> dict:
+        return {
+            "method": "track.getInfo",
+            "api_key": self.api_key,
+            "artist": artist,
+            "track": track,
+            "autocorrect": 1,
+            "format": "json",
+        }
+
+    def _store(self, key: Tuple[str, str], status: int, info: dict) -> Tuple[str, str]:
+        if 200 <= status < 300 and "track" in info:
+            ttl = None
+        elif info.get("error") == TRACK_NOT_FOUND:
+            ttl = self.not_found_ttl
+        else:
+            self.logger.warning(
+                f"Last.fm answered {status} with error {info.get('error')}: "
+                f"{info.get('message')}"
+            )
+            return "", ""
+
+        image_infographics = info.get("track", {}).get("album", {}).get("image", [])
+
+        album_art = ""
+        for image_info in image_infographics[::-1]:
+            if image_info.get("#text"):
+                album_art = image_info.get("#text")
+                self.logger.info("Received Album Art for song")
+                break
+
+        wiki = info.get("track", {}).get("wiki", {}).get("summary", "")
+        if wiki:
+            self.logger.info("Received Wiki information for the song")
+            # the summary ends with a "Read more on Last.fm" link
+            wiki = sanitize(wiki, limit=None, drop_links=True).strip()
+
+        result = (album_art, wiki)
+        self.cache.set(key, result, ttl=ttl)
+        return result
+
+
+def _parse(body: bytes) -> dict:
+    try:
+        info = json.loads(body)
+    except ValueError:
+        return {}
+    return info if isinstance(info, dict) else {}
@@ -0,0 +1,43 @@
+import importlib
+from types import ModuleType
+from typing import Optional, Set
+
+# the modules lazy_import was asked for, for preload
+_lazy_names: Set[str] = set()
+
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported the first time one of its
+    attributes is read, for the libraries that are slow to import and are
+    not needed to start the bot
+    """
+
+    def __init__(self, name: str):
+        self.__name = name
+        self.__module: Optional[ModuleType] = None
+
+    def __getattr__(self, attr: str):
+        module = self.__module
+        if module is None:
+            # import_module holds the import lock of the module, so the
+            # threads that get here at once import it only once
+            module = self.__module = importlib.import_module(self.__name)
+        return getattr(module, attr)
+
+    def __repr__(self) -> str:
+        state = "imported" if self.__module is not None else "not imported"
+        return f"<lazy module {self.__name!r}, {state}>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    _lazy_names.add(name)
+    return LazyModule(name)
+
+
+def preload() -> None:
+    """
+    Imports every module that was imported lazily, up front
+    """
+    for name in sorted(_lazy_names):
+        importlib.import_module(name)
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from lyrix_telegram_bot.cache import MISSING, TTLCache
+from lyrix_telegram_bot.lazy import lazy_import
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.metrics import track_upstream
+from lyrix_telegram_bot.normalize import song_key
+from lyrix_telegram_bot.singleflight import SingleFlight
+from lyrix_telegram_bot.storage import write_json_atomic
+from lyrix_telegram_bot.tracing import span
+
+CACHE_DIR = os.getenv("LYRIX_CACHE_DIR", ".cache")
+LYRICS_CACHE_DIR = os.path.join(CACHE_DIR, "lyrics")
+LYRICS_CACHE_SIZE = int(os.getenv("LYRIX_LYRICS_CACHE_SIZE", "512"))
+LYRICS_CACHE_TTL = float(os.getenv("LYRIX_LYRICS_CACHE_TTL", str(7 * 24 * 3600)))
+LYRICS_NEGATIVE_TTL = float(os.getenv("LYRIX_LYRICS_NEGATIVE_TTL", "3600"))
+# files the disk tier keeps, the ones used least recently are removed past it,
+# negative entries included
+LYRICS_DISK_ENTRIES = int(os.getenv("LYRIX_LYRICS_DISK_ENTRIES", "10000"))
+
+swaglyrics_cli = lazy_import("swaglyrics.cli")
+
+
+def get_lyrics(track: str, artist: str) -> Optional[str]:
+    """
+    Scrapes the lyrics of a song from Genius with swaglyrics, which is only
+    imported the first time
+    """
+    return swaglyrics_cli.get_lyrics(track, artist)
+
+
+class LyricsCache:
+    """
+    Caches the lyrics scraped by swaglyrics in an in-memory LRU tier, backed by
+    json files in ``directory``. Songs without lyrics are remembered for
+    ``negative_ttl`` seconds, so that they are not scraped again on every
+    request. Concurrent misses for the same song are scraped once. The disk
+    tier keeps at most ``disk_entries`` files, and drops the ones that were
+    read or written the longest ago, by their mtime.
+    """
+
+    logger = make_logger("lyrics")
+
+    def __init__(
+        self,
+        fetch: Callable[[str, str], Optional[str]] = get_lyrics,
+        directory: str = LYRICS_CACHE_DIR,
+        maxsize: int = LYRICS_CACHE_SIZE,
+        ttl: float = LYRICS_CACHE_TTL,
+        negative_ttl: float = LYRICS_NEGATIVE_TTL,
+        disk_entries: int = LYRICS_DISK_ENTRIES,
+    ):
+        self.fetch = fetch
+        self.directory = directory
+        self.disk_entries = disk_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "negative_hits": 0,
+            "misses": 0,
+        }
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        # the files in the directory, counted on the first write rather than
+        # at startup
+        self._disk_size: Optional[int] = None
+        self._disk_lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, track: str, artist: str) -> Optional[str]:
+        with span("cache.lyrics") as current:
+            lyrics, result = self._get(track, artist)
+            if current is not None:
+                current.attrs["result"] = result
+        return lyrics
+
+    def _get(self, track: str, artist: str) -> Tuple[Optional[str], str]:
+        key = song_key(artist, track)
+
+        lyrics = self.memory.get(key, MISSING)
+        if lyrics is not MISSING:
+            self._count("memory_hits" if lyrics else "negative_hits")
+            return lyrics, "memory" if lyrics else "negative"
+
+        lyrics = self._read_disk(key)
+        if lyrics is not MISSING:
+            self._count("disk_hits" if lyrics else "negative_hits")
+            return lyrics, "disk" if lyrics else "negative"
+
+        self._count("misses")
+        self.logger.debug(f"Lyrics cache miss for {track} by {artist}")
+        return self._flight.do(key, self._scrape, track, artist), "miss"
+
+    def cached(self, track: str, artist: str) -> bool:
+        """
+        Whether the song is in the memory tier, without touching the disk, the
+        LRU order or the hit counters
+        """
+        return song_key(artist, track) in self.memory
+
+    def put(self, track: str, artist: str, lyrics: Optional[str]) -> None:
+        key = song_key(artist, track)
+        ttl = self.ttl if lyrics else self.negative_ttl
+        self.memory.set(key, lyrics, ttl=ttl)
+        if not self.directory:
+            return
+        path = self._path(key)
+        is_new = not os.path.exists(path)
+        try:
+            write_json_atomic(
+                path,
+                {
+                    "artist": key[0],
+                    "track": key[1],
+                    "lyrics": lyrics,
+                    "expires_at": time.time() + ttl,
+                },
+            )
+        except OSError as e:
+            self.logger.warning(f"Couldn't write the lyrics cache entry: {e}")
+            return
+        if is_new:
+            self._count_disk_entry()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._counters)
+        stats["memory_size"] = len(self.memory)
+        return stats
+
+    def _scrape(self, track: str, artist: str) -> Optional[str]:
+        # swaglyrics sends its own requests, outside of the transport
+        with span("genius"), track_upstream("genius"):
+            lyrics = self.fetch(track, artist) or None
+        self.put(track, artist, lyrics)
+        return lyrics
+
+    def _count_disk_entry(self) -> None:
+        with self._disk_lock:
+            if self._disk_size is None:
+                self._disk_size = len(self._disk_files())
+            else:
+                self._disk_size += 1
+            if self._disk_size > self.disk_entries:
+                self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        """
+        Removes the files used the longest ago, down to 90% of the limit so
+        that it is not done on every write
+        """
+        files = []
+        for path in self._disk_files():
+            try:
+                files.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+        files.sort()
+        excess = len(files) - int(self.disk_entries * 0.9)
+        for _, path in files[: max(0, excess)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._disk_size = len(self._disk_files())
+        self.logger.info(f"Pruned the lyrics cache to {self._disk_size} files")
+
+    def _disk_files(self) -> List[str]:
+        # the temporary files of write_json_atomic start with a dot
+        return [
+            entry.path
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(".json") and not entry.name.startswith(".")
+        ]
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _path(self, key: Tuple[str, str]) -> str:
+        digest = hashlib.sha1("\x1f".join(key).encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def _read_disk(self, key: Tuple[str, str]):
+        if not self.directory:
+            return MISSING
+        path = self._path(key)
+        try:
+            with open(path) as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            return MISSING
+
+        remaining = entry.get("expires_at", 0) - time.time()
+        if remaining <= 0 or (entry.get("artist"), entry.get("track")) != key:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            else:
+                with self._disk_lock:
+                    if self._disk_size is not None:
+                        self._disk_size -= 1
+            return MISSING
+
+        try:
+            # the files used the longest ago are the ones pruned
+            os.utime(path)
+        except OSError:
+            pass
+        lyrics = entry.get("lyrics")
+        self.memory.set(key, lyrics, ttl=remaining)
+        return lyrics
@@ -0,0 +1,199 @@
+import html
+import re
+from typing import List, Optional, Tuple
+
+# the longest text and caption telegram accepts, in UTF-16 code units
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+ELLIPSIS = "…"
+
+# the tags telegram understands in HTML mode, everything else is stripped
+ALLOWED_TAGS = {
+    "a",
+    "b",
+    "strong",
+    "i",
+    "em",
+    "u",
+    "ins",
+    "s",
+    "strike",
+    "del",
+    "code",
+    "pre",
+    "blockquote",
+    "tg-spoiler",
+}
+# tags dropped together with what is inside them
+DROPPED_TAGS = {"script", "style", "head", "title"}
+# tags that start a new line of text
+LINE_TAGS = {"br", "p", "div", "li"}
+LINK_SCHEMES = ("http://", "https://", "tg://", "mailto:")
+
+# no part of a tag can run past the next "<" or ">", so that a broken tag is
+# given up on at the next one and the scan stays linear
+_TOKEN = re.compile(
+    r"<!--.*?(?:-->|\Z)"
+    r"|<(?P<close>/)?(?P<tag>[a-zA-Z][a-zA-Z0-9-]*)"
+    r"(?P<attrs>(?:\s+[^\s=<>/]+"
+    r"(?:\s*=\s*(?:\"[^\"<>]*\"|'[^'<>]*'|[^\s<>]+))?)*)"
+    r"\s*/?>"
+    r"|&(?P<entity>#[0-9]{1,7}|#[xX][0-9a-fA-F]{1,6}|[a-zA-Z][a-zA-Z0-9]{1,31});",
+    re.DOTALL,
+)
+_HREF = re.compile(r"""\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.IGNORECASE)
+
+
+def sanitize(
+    source: str,
+    limit: Optional[int] = MESSAGE_LIMIT,
+    drop_links: bool = False,
+    ellipsis: str = ELLIPSIS,
+) -> str:
+    """
+    Turns HTML or plain text from anywhere into HTML that telegram accepts,
+    in one pass: the tags it does not know are stripped, the text and the
+    link urls are escaped, and the tags are balanced. Past ``limit`` visible
+    characters the text is cut with ``ellipsis``, closing the open tags.
+    With ``drop_links``, links are removed along with their text.
+    """
+    # the visible text is never longer than the source
+    if limit is not None and _units(source) <= limit:
+        limit = None
+    budget = None if limit is None else limit - _units(ellipsis)
+
+    out: List[str] = []
+    stack: List[str] = []
+    visible = 0
+    cut: Optional[Tuple[int, List[str]]] = None
+    skipping: Optional[str] = None
+    skip_depth = 0
+
+    def add_text(text: str) -> bool:
+        """
+        Adds escaped text, returns False once it is past the limit
+        """
+        nonlocal visible, cut
+        units = _units(text)
+        if budget is not None and cut is None and visible + units > budget:
+            # where the text is cut if it turns out not to fit
+            head = _cut(text, budget - visible)
+            out.append(html.escape(head, quote=False))
+            cut = (len(out), list(stack))
+            out.append(html.escape(text[len(head) :], quote=False))
+        else:
+            out.append(html.escape(text, quote=False))
+        visible += units
+        return limit is None or visible <= limit
+
+    position = 0
+    fits = True
+    for match in _TOKEN.finditer(source):
+        text = source[position : match.start()]
+        position = match.end()
+        if skipping is not None:
+            tag = (match.group("tag") or "").lower()
+            if tag == skipping:
+                skip_depth += -1 if match.group("close") else 1
+                if skip_depth == 0:
+                    skipping = None
+            continue
+        if text and not add_text(text):
+            fits = False
+            break
+
+        entity = match.group("entity")
+        tag = (match.group("tag") or "").lower()
+        if entity is not None:
+            if not add_text(_resolve(entity)):
+                fits = False
+                break
+        elif not tag:
+            # a comment
+            continue
+        elif match.group("close"):
+            if tag in stack:
+                while True:
+                    open_tag = stack.pop()
+                    out.append(f"</{open_tag}>")
+                    if open_tag == tag:
+                        break
+        elif tag in DROPPED_TAGS or (tag == "a" and drop_links):
+            if not match.group(0).endswith("/>"):
+                skipping, skip_depth = tag, 1
+        elif tag in ALLOWED_TAGS:
+            if tag == "a":
+                href = _href(match.group("attrs"))
+                if href is None:
+                    continue
+                out.append(f'<a href="{html.escape(href)}">')
+            else:
+                out.append(f"<{tag}>")
+            stack.append(tag)
+        elif tag in LINE_TAGS and out:
+            if not add_text("\n"):
+                fits = False
+                break
+    else:
+        if skipping is None:
+            fits = add_text(source[position:])
+
+    if not fits:
+        end, stack = cut
+        del out[end:]
+        out.append(html.escape(ellipsis, quote=False))
+    out.extend(f"</{tag}>" for tag in reversed(stack))
+    return "".join(out)
+
+
+def truncate_text(
+    text: str, limit: int = MESSAGE_LIMIT, ellipsis: str = ELLIPSIS
+) -> str:
+    """
+    Cuts plain text to ``limit`` visible characters
+    """
+    if _units(text) <= limit:
+        return text
+    return _cut(text, limit - _units(ellipsis)) + ellipsis
+
+
+def _units(text: str) -> int:
+    # telegram counts the characters outside the BMP twice
+    return len(text.encode("utf-16-le", "surrogatepass")) // 2
+
+
+def _cut(text: str, units: int) -> str:
+    """
+    The longest prefix of ``text`` that is at most ``units`` long
+    """
+    if units <= 0:
+        return ""
+    if len(text) == _units(text):
+        return text[:units]
+    length = 0
+    for i, char in enumerate(text):
+        length += 2 if ord(char) > 0xFFFF else 1
+        if length > units:
+            return text[:i]
+    return text
+
+
+def _resolve(entity: str) -> str:
+    if not entity.startswith("#"):
+        # unknown names are left as they are
+        return html.unescape(f"&{entity};")
+    code = int(entity[2:], 16) if entity[1] in "xX" else int(entity[1:])
+    if code == 0 or 0xD800 <= code <= 0xDFFF or code > 0x10FFFF:
+        return "\ufffd"
+    return chr(code)
+
+
+def _href(attrs: str) -> Optional[str]:
+    match = _HREF.search(attrs or "")
+    if match is None:
+        return None
+    href = html.unescape(next(g for g in match.groups() if g is not None)).strip()
+    if not href.lower().startswith(LINK_SCHEMES):
+        return None
+    return href
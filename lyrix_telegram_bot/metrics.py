@@ -0,0 +1,372 @@
+import bisect
+import functools
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.tracing import Span, detach, finish_trace, start_trace
+
+# the port of the local /metrics endpoint, the metrics are not collected at
+# all when it is not set
+METRICS_PORT = os.getenv("LYRIX_METRICS_PORT")
+METRICS_LISTEN = os.getenv("LYRIX_METRICS_LISTEN", "127.0.0.1")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# the upstream a request is counted under, by host. The requests to any
+# other host go to a lyrix homeserver.
+UPSTREAM_HOSTS = {
+    "api.spotify.com": "spotify",
+    "accounts.spotify.com": "spotify",
+    "ws.audioscrobbler.com": "lastfm",
+    "api.telegram.org": "telegram",
+    "genius.com": "genius",
+    "api.genius.com": "genius",
+}
+
+Labels = Tuple[str, ...]
+
+# the upstream a request is counted under, by host and port, for the
+# upstreams whose url is configured
+_UPSTREAM_NETLOCS: Dict[str, str] = {}
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], **extra) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for _, value in pairs
+    )
+    return "{" + ",".join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, registry: "Registry", name: str, help: str, labels: Labels):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    @contextmanager
+    def count_exceptions(self, *labels: str) -> Iterator[None]:
+        try:
+            yield
+        except Exception:
+            self.inc(*labels)
+            raise
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return super().render() + [
+            f"{self.name}{_format_labels(self.labels, labels)} {value}"
+            for labels, value in values
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(*args)
+        self.buckets = tuple(buckets)
+        # per label values: the count of every bucket, the sum and the count
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        if not self.registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(labels) or self._values.setdefault(
+                labels, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        if not self.registry.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(
+                (labels, list(counts), total[0])
+                for labels, (counts, total) in self._values.items()
+            )
+        lines = super().render()
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(
+                    f"{self.name}_bucket"
+                    f"{_format_labels(self.labels, labels, le=le)} {cumulative}"
+                )
+            label_text = _format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    A gauge read when the metrics are scraped, from a function that returns
+    the value of every label combination
+    """
+
+    kind = "gauge"
+
+    def __init__(self, *args, read: Callable[[], Dict[Labels, float]]):
+        super().__init__(*args)
+        self.read = read
+
+    def render(self) -> List[str]:
+        try:
+            values = sorted(self.read().items())
+        except Exception as e:
+            self.registry.logger.warning(f"Couldn't read {self.name}: {e}")
+            values = []
+        return super().render() + [
+            f"{self.name}{_format_labels(self.labels, labels)} {value}"
+            for labels, value in values
+        ]
+
+
+class Registry:
+    """
+    The metrics of the bot, in the Prometheus text format. When it is not
+    enabled the metrics are not recorded, and recording one costs a single
+    attribute check. The handlers are traced either way, see
+    ``instrument_handler``.
+    """
+
+    logger = make_logger("metrics")
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labels: Labels = ()) -> Counter:
+        return self._add(Counter(self, name, help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Labels = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._add(Histogram(self, name, help, labels, buckets=buckets))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        labels: Labels,
+        read: Callable[[], Dict[Labels, float]],
+    ) -> Gauge:
+        """
+        Registers a gauge, replacing the one with the same name
+        """
+        gauge = Gauge(self, name, help, labels, read=read)
+        with self._lock:
+            self._metrics[name] = gauge
+        return gauge
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _add(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+
+metrics = Registry(enabled=METRICS_PORT is not None)
+
+HANDLER_SECONDS = metrics.histogram(
+    "lyrix_handler_seconds", "Time spent handling a command", ("handler",)
+)
+HANDLER_ERRORS = metrics.counter(
+    "lyrix_handler_errors_total", "Commands that raised an error", ("handler",)
+)
+UPSTREAM_SECONDS = metrics.histogram(
+    "lyrix_upstream_seconds", "Time spent waiting on an upstream", ("upstream",)
+)
+UPSTREAM_ERRORS = metrics.counter(
+    "lyrix_upstream_errors_total",
+    "Upstream calls that failed or answered with an error status",
+    ("upstream",),
+)
+
+
+def register_upstream(url: str, upstream: str) -> None:
+    """
+    Counts the requests to the host and port of ``url`` under ``upstream``,
+    for an upstream that was pointed somewhere else than its usual host
+    """
+    _UPSTREAM_NETLOCS[urlsplit(url).netloc] = upstream
+
+
+def upstream_name(url: str) -> str:
+    parts = urlsplit(url)
+    upstream = _UPSTREAM_NETLOCS.get(parts.netloc)
+    if upstream is not None:
+        return upstream
+    return UPSTREAM_HOSTS.get(parts.hostname or "", "lyrix_backend")
+
+
+@contextmanager
+def track_upstream(upstream: str) -> Iterator[None]:
+    """
+    Times a call to an upstream, and counts it as an error if it raises
+    """
+    if not metrics.enabled:
+        yield
+        return
+    with UPSTREAM_SECONDS.time(upstream), UPSTREAM_ERRORS.count_exceptions(upstream):
+        yield
+
+
+def instrument_handler(name: str, callback: Callable) -> Callable:
+    """
+    Wraps a python-telegram-bot callback to trace the update, and to record
+    its latency and errors under ``name``. A handler that returns a Future,
+    like the ones that schedule a coroutine, is measured until the future is
+    done. The callback is wrapped and traced even when the registry is not
+    enabled, since /stats and the slow update log are read from the traces;
+    only the metrics are skipped then.
+    """
+
+    def finish(root: Span, error: Optional[BaseException]) -> None:
+        finish_trace(root, error)
+        HANDLER_SECONDS.observe(root.duration, name)
+        if error is not None:
+            HANDLER_ERRORS.inc(name)
+
+    def finish_future(root: Span, future: Future) -> None:
+        if future.cancelled():
+            finish(root, CancelledError())
+        else:
+            finish(root, future.exception())
+
+    @functools.wraps(callback)
+    def instrumented(update, *args, **kwargs):
+        root, token = start_trace(name, **_update_attrs(update))
+        try:
+            result = callback(update, *args, **kwargs)
+        except Exception as e:
+            finish(root, e)
+            raise
+        finally:
+            detach(token)
+        if isinstance(result, Future):
+            result.add_done_callback(functools.partial(finish_future, root))
+        else:
+            finish(root, None)
+        return result
+
+    return instrumented
+
+
+def _update_attrs(update) -> dict:
+    attrs = {"update_id": getattr(update, "update_id", None)}
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        attrs["user_id"] = user.id
+    return attrs
+
+
+class MetricsServer:
+    """
+    Serves the registry on ``/metrics``, from a thread of its own
+    """
+
+    logger = make_logger("metrics")
+
+    def __init__(
+        self,
+        registry: Registry = metrics,
+        listen: str = METRICS_LISTEN,
+        port: int = int(METRICS_PORT or 0),
+    ):
+        self.registry = registry
+        self._server = ThreadingHTTPServer((listen, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="lyrix-metrics", daemon=True
+        )
+
+    @property
+    def bound_port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> None:
+        self._thread.start()
+        self.logger.info(f"Serving the metrics on port {self.bound_port}")
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_handler(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
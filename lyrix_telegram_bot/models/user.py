@@ -1,12 +1,13 @@
 import os
 
-from spotipy import SpotifyOAuth, CacheFileHandler
-
-from lyrix_api.api import Api
 from lyrix_telegram_bot.constants import SCOPES
+from lyrix_telegram_bot.lazy import lazy_import
+from lyrix_telegram_bot.tokens import token_manager
 
 CACHE_DIR = os.getenv("LYRIX_CACHE_DIR", ".cache")
 
+spotipy = lazy_import("spotipy")
+
 
 class LyrixUser:
     def __init__(
@@ -15,12 +16,17 @@ class LyrixUser:
         username: str = None,
         homeserver: str = None,
         token: str = None,
+        spotify_user_id: str = None,
+        spotify_display_name: str = None,
+        playlist_id: str = None,
     ):
         self.telegram_user_id = telegram_user_id
         self.username = username
         self.homeserver = homeserver
         self.token = token
-        self.playlist_id = None
+        self.spotify_user_id = spotify_user_id
+        self.spotify_display_name = spotify_display_name
+        self.playlist_id = playlist_id
 
     def parse_to_dict(self):
         return {
@@ -28,6 +34,9 @@ class LyrixUser:
             "username": self.username,
             "homeserver": self.homeserver,
             "token": self.token,
+            "spotify_user_id": self.spotify_user_id,
+            "spotify_display_name": self.spotify_display_name,
+            "playlist_id": self.playlist_id,
         }
 
     @classmethod
@@ -37,22 +46,21 @@ class LyrixUser:
             username=data.get("username"),
             homeserver=data.get("homeserver"),
             token=data.get("token"),
+            spotify_user_id=data.get("spotify_user_id"),
+            spotify_display_name=data.get("spotify_display_name"),
+            playlist_id=data.get("playlist_id"),
         )
 
     def get_access_token(self) -> str:
-        handler = CacheFileHandler(
-            cache_path=os.path.join(CACHE_DIR, f"cache-{self.telegram_user_id}"),
-            username=str(self.telegram_user_id),
-        )
-        spo = SpotifyOAuth(cache_handler=handler, scope=SCOPES)
-        spotify_auth_token = Api.get_spotify_token(self)
-
-        token = spo.get_access_token(spotify_auth_token)
-        return token.get("access_token")
+        return token_manager.get_access_token(self)
 
     def set_user_playlist_queue(self, playlist_id: str) -> None:
         self.playlist_id = playlist_id
 
+    def set_spotify_profile(self, spotify_user_id: str, display_name: str) -> None:
+        self.spotify_user_id = spotify_user_id
+        self.spotify_display_name = display_name
+
 
 class User:
     def __init__(
@@ -85,11 +93,11 @@ class User:
         }
 
     def get_access_token(self) -> str:
-        handler = CacheFileHandler(
+        handler = spotipy.CacheFileHandler(
             cache_path=os.path.join(CACHE_DIR, f"cache-{self.telegram_user_id}"),
             username=str(self.telegram_user_id),
         )
-        spo = SpotifyOAuth(cache_handler=handler, scope=SCOPES)
+        spo = spotipy.SpotifyOAuth(cache_handler=handler, scope=SCOPES)
 
         token = spo.get_access_token(self.spotify_auth_token)
         return token.get("access_token")
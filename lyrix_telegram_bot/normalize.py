@@ -0,0 +1,92 @@
+import os
+import re
+from functools import lru_cache
+from typing import Tuple
+
+from lyrix_telegram_bot.lazy import lazy_import
+
+swaglyrics_cli = lazy_import("swaglyrics.cli")
+
+# names remembered by each of the functions below, the same few songs are
+# looked up over and over
+NORMALIZE_CACHE_SIZE = int(os.getenv("LYRIX_NORMALIZE_CACHE_SIZE", "4096"))
+
+# the other artists of a song, "Artist feat. Other" from the players that put
+# them in the artist name
+_FEATURED_ARTISTS = re.compile(
+    r"\s+(?:feat\.?|ft\.|featuring)\s.*$|\s+[(\[](?:feat|ft)\b.*$", re.IGNORECASE
+)
+# the artists of a song as Spotify lists them, "Artist, Other"
+_ARTIST_LIST = re.compile(r",\s")
+# bands whose name is a list itself, like "Earth, Wind & Fire" or "Peter, Paul
+# and Mary", which are not split into artists
+_LISTED_BAND = re.compile(
+    r"[^\s,]+(?:,\s[^\s,]+)*\s(?:&|and)\s[^\s,]+(?=,\s|$)", re.IGNORECASE
+)
+# YouTube Music auto-generated channels, "Artist - Topic" or "Artist - Music"
+_CHANNEL_SUFFIX = re.compile(r"\s*-\s*(?:Topic|Music)\s*$", re.IGNORECASE)
+# "(feat. Other)", "[Remastered 2011]"-like parts of the track name, and
+# everything after " - ", like "Song - Radio Edit"
+_TRACK_DECORATIONS = re.compile(
+    r"\s*[(\[](?:feat|ft|with|from|remaster)[^)\]]*[)\]]|\s+-\s.*$",
+    re.IGNORECASE,
+)
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def clean_artist(artist: str) -> str:
+    """
+    Returns the main artist of a song, without the channel suffixes and the
+    characters Genius leaves out of its urls, like "Guns N Roses" for
+    "Guns N' Roses, Other - Music"
+    """
+    artist = _FEATURED_ARTISTS.sub("", _CHANNEL_SUFFIX.sub("", artist))
+    band = _LISTED_BAND.match(artist)
+    if band:
+        artist = band.group()
+    else:
+        artist = _ARTIST_LIST.split(artist, maxsplit=1)[0]
+    # names in other scripts are left out of the urls entirely
+    return _slug(artist) or artist.strip()
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def clean_track(track: str) -> str:
+    """
+    Returns the track name without the featured artists and the version
+    suffixes, like "Song" for "Song (feat. Other) - Remastered 2011"
+    """
+    cleaned = _TRACK_DECORATIONS.sub("", track).strip()
+    # a track named only "(Intro)" or "- Interlude" keeps its name
+    return cleaned or track.strip()
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def song_key(artist: str, track: str) -> Tuple[str, str]:
+    """
+    The canonical (artist, track) key of a song, which the versions of a song
+    with the same lyrics share, for the lyrics cache
+    """
+    track = clean_track(track)
+    return (
+        _WHITESPACE.sub(" ", clean_artist(artist)).casefold(),
+        _WHITESPACE.sub(" ", _slug(track) or track).casefold(),
+    )
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def track_info_key(artist: str, track: str) -> Tuple[str, str]:
+    """
+    The key of the names a song is looked up on Last.fm with, only told apart
+    by case and spacing: a remaster or a soundtrack version has the album art
+    and the wiki of its own album
+    """
+    return (
+        _WHITESPACE.sub(" ", artist).strip().casefold(),
+        _WHITESPACE.sub(" ", track).strip().casefold(),
+    )
+
+
+def _slug(name: str) -> str:
+    return swaglyrics_cli.stripper("", name).strip("-").replace("-", " ")
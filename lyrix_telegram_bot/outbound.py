@@ -0,0 +1,317 @@
+import functools
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+from telegram.utils.helpers import DEFAULT_NONE
+
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.metrics import metrics, track_upstream
+from lyrix_telegram_bot.tracing import span
+
+# messages per second across all chats
+OUTBOUND_GLOBAL_RATE = float(os.getenv("LYRIX_OUTBOUND_GLOBAL_RATE", "30"))
+# messages per second in a private chat
+OUTBOUND_CHAT_RATE = float(os.getenv("LYRIX_OUTBOUND_CHAT_RATE", "1"))
+# messages per second in a group, telegram allows 20 a minute
+OUTBOUND_GROUP_RATE = float(os.getenv("LYRIX_OUTBOUND_GROUP_RATE", "0.33"))
+# messages a chat can get at once before its rate applies
+OUTBOUND_CHAT_BURST = int(os.getenv("LYRIX_OUTBOUND_CHAT_BURST", "3"))
+# concurrent requests to the Bot API
+OUTBOUND_WORKERS = int(os.getenv("LYRIX_OUTBOUND_WORKERS", "8"))
+# the Bot API the bot talks to, followed by the token
+TELEGRAM_API_URL = os.getenv("LYRIX_TELEGRAM_API_URL", "https://api.telegram.org/bot")
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# the Bot API methods that count towards the flood limits
+QUEUED_METHODS = {
+    "sendMessage",
+    "sendPhoto",
+    "sendAudio",
+    "sendDocument",
+    "editMessageText",
+    "editMessageReplyMarkup",
+    "answerInlineQuery",
+}
+
+# idle chat buckets are dropped past this many chats
+MAX_CHAT_BUCKETS = 10_000
+
+OUTBOUND_WAIT_SECONDS = metrics.histogram(
+    "lyrix_outbound_wait_seconds",
+    "Time a message waited in the outbound queue",
+    ("priority",),
+)
+
+
+class TokenBucket:
+    """
+    ``rate`` tokens a second, up to ``capacity``. Not thread safe, the
+    OutboundQueue guards its buckets with its own lock.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        """
+        Seconds until a token is available
+        """
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float, now: float) -> None:
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "chat_id", "func", "future", "enqueued_at")
+
+    def __init__(self, priority: int, seq: int, chat_id: Hashable, func: Callable):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.func = func
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other: "_Job") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundQueue:
+    """
+    Sends the bot's messages no faster than Telegram allows: a token bucket
+    for the whole bot, and one for every chat. Interactive replies are sent
+    before the bulk messages, and when Telegram answers 429 anyway, the chat
+    is paused for ``retry_after`` seconds and the message is sent again.
+    """
+
+    logger = make_logger("outbound")
+
+    def __init__(
+        self,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        chat_rate: float = OUTBOUND_CHAT_RATE,
+        group_rate: float = OUTBOUND_GROUP_RATE,
+        chat_burst: int = OUTBOUND_CHAT_BURST,
+        workers: int = OUTBOUND_WORKERS,
+    ):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.sent = 0
+        self.retried = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[Hashable, TokenBucket] = {}
+        self._jobs: List[_Job] = []
+        self._seq = 0
+        self._running = True
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(
+            workers, thread_name_prefix="lyrix-outbound"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="lyrix-outbound", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self, chat_id: Optional[Hashable], func: Callable, priority: int = INTERACTIVE
+    ) -> Future:
+        """
+        Queues ``func``, which sends one message to ``chat_id``, or to no chat
+        in particular when it is None
+        """
+        with self._cond:
+            self._seq += 1
+            job = _Job(priority, self._seq, chat_id, func)
+            self._jobs.append(job)
+            self._cond.notify()
+        return job.future
+
+    def send(
+        self, chat_id: Optional[Hashable], func: Callable, priority: int = INTERACTIVE
+    ) -> Any:
+        """
+        Queues ``func``, and waits for its result
+        """
+        return self.submit(chat_id, func, priority).result()
+
+    def stop(self) -> None:
+        """
+        Sends the queued messages, and then stops
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "queued": len(self._jobs),
+                "queued_interactive": sum(
+                    job.priority == INTERACTIVE for job in self._jobs
+                ),
+                "queued_bulk": sum(job.priority == BULK for job in self._jobs),
+                "oldest_wait": max(
+                    (now - job.enqueued_at for job in self._jobs), default=0.0
+                ),
+                "sent": self.sent,
+                "retried": self.retried,
+                "wait_avg": self.wait_total / self.sent if self.sent else 0.0,
+                "wait_max": self.wait_max,
+            }
+
+    def _run(self) -> None:
+        with self._cond:
+            while self._running or self._jobs:
+                now = time.monotonic()
+                job, delay = self._next_job(now)
+                if job is None:
+                    self._cond.wait(delay)
+                    continue
+                self._jobs.remove(job)
+                self._global.take(now)
+                if job.chat_id is not None:
+                    self._bucket(job.chat_id).take(now)
+                wait = now - job.enqueued_at
+                self.sent += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                OUTBOUND_WAIT_SECONDS.observe(wait, PRIORITY_NAMES[job.priority])
+                self._executor.submit(self._deliver, job)
+                if len(self._chats) > MAX_CHAT_BUCKETS:
+                    self._prune(now)
+
+    def _next_job(self, now: float) -> Tuple[Optional[_Job], Optional[float]]:
+        """
+        Returns the most urgent job whose chat can take a message now, or
+        how long to wait for one
+        """
+        if not self._jobs:
+            return None, None
+        delay = self._global.wait_time(now)
+        if delay > 0:
+            return None, delay
+        for job in sorted(self._jobs):
+            if job.chat_id is None:
+                return job, 0.0
+            wait = self._bucket(job.chat_id).wait_time(now)
+            if wait == 0:
+                return job, 0.0
+            delay = wait if delay == 0 else min(delay, wait)
+        return None, delay
+
+    def _deliver(self, job: _Job) -> None:
+        try:
+            result = job.func()
+        except RetryAfter as e:
+            self.logger.warning(
+                f"Telegram asked to retry after {e.retry_after}s in {job.chat_id}"
+            )
+            with self._cond:
+                bucket = (
+                    self._global if job.chat_id is None else self._bucket(job.chat_id)
+                )
+                bucket.block(e.retry_after, time.monotonic())
+                self.retried += 1
+                self._jobs.append(job)
+                self._cond.notify()
+            return
+        except Exception as e:
+            job.future.set_exception(e)
+            return
+        job.future.set_result(result)
+
+    def _bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # group ids are negative
+            rate = self.group_rate if str(chat_id).startswith("-") else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        queued = {job.chat_id for job in self._jobs}
+        for chat_id, bucket in list(self._chats.items()):
+            if chat_id not in queued and bucket.idle(now):
+                del self._chats[chat_id]
+
+
+class OutboundBot(ExtBot):
+    """
+    A Bot that sends its messages through an OutboundQueue. Every handler
+    sends through the Update's bot, so replies, edits and inline answers
+    all go through the queue.
+    """
+
+    def __init__(self, token: str, outbound: OutboundQueue, **kwargs):
+        super().__init__(token, **kwargs)
+        self.outbound = outbound
+        self._local = threading.local()
+
+    def send_bulk_message(self, *args, **kwargs):
+        """
+        send_message, sent after the queued interactive replies
+        """
+        self._local.priority = BULK
+        try:
+            return self.send_message(*args, **kwargs)
+        finally:
+            self._local.priority = INTERACTIVE
+
+    def _post(
+        self,
+        endpoint: str,
+        data: dict = None,
+        timeout=DEFAULT_NONE,
+        api_kwargs: dict = None,
+    ):
+        post = functools.partial(self._send, endpoint, data, timeout, api_kwargs)
+        # traced with the wait in the queue, which the handler waits for too
+        with span("telegram", method=endpoint):
+            if endpoint not in QUEUED_METHODS:
+                return post()
+            return self.outbound.send(
+                (data or {}).get("chat_id"),
+                post,
+                priority=getattr(self._local, "priority", INTERACTIVE),
+            )
+
+    def _send(self, *args):
+        # timed apart from the wait in the queue
+        with track_upstream("telegram"):
+            return super()._post(*args)
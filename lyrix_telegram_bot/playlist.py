@@ -0,0 +1,158 @@
+import os
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Set, Tuple
+
+from lyrix_telegram_bot.cache import TTLCache
+from lyrix_telegram_bot.lazy import lazy_import
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.models.user import LyrixUser
+
+spotipy = lazy_import("spotipy")
+
+# songs a user adds within this many seconds are written with one call
+PLAYLIST_FLUSH_WINDOW = float(os.getenv("LYRIX_PLAYLIST_FLUSH_WINDOW", "1.5"))
+# how long the songs of a playlist are trusted before they are read again,
+# since they can also be changed from the spotify apps
+PLAYLIST_MEMBERSHIP_TTL = float(os.getenv("LYRIX_PLAYLIST_MEMBERSHIP_TTL", "3600"))
+# locks the playlist writes are serialized on, a user always gets the same one
+PLAYLIST_WRITE_LOCKS = int(os.getenv("LYRIX_PLAYLIST_WRITE_LOCKS", "64"))
+# spotify adds at most this many items per call
+MAX_ITEMS_PER_CALL = 100
+
+
+class PlaylistWriter:
+    """
+    Adds songs to the users' lyrix playlists in batches. The songs a user
+    asks for within ``window`` seconds are written together, and the ones
+    already in the playlist are dropped, going by a set of its songs kept in
+    memory.
+
+    ``open_playlist`` returns a spotify client for the user and the id of
+    their playlist, creating it when they have none. ``forget_playlist``
+    drops the stored id of a playlist that was deleted in spotify, so that
+    the next ``open_playlist`` creates another one.
+    """
+
+    logger = make_logger("playlist")
+
+    def __init__(
+        self,
+        open_playlist: Callable[[LyrixUser], Tuple["spotipy.Spotify", str]],
+        forget_playlist: Callable[[LyrixUser], None],
+        window: float = PLAYLIST_FLUSH_WINDOW,
+        membership_ttl: float = PLAYLIST_MEMBERSHIP_TTL,
+        write_locks: int = PLAYLIST_WRITE_LOCKS,
+    ):
+        self.window = window
+        self._open_playlist = open_playlist
+        self._forget_playlist = forget_playlist
+        self._pending: Dict[int, List[Tuple[str, Future]]] = {}
+        self._members = TTLCache(maxsize=1024, ttl=membership_ttl)
+        self._write_locks = [threading.Lock() for _ in range(write_locks)]
+        self._lock = threading.Lock()
+
+    def add(self, user: LyrixUser, uri: str) -> Future:
+        """
+        Queues the song, and returns a future that resolves once the batch is
+        written: to True if the song was added, or False if the playlist
+        already had it
+        """
+        future = Future()
+        with self._lock:
+            batch = self._pending.get(user.telegram_user_id)
+            if batch is None:
+                batch = self._pending[user.telegram_user_id] = []
+                timer = threading.Timer(self.window, self._flush, args=(user,))
+                timer.daemon = True
+                timer.start()
+            batch.append((uri, future))
+        return future
+
+    def invalidate(self, telegram_id: int) -> None:
+        """
+        Forgets the songs of the user's playlist, after it was changed
+        without the writer
+        """
+        self._members.pop(telegram_id)
+
+    def clear(self, user: LyrixUser, sp: "spotipy.Spotify", playlist_id: str) -> None:
+        """
+        Removes every song from the user's playlist, after the batches being
+        written. A playlist that was deleted in spotify is forgotten instead.
+        """
+        with self._write_lock(user):
+            try:
+                sp.playlist_replace_items(playlist_id, [])
+            except spotipy.SpotifyException as e:
+                if e.http_status != 404:
+                    raise
+                self._forget(user, playlist_id)
+                return
+            self._members.set(user.telegram_user_id, (playlist_id, set()))
+
+    def _write_lock(self, user: LyrixUser) -> threading.Lock:
+        return self._write_locks[user.telegram_user_id % len(self._write_locks)]
+
+    def _forget(self, user: LyrixUser, playlist_id: str) -> None:
+        self.logger.warning(f"Playlist {playlist_id} was deleted, forgetting it")
+        self._members.pop(user.telegram_user_id)
+        self._forget_playlist(user)
+
+    def _flush(self, user: LyrixUser) -> None:
+        with self._lock:
+            batch = self._pending.pop(user.telegram_user_id, [])
+        if not batch:
+            return
+        try:
+            with self._write_lock(user):
+                added = self._write(user, [uri for uri, _ in batch])
+        except Exception as e:
+            self.logger.warning(f"Couldn't add {len(batch)} songs to a playlist: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for uri, future in batch:
+            future.set_result(uri in added)
+
+    def _write(self, user: LyrixUser, uris: List[str]) -> Set[str]:
+        sp, playlist_id = self._open_playlist(user)
+        try:
+            return self._add_new(user, sp, playlist_id, uris)
+        except spotipy.SpotifyException as e:
+            if e.http_status != 404:
+                raise
+        self._forget(user, playlist_id)
+        sp, playlist_id = self._open_playlist(user)
+        return self._add_new(user, sp, playlist_id, uris)
+
+    def _add_new(
+        self, user: LyrixUser, sp: "spotipy.Spotify", playlist_id: str, uris: List[str]
+    ) -> Set[str]:
+        members = self._members.get(user.telegram_user_id)
+        if members is None or members[0] != playlist_id:
+            members = (playlist_id, self._read_members(sp, playlist_id))
+            self._members.set(user.telegram_user_id, members)
+
+        new = [uri for uri in dict.fromkeys(uris) if uri not in members[1]]
+        for i in range(0, len(new), MAX_ITEMS_PER_CALL):
+            chunk = new[i : i + MAX_ITEMS_PER_CALL]
+            sp.playlist_add_items(playlist_id, chunk)
+            members[1].update(chunk)
+        self.logger.info(
+            f"Added {len(new)} of {len(uris)} songs to playlist {playlist_id}"
+        )
+        return set(new)
+
+    @staticmethod
+    def _read_members(sp: "spotipy.Spotify", playlist_id: str) -> Set[str]:
+        members = set()
+        page = sp.playlist_items(
+            playlist_id, fields="items(track(uri)),next", limit=100
+        )
+        while page:
+            members.update(
+                item["track"]["uri"] for item in page["items"] if item.get("track")
+            )
+            page = sp.next(page) if page.get("next") else None
+        return members
@@ -0,0 +1,104 @@
+import os
+import queue
+import threading
+from typing import Callable, Dict, Optional, Set, Tuple
+
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.lyrics import LyricsCache
+from lyrix_telegram_bot.normalize import song_key
+
+# threads that scrape the lyrics of the shared songs ahead of time
+PREFETCH_WORKERS = int(os.getenv("LYRIX_PREFETCH_WORKERS", "2"))
+# songs waiting to be prefetched, past which new ones are dropped
+PREFETCH_QUEUE_SIZE = int(os.getenv("LYRIX_PREFETCH_QUEUE_SIZE", "32"))
+
+
+class LyricsPrefetcher:
+    """
+    Scrapes the lyrics of a shared song into the LyricsCache before anyone
+    asks for them, since a shared song card is usually followed by requests
+    for its lyrics. It only uses a few threads of its own, and it is best
+    effort: a song is dropped when the queue is full, or when ``busy`` says
+    that the bot has real requests waiting.
+    """
+
+    logger = make_logger("prefetch")
+
+    def __init__(
+        self,
+        lyrics: LyricsCache,
+        workers: int = PREFETCH_WORKERS,
+        max_queued: int = PREFETCH_QUEUE_SIZE,
+        busy: Optional[Callable[[], bool]] = None,
+    ):
+        self.lyrics = lyrics
+        self.busy = busy
+        self.counters = {"queued": 0, "prefetched": 0, "skipped": 0, "dropped": 0}
+        self._queue: "queue.Queue[Optional[Tuple[str, str]]]" = queue.Queue(max_queued)
+        self._pending: Set[Tuple[str, str]] = set()
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"lyrix-prefetch-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, track: str, artist: str) -> bool:
+        """
+        Queues the song, unless its lyrics are cached or already on their
+        way. Returns whether it was queued, without ever blocking.
+        """
+        key = song_key(artist, track)
+        with self._lock:
+            if key in self._pending or self.lyrics.cached(track, artist):
+                self.counters["skipped"] += 1
+                return False
+            if self.busy is not None and self.busy():
+                self.counters["dropped"] += 1
+                return False
+            try:
+                self._queue.put_nowait((track, artist))
+            except queue.Full:
+                self.counters["dropped"] += 1
+                return False
+            self._pending.add(key)
+            self.counters["queued"] += 1
+        return True
+
+    def stop(self) -> None:
+        """
+        Stops the workers once they finish the song they are on, the queued
+        ones are dropped
+        """
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self.counters)
+        stats["waiting"] = self._queue.qsize()
+        return stats
+
+    def _work(self) -> None:
+        while True:
+            song = self._queue.get()
+            if song is None:
+                return
+            track, artist = song
+            try:
+                if self.lyrics.get(track, artist):
+                    with self._lock:
+                        self.counters["prefetched"] += 1
+            except Exception as e:
+                self.logger.warning(f"Couldn't prefetch {track} by {artist}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(song_key(artist, track))
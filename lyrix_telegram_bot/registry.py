@@ -0,0 +1,160 @@
+import threading
+from typing import Dict, List, Optional
+
+from lyrix_telegram_bot.models.user import LyrixUser
+
+
+def user_handle(username: str, homeserver: str) -> str:
+    return f"{username}@{homeserver}"
+
+
+class UserRegistry:
+    """
+    In-memory index of the registered lyrix users.
+
+    Users are keyed by their telegram id, with a secondary index on
+    ``username@homeserver``. The raw records are kept as they were read from
+    the storage, so that the fields we do not know about survive a round trip,
+    and the :class:`LyrixUser` objects are built once and reused.
+
+    While the records are loaded in the background, after ``begin_load``, the
+    lookups and the updates wait for them.
+    """
+
+    def __init__(self, records: List[dict] = None):
+        self._lock = threading.RLock()
+        self._records: Dict[int, dict] = {}
+        self._users: Dict[int, LyrixUser] = {}
+        self._handles: Dict[str, int] = {}
+        # whether the records can be read without waiting, checked first by
+        # every lookup since it is cheaper than the event
+        self._ready = True
+        self._loaded = threading.Event()
+        self._loaded.set()
+        self._load_timeout: Optional[float] = None
+        self._load_error: Optional[BaseException] = None
+        if records:
+            self.load(records)
+
+    def __len__(self) -> int:
+        if not self._ready:
+            self._wait_loaded()
+        return len(self._records)
+
+    def __contains__(self, telegram_id: int) -> bool:
+        if not self._ready:
+            self._wait_loaded()
+        return telegram_id in self._records
+
+    @property
+    def loaded(self) -> bool:
+        return self._ready
+
+    def begin_load(self, timeout: float = None) -> None:
+        """
+        Makes the lookups wait, for at most ``timeout`` seconds, until
+        ``load`` or ``fail_load`` is called
+        """
+        self._load_timeout = timeout
+        self._load_error = None
+        self._ready = False
+        self._loaded.clear()
+
+    def fail_load(self, error: BaseException) -> None:
+        """
+        Makes the lookups that wait for the records raise instead
+        """
+        self._load_error = error
+        self._loaded.set()
+
+    def load(self, records: List[dict]) -> None:
+        with self._lock:
+            self._records.clear()
+            self._users.clear()
+            self._handles.clear()
+            for record in records:
+                telegram_id = record.get("telegram_user_id")
+                # the first record wins, like the linear scan used to do
+                if telegram_id is None or telegram_id in self._records:
+                    continue
+                self._records[telegram_id] = record
+                self._index_handle(record, telegram_id)
+            self._load_error = None
+            self._ready = True
+            self._loaded.set()
+
+    def get(self, telegram_id: int) -> Optional[LyrixUser]:
+        if not self._ready:
+            self._wait_loaded()
+        user = self._users.get(telegram_id)
+        if user is not None:
+            return user
+        with self._lock:
+            record = self._records.get(telegram_id)
+            if record is None:
+                return None
+            return self._users.setdefault(telegram_id, LyrixUser.from_dict(record))
+
+    def get_by_handle(self, username: str, homeserver: str) -> Optional[LyrixUser]:
+        if not self._ready:
+            self._wait_loaded()
+        telegram_id = self._handles.get(user_handle(username, homeserver))
+        if telegram_id is None:
+            return None
+        return self.get(telegram_id)
+
+    def add(self, record: dict) -> LyrixUser:
+        """
+        Adds a record read from the storage after the others were loaded,
+        unless the user is known already, and returns the user
+        """
+        if not self._ready:
+            self._wait_loaded()
+        telegram_id = record["telegram_user_id"]
+        with self._lock:
+            if telegram_id not in self._records:
+                self._records[telegram_id] = record
+                self._index_handle(record, telegram_id)
+        return self.get(telegram_id)
+
+    def upsert(self, user: LyrixUser) -> dict:
+        """
+        Inserts or updates the user, and returns the stored record
+        """
+        if not self._ready:
+            self._wait_loaded()
+        telegram_id = user.telegram_user_id
+        with self._lock:
+            record = self._records.get(telegram_id)
+            if record is None:
+                record = {}
+                self._records[telegram_id] = record
+            else:
+                self._unindex_handle(record, telegram_id)
+            record.update(user.parse_to_dict())
+            self._users[telegram_id] = user
+            self._index_handle(record, telegram_id)
+            return record
+
+    def records(self) -> List[dict]:
+        if not self._ready:
+            self._wait_loaded()
+        with self._lock:
+            return list(self._records.values())
+
+    def _wait_loaded(self) -> None:
+        if not self._loaded.wait(self._load_timeout):
+            raise TimeoutError("The users are still being loaded")
+        if self._load_error is not None:
+            raise RuntimeError("The users could not be loaded") from self._load_error
+
+    def _index_handle(self, record: dict, telegram_id: int) -> None:
+        if record.get("username") and record.get("homeserver"):
+            handle = user_handle(record["username"], record["homeserver"])
+            self._handles[handle] = telegram_id
+
+    def _unindex_handle(self, record: dict, telegram_id: int) -> None:
+        if record.get("username") and record.get("homeserver"):
+            handle = user_handle(record["username"], record["homeserver"])
+            if self._handles.get(handle) == telegram_id:
+                del self._handles[handle]
@@ -0,0 +1,352 @@
+import json
+import os
+import threading
+import zlib
+from typing import Callable, Dict, Optional
+
+from telegram import Update
+from telegram.error import Conflict, TelegramError
+from telegram.ext import Updater
+
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.metrics import metrics
+from lyrix_telegram_bot.shared import SharedStore
+from lyrix_telegram_bot.webhook import ALLOWED_UPDATES, start_dispatcher
+
+# the replicas the users are sharded over, and which one this process is.
+# Every replica has to be started with the same count.
+REPLICAS = int(os.getenv("LYRIX_REPLICAS", "1"))
+REPLICA_INDEX = int(os.getenv("LYRIX_REPLICA_INDEX", "0"))
+# how long the replica that polls Telegram holds the lease without renewing
+# it, it is renewed three times as often
+LEADER_LEASE_SECONDS = float(os.getenv("LYRIX_LEADER_LEASE_SECONDS", "30"))
+# long polling timeout of getUpdates, shorter than the lease so that a leader
+# notices it lost the lease before another replica starts polling
+LEADER_POLL_TIMEOUT = float(os.getenv("LYRIX_LEADER_POLL_TIMEOUT", "10"))
+# how often a replica looks for the updates routed to it while it has none
+ROUTE_POLL_INTERVAL = float(os.getenv("LYRIX_ROUTE_POLL_INTERVAL", "0.05"))
+# updates taken from the queue of a replica at once
+ROUTE_BATCH = int(os.getenv("LYRIX_ROUTE_BATCH", "100"))
+
+LEADER_LEASE = "polling_leader"
+# the first update the next leader asks Telegram for
+POLLING_OFFSET_KEY = "polling_offset"
+
+ROUTED_UPDATES = metrics.counter(
+    "lyrix_routed_updates_total",
+    "Updates handed to the replica that owns the user",
+    ("replica",),
+)
+
+
+def replica_for(telegram_id: int, replicas: int = REPLICAS) -> int:
+    """
+    The replica that handles the updates of a user
+    """
+    return zlib.crc32(str(telegram_id).encode()) % replicas
+
+
+def queue_name(index: int) -> str:
+    return f"updates:{index}"
+
+
+class LeaderElector:
+    """
+    Keeps trying to take the lease ``name`` in the shared store, and renews
+    it while it has it. ``on_elected`` is called once the lease is taken.
+    """
+
+    logger = make_logger("replicas")
+
+    def __init__(
+        self,
+        store: SharedStore,
+        holder: str,
+        on_elected: Callable[[], None],
+        name: str = LEADER_LEASE,
+        ttl: float = LEADER_LEASE_SECONDS,
+    ):
+        self.store = store
+        self.holder = holder
+        self.on_elected = on_elected
+        self.name = name
+        self.ttl = ttl
+        self.is_leader = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="lyrix-elector", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        self.resign()
+
+    def resign(self) -> None:
+        """
+        Gives the lease up, so that another replica, or this one again, can
+        take it
+        """
+        if self.is_leader:
+            self.is_leader = False
+            self.store.release_lease(self.name, self.holder)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                leader = self.store.acquire_lease(self.name, self.holder, self.ttl)
+            except Exception:
+                self.logger.exception(f"Couldn't renew the {self.name} lease")
+                leader = False
+            if leader and not self.is_leader:
+                self.logger.info(f"{self.holder} took the {self.name} lease")
+                self.is_leader = True
+                self.on_elected()
+            elif not leader and self.is_leader:
+                self.logger.warning(f"{self.holder} lost the {self.name} lease")
+                self.is_leader = False
+            self._stopped.wait(self.ttl / 3)
+
+
+class LeaderPoller:
+    """
+    Pulls the updates with getUpdates while the elector holds the lease,
+    queues the ones of the other replicas' users for them and puts the rest
+    on the dispatcher's queue. The offset is kept in the shared store, and
+    only moved past the updates once they were handed on: a leader that dies
+    before leaves them to the next one, which may handle some twice. The
+    updates of this replica's own users that were still waiting in its
+    dispatcher are lost with it, like they are without replicas. A poller
+    that fails gives the lease up, so that the polling is taken over.
+    """
+
+    logger = make_logger("replicas")
+
+    def __init__(
+        self,
+        updater: Updater,
+        store: SharedStore,
+        elector: LeaderElector,
+        router: "UpdateRouter",
+        timeout: float = LEADER_POLL_TIMEOUT,
+    ):
+        self.updater = updater
+        self.store = store
+        self.elector = elector
+        self.router = router
+        self.timeout = timeout
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        # a leader that lost the lease and took it back before its last long
+        # poll returned is still polling
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="lyrix-leader-poller", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        try:
+            self._poll()
+        except Exception:
+            self.logger.exception("Polling failed, giving the lease up")
+            # the elector starts another poller if it takes the lease back
+            self._thread = None
+            self.elector.resign()
+
+    def _poll(self) -> None:
+        bot = self.updater.bot
+        webhook_deleted = False
+        while not self._stopped.is_set() and self.elector.is_leader:
+            if not webhook_deleted:
+                try:
+                    bot.delete_webhook()
+                except TelegramError as e:
+                    self.logger.warning(f"Couldn't delete the webhook: {e}")
+                    self._stopped.wait(1)
+                    continue
+                webhook_deleted = True
+            offset = self.store.get(POLLING_OFFSET_KEY)
+            try:
+                updates = bot.get_updates(
+                    int(offset) if offset is not None else None,
+                    timeout=self.timeout,
+                    allowed_updates=ALLOWED_UPDATES,
+                )
+            except Conflict:
+                # the previous leader is still in its last long poll
+                self._stopped.wait(1)
+                continue
+            except TelegramError as e:
+                self.logger.warning(f"Couldn't get the updates: {e}")
+                self._stopped.wait(1)
+                continue
+            if not updates:
+                continue
+            for update in updates:
+                if not self.router.forward(update):
+                    self.updater.update_queue.put(update)
+            self.store.set(POLLING_OFFSET_KEY, str(updates[-1].update_id + 1))
+        self.logger.info("Stopped polling")
+
+
+class UpdateRouter:
+    """
+    Hands every update to the replica that owns its user, through the queues
+    of the shared store, as soon as it is taken from Telegram, so that the
+    commands of a user are handled by one replica. The updates routed to this
+    replica are taken from its queue and put on the dispatcher's queue.
+
+    With polling, the leader is the only replica that takes updates, and a
+    user's updates keep the order Telegram sent them in. With the webhook
+    they land on any replica, so with ``route_local`` the ones that land on
+    their owner go through its queue as well, and a user's updates are
+    handled in the order the replicas accepted them.
+    """
+
+    logger = make_logger("replicas")
+
+    def __init__(
+        self,
+        updater: Updater,
+        store: SharedStore,
+        replicas: int = REPLICAS,
+        index: int = REPLICA_INDEX,
+        route_local: bool = False,
+    ):
+        self.updater = updater
+        self.store = store
+        self.replicas = replicas
+        self.index = index
+        self.route_local = route_local
+        self.routed = 0
+        self.received = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="lyrix-router", daemon=True
+        )
+
+    def forward(self, update: Update) -> bool:
+        """
+        Queues the update for the replica that owns its user. Returns False
+        when it is to be handled here right away.
+        """
+        user = update.effective_user
+        # the updates without a user, which the bot has no handlers for, stay
+        # where they arrived
+        if user is None:
+            return False
+        owner = replica_for(user.id, self.replicas)
+        if owner == self.index and not self.route_local:
+            return False
+        self.store.push(queue_name(owner), [json.dumps(update.to_dict())])
+        self.routed += 1
+        ROUTED_UPDATES.inc(str(owner))
+        return True
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        return {"routed": self.routed, "received": self.received}
+
+    def _run(self) -> None:
+        queue = queue_name(self.index)
+        while not self._stopped.is_set():
+            try:
+                items = self.store.pop(queue, ROUTE_BATCH)
+            except Exception:
+                self.logger.exception("Couldn't read the routed updates")
+                items = []
+            for item in items:
+                update = Update.de_json(json.loads(item), self.updater.bot)
+                self.received += 1
+                self.updater.update_queue.put(update)
+            if not items:
+                self._stopped.wait(ROUTE_POLL_INTERVAL)
+
+
+class ReplicaNode:
+    """
+    Runs the dispatcher of a replica without python-telegram-bot's polling.
+    Updates come in through the webhook on every replica, or through
+    getUpdates on the one replica that holds the polling lease, and are
+    routed to the replica that owns the user.
+    """
+
+    logger = make_logger("replicas")
+
+    def __init__(
+        self,
+        updater: Updater,
+        store: SharedStore,
+        replicas: int = REPLICAS,
+        index: int = REPLICA_INDEX,
+    ):
+        if not 0 <= index < replicas:
+            raise ValueError(
+                f"LYRIX_REPLICA_INDEX {index} is not below LYRIX_REPLICAS {replicas}"
+            )
+        self.updater = updater
+        self.store = store
+        self.index = index
+        self.router = UpdateRouter(updater, store, replicas, index)
+        self.elector: Optional[LeaderElector] = None
+        self.poller: Optional[LeaderPoller] = None
+
+    def start(self, poll: bool) -> None:
+        """
+        Starts taking the updates routed to this replica. With ``poll``, it
+        also starts the dispatcher, which the webhook server starts otherwise,
+        and takes part in the election of the replica that polls Telegram.
+        """
+        if poll:
+            start_dispatcher(self.updater)
+        else:
+            # every replica takes updates from the webhook, which hands them to
+            # the router; a user's updates all go through the owner's queue
+            # to stay in order
+            self.router.route_local = True
+        self.router.start()
+        self.logger.info(f"Replica {self.index} is taking the updates routed to it")
+
+        if poll:
+            self.elector = LeaderElector(
+                self.store, f"replica-{self.index}-{os.getpid()}", self._elected
+            )
+            self.poller = LeaderPoller(
+                self.updater, self.store, self.elector, self.router
+            )
+            self.elector.start()
+
+    def stop(self) -> None:
+        if self.elector is not None:
+            self.elector.stop()
+        if self.poller is not None:
+            self.poller.stop()
+        self.router.stop()
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            self.router.stats(),
+            leader=int(self.elector is not None and self.elector.is_leader),
+        )
+
+    def _elected(self) -> None:
+        self.logger.info(f"Replica {self.index} is polling Telegram")
+        self.poller.start()
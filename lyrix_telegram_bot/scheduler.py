@@ -0,0 +1,212 @@
+import functools
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, Set
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from lyrix_telegram_bot.cache import TTLCache
+from lyrix_telegram_bot.logger import make_logger
+
+# workers for the instant commands, like /ping and /telegram_id
+FAST_WORKERS = int(os.getenv("LYRIX_FAST_WORKERS", "4"))
+# workers for the commands that wait on lyrics, Spotify or the homeservers
+SLOW_WORKERS = int(os.getenv("LYRIX_SLOW_WORKERS", "16"))
+# commands a user can have waiting in a pool, past which they are told to wait
+USER_QUEUE_DEPTH = int(os.getenv("LYRIX_USER_QUEUE_DEPTH", "3"))
+# a user is told they are busy at most once in this many seconds
+BUSY_REPLY_INTERVAL = float(os.getenv("LYRIX_BUSY_REPLY_INTERVAL", "10"))
+
+BUSY_MESSAGE = "🐢 I'm still working on your last few requests, try again in a bit"
+
+Handler = Callable[[Update, CallbackContext], None]
+
+
+class FairPool:
+    """
+    A pool of worker threads with a queue per user. The workers serve the
+    users round-robin, so a user with many queued jobs only delays their own
+    jobs, and the queues are bounded at ``max_depth`` jobs per user. A user's
+    jobs run one at a time, in the order they were submitted; a job that
+    returns a Future holds the user's next job back until it is done.
+    """
+
+    logger = make_logger("scheduler")
+
+    def __init__(self, name: str, workers: int, max_depth: int):
+        self.name = name
+        self.max_depth = max_depth
+        self.rejected = 0
+        self.replaced = 0
+        self._queues: Dict[Hashable, deque] = {}
+        # the users with queued jobs and none running, in the order they are
+        # served
+        self._ready: "OrderedDict[Hashable, None]" = OrderedDict()
+        # the users with a job running
+        self._running_keys: Set[Hashable] = set()
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._work, name=f"lyrix-{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(
+        self,
+        key: Hashable,
+        func: Callable,
+        *args,
+        force: bool = False,
+        replace: bool = False,
+    ) -> bool:
+        """
+        Queues ``func(*args)`` behind the other jobs of ``key``. Returns False
+        without queueing it when the queue is full, unless ``force`` is set.
+        With ``replace``, the jobs of ``key`` that did not start yet are
+        dropped for this one, so that only the newest waits.
+        """
+        with self._cond:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+            elif replace and queue:
+                self.replaced += len(queue)
+                self._queued -= len(queue)
+                queue.clear()
+            elif not force and len(queue) >= self.max_depth:
+                self.rejected += 1
+                return False
+            queue.append((func, args))
+            self._queued += 1
+            if key not in self._running_keys:
+                self._ready[key] = None
+                self._cond.notify()
+            return True
+
+    def stop(self) -> None:
+        """
+        Runs the queued jobs, and then stops the workers
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def busy(self) -> bool:
+        """
+        Whether jobs are waiting for a worker
+        """
+        return self._queued > 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "workers": len(self._threads),
+                "users": len(self._queues),
+                "queued": self._queued,
+                "rejected": self.rejected,
+                "replaced": self.replaced,
+            }
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                # the jobs queued behind a running one are run once it is
+                # done, even when the pool is stopping
+                while not self._ready and (self._running or self._running_keys):
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                key, _ = self._ready.popitem(last=False)
+                func, args = self._queues[key].popleft()
+                self._queued -= 1
+                self._running_keys.add(key)
+            result = None
+            try:
+                result = func(*args)
+            except Exception:
+                self.logger.exception(f"Unhandled error in the {self.name} pool")
+            if isinstance(result, Future):
+                result.add_done_callback(lambda _, key=key: self._done(key))
+            else:
+                self._done(key)
+
+    def _done(self, key: Hashable) -> None:
+        with self._cond:
+            self._running_keys.discard(key)
+            if self._queues[key]:
+                # the user goes to the back of the line
+                self._ready[key] = None
+            else:
+                del self._queues[key]
+            if self._running:
+                self._cond.notify()
+            else:
+                # the workers of a stopping pool wait for the last running job
+                self._cond.notify_all()
+
+
+class Scheduler:
+    """
+    Runs the handlers on two bulkheads: ``fast`` for the instant commands,
+    and ``slow`` for the ones that wait on upstream services, so that a
+    backlog of lyrics lookups never delays /ping. Within a pool, users take
+    turns, and a user who already has a full queue gets a busy reply instead.
+    The handlers that keep only the latest update, like the inline queries,
+    have a queue of their own for every user.
+    """
+
+    def __init__(
+        self,
+        fast_workers: int = FAST_WORKERS,
+        slow_workers: int = SLOW_WORKERS,
+        max_depth: int = USER_QUEUE_DEPTH,
+    ):
+        self.fast = FairPool("fast", fast_workers, max_depth)
+        self.slow = FairPool("slow", slow_workers, max_depth)
+        self._told_busy = TTLCache(maxsize=4096, ttl=BUSY_REPLY_INTERVAL)
+
+    def handler(
+        self, callback: Handler, slow: bool = False, latest: bool = False
+    ) -> Handler:
+        """
+        Wraps a python-telegram-bot callback, so that it is queued on one of
+        the pools instead of running on the dispatcher thread. With
+        ``latest``, a user has at most one update waiting for the callback,
+        and a newer one takes its place: while they type an inline query,
+        the query they end up seeing is the one answered.
+        """
+        pool = self.slow if slow else self.fast
+
+        @functools.wraps(callback)
+        def schedule(update: Update, ctx: CallbackContext) -> None:
+            user = update.effective_user
+            key = user.id if user is not None else None
+            if latest:
+                pool.submit((key, "latest"), callback, update, ctx, replace=True)
+            elif not pool.submit(key, callback, update, ctx):
+                self._reply_busy(key, update)
+
+        return schedule
+
+    def stop(self) -> None:
+        self.fast.stop()
+        self.slow.stop()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"fast": self.fast.stats(), "slow": self.slow.stats()}
+
+    def _reply_busy(self, key: Hashable, update: Update) -> None:
+        if update.effective_message is None or self._told_busy.get(key):
+            return
+        self._told_busy.set(key, True)
+        self.fast.submit(
+            key, update.effective_message.reply_text, BUSY_MESSAGE, force=True
+        )
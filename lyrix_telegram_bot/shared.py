@@ -0,0 +1,221 @@
+import collections
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from lyrix_telegram_bot.logger import make_logger
+
+# "local" keeps the shared state in the process, which is all a single
+# replica needs, "sqlite" shares it between the replicas through a database
+# on a volume they all mount
+SHARED_STORE = os.getenv("LYRIX_SHARED_STORE", "local")
+SHARED_STORE_PATH = os.getenv("LYRIX_SHARED_STORE_PATH", "lyrix-shared.db")
+
+
+class SharedStore:
+    """
+    The state the replicas of the bot share: values by key, leases held by
+    one replica at a time, and the queues the updates are routed through
+    """
+
+    logger = make_logger("shared")
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """
+        Takes the lease for ``ttl`` seconds, or extends it when ``holder``
+        already has it. Returns False while another holder has it.
+        """
+        raise NotImplementedError
+
+    def release_lease(self, name: str, holder: str) -> None:
+        raise NotImplementedError
+
+    def push(self, queue: str, items: List[str]) -> None:
+        raise NotImplementedError
+
+    def pop(self, queue: str, limit: int) -> List[str]:
+        """
+        Removes and returns at most ``limit`` items, the oldest first
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class LocalSharedStore(SharedStore):
+    def __init__(self):
+        self._values: Dict[str, str] = {}
+        self._leases: Dict[str, Tuple[str, float]] = {}
+        self._queues: Dict[str, Deque[str]] = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        return self._values.get(key)
+
+    def set(self, key: str, value: str) -> None:
+        self._values[key] = value
+
+    def delete(self, key: str) -> None:
+        self._values.pop(key, None)
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            current = self._leases.get(name)
+            if current is not None and current[0] != holder and current[1] > now:
+                return False
+            self._leases[name] = (holder, now + ttl)
+            return True
+
+    def release_lease(self, name: str, holder: str) -> None:
+        with self._lock:
+            if self._leases.get(name, (None,))[0] == holder:
+                del self._leases[name]
+
+    def push(self, queue: str, items: List[str]) -> None:
+        with self._lock:
+            self._queues[queue].extend(items)
+
+    def pop(self, queue: str, limit: int) -> List[str]:
+        with self._lock:
+            items = self._queues.get(queue)
+            if not items:
+                return []
+            return [items.popleft() for _ in range(min(limit, len(items)))]
+
+
+class SqliteSharedStore(SharedStore):
+    """
+    Shares the state through a WAL mode SQLite database. Every replica opens
+    it, and the writes that read first, like taking a lease or popping from
+    a queue, run in an immediate transaction so that only one replica at a
+    time does them.
+    """
+
+    def __init__(self, path: str = SHARED_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=10, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS queue ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "name TEXT NOT NULL, item TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS queue_name ON queue (name, id)"
+            )
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, key: str, value: str) -> None:
+        with self._transaction():
+            self._conn.execute(
+                "INSERT INTO kv (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._transaction():
+            self._conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        with self._transaction():
+            row = self._conn.execute(
+                "SELECT holder, expires_at FROM leases WHERE name = ?", (name,)
+            ).fetchone()
+            if row is not None and row[0] != holder and row[1] > now:
+                return False
+            self._conn.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET "
+                "holder = excluded.holder, expires_at = excluded.expires_at",
+                (name, holder, now + ttl),
+            )
+            return True
+
+    def release_lease(self, name: str, holder: str) -> None:
+        with self._transaction():
+            self._conn.execute(
+                "DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder)
+            )
+
+    def push(self, queue: str, items: List[str]) -> None:
+        with self._transaction():
+            self._conn.executemany(
+                "INSERT INTO queue (name, item) VALUES (?, ?)",
+                [(queue, item) for item in items],
+            )
+
+    def pop(self, queue: str, limit: int) -> List[str]:
+        with self._transaction():
+            rows = self._conn.execute(
+                "SELECT id, item FROM queue WHERE name = ? ORDER BY id LIMIT ?",
+                (queue, limit),
+            ).fetchall()
+            if rows:
+                self._conn.execute(
+                    "DELETE FROM queue WHERE name = ? AND id <= ?",
+                    (queue, rows[-1][0]),
+                )
+        return [item for _, item in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # takes the write lock of the database from the start, so that what
+        # the transaction reads is still true when it writes
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            else:
+                self._conn.execute("COMMIT")
+
+
+def make_shared_store(backend: str = SHARED_STORE) -> SharedStore:
+    if backend == "local":
+        return LocalSharedStore()
+    if backend == "sqlite":
+        return SqliteSharedStore()
+    raise ValueError(f"Unknown shared store {backend!r}")
+
+
+shared_store = make_shared_store()
@@ -0,0 +1,234 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+from lyrix_telegram_bot.logger import make_logger
+
+STORAGE_BACKEND = os.getenv("LYRIX_STORAGE_BACKEND", "json")
+STORAGE_JSON_PATH = os.getenv("LYRIX_STORAGE_JSON_PATH", "spotify.json")
+STORAGE_SQLITE_PATH = os.getenv("LYRIX_STORAGE_SQLITE_PATH", "lyrix.db")
+DEFAULT_DATA = {"version": 1, "users": []}
+
+
+class Storage:
+    """
+    Persistence backend for the registered users. Records are the dicts
+    produced by ``LyrixUser.parse_to_dict``, keyed by ``telegram_user_id``.
+    """
+
+    logger = make_logger("storage")
+
+    def load(self) -> List[dict]:
+        raise NotImplementedError
+
+    def upsert(self, record: dict) -> None:
+        raise NotImplementedError
+
+    def write(self, records: List[dict]) -> None:
+        raise NotImplementedError
+
+    def get(self, telegram_id: int) -> Optional[dict]:
+        """
+        Reads one record, for the users another replica added since the
+        records were loaded
+        """
+        raise NotImplementedError
+
+    def get_by_handle(self, username: str, homeserver: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+def write_json_atomic(path: str, data: dict) -> None:
+    """
+    Writes the json to a temporary file next to ``path`` and renames it over
+    the original, so that a crash never leaves a truncated file behind
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory
+    )
+    try:
+        with os.fdopen(fd, "w") as fp:
+            json.dump(data, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class JsonStorage(Storage):
+    """
+    Keeps the whole database in a single json file. Every upsert rewrites the
+    file atomically.
+    """
+
+    def __init__(self, path: str = STORAGE_JSON_PATH):
+        self.path = path
+        self.db = {}
+        self._records: Dict[int, dict] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> List[dict]:
+        if not os.path.exists(self.path):
+            write_json_atomic(self.path, DEFAULT_DATA)
+
+        with open(self.path) as fp:
+            self.db = dict(DEFAULT_DATA, **json.load(fp))
+
+        with self._lock:
+            self._records.clear()
+            for record in self.db["users"]:
+                self._records.setdefault(record.get("telegram_user_id"), record)
+        return self.db["users"]
+
+    def upsert(self, record: dict) -> None:
+        with self._lock:
+            self._records[record["telegram_user_id"]] = record
+            self._dump(list(self._records.values()))
+
+    def write(self, records: List[dict]) -> None:
+        with self._lock:
+            self._records = {r["telegram_user_id"]: r for r in records}
+            self._dump(records)
+
+    def get(self, telegram_id: int) -> Optional[dict]:
+        return self._records.get(telegram_id)
+
+    def get_by_handle(self, username: str, homeserver: str) -> Optional[dict]:
+        with self._lock:
+            records = list(self._records.values())
+        for record in records:
+            if (
+                record.get("username") == username
+                and record.get("homeserver") == homeserver
+            ):
+                return record
+        return None
+
+    def _dump(self, records: List[dict]) -> None:
+        self.db["users"] = records
+        write_json_atomic(self.path, self.db)
+
+
+class SqliteStorage(Storage):
+    """
+    Stores one row per user in a WAL mode SQLite database, so that every
+    upsert is written on its own, in a transaction. On the first start, the
+    users from ``json_path`` are imported if the file exists.
+    """
+
+    def __init__(
+        self, path: str = STORAGE_SQLITE_PATH, json_path: str = STORAGE_JSON_PATH
+    ):
+        self.path = path
+        self.json_path = json_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "telegram_user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS users_handle ON users ("
+                "json_extract(data, '$.username'), json_extract(data, '$.homeserver'))"
+            )
+
+    def load(self) -> List[dict]:
+        with self._lock:
+            self._migrate_json()
+            rows = self._conn.execute("SELECT data FROM users").fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def upsert(self, record: dict) -> None:
+        with self._lock, self._conn:
+            self._upsert(record)
+
+    def write(self, records: List[dict]) -> None:
+        with self._lock, self._conn:
+            for record in records:
+                self._upsert(record)
+
+    def get(self, telegram_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM users WHERE telegram_user_id = ?", (telegram_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_by_handle(self, username: str, homeserver: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM users WHERE json_extract(data, '$.username') = ? "
+                "AND json_extract(data, '$.homeserver') = ? "
+                "ORDER BY telegram_user_id LIMIT 1",
+                (username, homeserver),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _upsert(self, record: dict) -> None:
+        self._conn.execute(
+            "INSERT INTO users (telegram_user_id, data) VALUES (?, ?) "
+            "ON CONFLICT(telegram_user_id) DO UPDATE SET data = excluded.data",
+            (record["telegram_user_id"], json.dumps(record)),
+        )
+
+    def _migrate_json(self) -> None:
+        migrated = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'migrated_json'"
+        ).fetchone()
+        if migrated is not None:
+            return
+
+        records = []
+        if self.json_path and os.path.exists(self.json_path):
+            with open(self.json_path) as fp:
+                records = json.load(fp).get("users", [])
+            self.logger.info(
+                f"Migrating {len(records)} users from {self.json_path} to {self.path}"
+            )
+
+        with self._conn:
+            for record in records:
+                if record.get("telegram_user_id") is None:
+                    continue
+                # keep the first record, like the json lookups do
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO users (telegram_user_id, data) "
+                    "VALUES (?, ?)",
+                    (record["telegram_user_id"], json.dumps(record)),
+                )
+            # the workers that start together may all have found nothing
+            # migrated yet
+            self._conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('migrated_json', ?)",
+                (self.json_path or "",),
+            )
+
+
+def make_storage(backend: str = STORAGE_BACKEND) -> Storage:
+    if backend == "json":
+        return JsonStorage()
+    if backend == "sqlite":
+        return SqliteStorage()
+    raise ValueError(f"Unknown storage backend {backend!r}")
@@ -0,0 +1,225 @@
+import functools
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from lyrix_telegram_bot.backend import LyrixBackend
+from lyrix_telegram_bot.constants import SCOPES
+from lyrix_telegram_bot.lazy import lazy_import
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.metrics import register_upstream
+from lyrix_telegram_bot.shared import SHARED_STORE, SharedStore, shared_store
+from lyrix_telegram_bot.transport import transport
+
+spotipy = lazy_import("spotipy")
+
+CACHE_DIR = os.getenv("LYRIX_CACHE_DIR", ".cache")
+# where the spotify web api and the token endpoint are, they only change to
+# point the bot at a stand-in
+SPOTIFY_API_URL = os.getenv("LYRIX_SPOTIFY_API_URL", "https://api.spotify.com/v1/")
+SPOTIFY_ACCOUNTS_URL = os.getenv(
+    "LYRIX_SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com"
+)
+# tokens are refreshed in the background once they are this close to expiry
+TOKEN_REFRESH_MARGIN = float(os.getenv("LYRIX_SPOTIFY_TOKEN_REFRESH_MARGIN", "300"))
+# below this, the cached token is not handed out anymore
+TOKEN_MIN_VALIDITY = 30
+
+register_upstream(SPOTIFY_API_URL, "spotify")
+register_upstream(SPOTIFY_ACCOUNTS_URL, "spotify")
+
+
+class SpotifyTokenManager:
+    """
+    Keeps the spotify access token of every user in memory, along with its
+    expiry. Tokens are refreshed with their refresh token ahead of expiry,
+    and the lyrix backend is only asked for the authorization code when
+    spotify does not have a usable refresh token.
+
+    The tokens are cached in ``cache_dir``, or in ``store`` when the replicas
+    of the bot share one, so that a replica starts with the tokens another
+    one got.
+    """
+
+    logger = make_logger("tokens")
+
+    def __init__(
+        self,
+        cache_dir: str = CACHE_DIR,
+        refresh_margin: float = TOKEN_REFRESH_MARGIN,
+        store: SharedStore = None,
+    ):
+        self.cache_dir = cache_dir
+        self.refresh_margin = refresh_margin
+        self.store = store
+        self._tokens: Dict[int, dict] = {}
+        self._oauth: Dict[int, "spotipy.SpotifyOAuth"] = {}
+        self._user_locks: Dict[int, threading.Lock] = {}
+        self._refreshing: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def get_access_token(self, user) -> str:
+        return self.get_cached_access_token(user) or self._refresh(user)["access_token"]
+
+    def get_cached_access_token(self, user) -> Optional[str]:
+        """
+        Returns the cached token if it can still be used, without blocking on
+        the network. None means that the token has to be refreshed first.
+        """
+        token_info = self._tokens.get(user.telegram_user_id)
+        if token_info is None:
+            return None
+        remaining = token_info["expires_at"] - time.time()
+        if remaining > self.refresh_margin:
+            return token_info["access_token"]
+        if remaining > TOKEN_MIN_VALIDITY:
+            self._refresh_in_background(user)
+            return token_info["access_token"]
+        return None
+
+    def invalidate(self, telegram_id: int) -> None:
+        with self._lock:
+            self._tokens.pop(telegram_id, None)
+            self._oauth.pop(telegram_id, None)
+
+    def _refresh(self, user) -> dict:
+        telegram_id = user.telegram_user_id
+        with self._user_lock(telegram_id):
+            token_info = self._tokens.get(telegram_id)
+            if self._is_fresh(token_info):
+                return token_info
+
+            oauth = self._get_oauth(user)
+            if token_info is None or self.store is not None:
+                # with a shared store, another replica may have refreshed it
+                cached = oauth.cache_handler.get_cached_token()
+                if self._has_scopes(cached):
+                    token_info = cached
+            if self._is_fresh(token_info):
+                self._tokens[telegram_id] = token_info
+                return token_info
+
+            new_token_info = None
+            if token_info and token_info.get("refresh_token"):
+                try:
+                    new_token_info = oauth.refresh_access_token(
+                        token_info["refresh_token"]
+                    )
+                except spotipy.oauth2.SpotifyOauthError as e:
+                    self.logger.info(
+                        f"Couldn't refresh the spotify token of {telegram_id}: {e}"
+                    )
+
+            if new_token_info is None:
+                self.logger.info(
+                    f"Requesting a new spotify authorization code for {telegram_id}"
+                )
+                code = LyrixBackend.get_spotify_token(user)
+                oauth.get_access_token(code, as_dict=False, check_cache=False)
+                new_token_info = oauth.cache_handler.get_cached_token()
+
+            self._tokens[telegram_id] = new_token_info
+            return new_token_info
+
+    def _refresh_in_background(self, user) -> None:
+        telegram_id = user.telegram_user_id
+        with self._lock:
+            if telegram_id in self._refreshing:
+                return
+            self._refreshing.add(telegram_id)
+
+        def refresh():
+            try:
+                self._refresh(user)
+            except Exception as e:
+                self.logger.warning(
+                    f"Background refresh of the spotify token of {telegram_id} "
+                    f"failed: {e}"
+                )
+            finally:
+                with self._lock:
+                    self._refreshing.discard(telegram_id)
+
+        threading.Thread(
+            target=refresh, name=f"token-refresh-{telegram_id}", daemon=True
+        ).start()
+
+    def _is_fresh(self, token_info: Optional[dict]) -> bool:
+        return (
+            token_info is not None
+            and token_info.get("expires_at", 0) - time.time() > self.refresh_margin
+        )
+
+    @staticmethod
+    def _has_scopes(token_info: Optional[dict]) -> bool:
+        if token_info is None:
+            return False
+        return set(SCOPES.split()) <= set(token_info.get("scope", "").split())
+
+    def _get_oauth(self, user) -> "spotipy.SpotifyOAuth":
+        telegram_id = user.telegram_user_id
+        with self._lock:
+            oauth = self._oauth.get(telegram_id)
+            if oauth is None:
+                if self.store is not None:
+                    handler = _store_cache_handler()(
+                        self.store, f"spotify_token:{telegram_id}"
+                    )
+                else:
+                    handler = spotipy.CacheFileHandler(
+                        cache_path=os.path.join(self.cache_dir, f"cache-{telegram_id}"),
+                        username=str(telegram_id),
+                    )
+                oauth = spotipy.SpotifyOAuth(
+                    cache_handler=handler,
+                    scope=SCOPES,
+                    requests_session=transport.session,
+                    requests_timeout=transport.timeout,
+                )
+                oauth.OAUTH_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+                self._oauth[telegram_id] = oauth
+            return oauth
+
+    def _user_lock(self, telegram_id: int) -> threading.Lock:
+        with self._lock:
+            return self._user_locks.setdefault(telegram_id, threading.Lock())
+
+
+@functools.lru_cache(maxsize=None)
+def _store_cache_handler():
+    # spotipy only takes subclasses of its CacheHandler, which is defined
+    # here so that spotipy is still imported on first use
+    class StoreCacheHandler(spotipy.cache_handler.CacheHandler):
+        """
+        Caches the token of a user in the shared store
+        """
+
+        def __init__(self, store: SharedStore, key: str):
+            self.store = store
+            self.key = key
+
+        def get_cached_token(self) -> Optional[dict]:
+            value = self.store.get(self.key)
+            return json.loads(value) if value is not None else None
+
+        def save_token_to_cache(self, token_info: dict) -> None:
+            self.store.set(self.key, json.dumps(token_info))
+
+    return StoreCacheHandler
+
+
+token_manager = SpotifyTokenManager(
+    store=shared_store if SHARED_STORE != "local" else None
+)
+
+
+def spotify_client(access_token: str) -> "spotipy.Spotify":
+    sp = spotipy.Spotify(
+        auth=access_token,
+        requests_session=transport.session,
+        requests_timeout=transport.timeout,
+    )
+    sp.prefix = SPOTIFY_API_URL
+    return sp
@@ -0,0 +1,184 @@
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from lyrix_telegram_bot.logger import make_logger
+
+# updates that take longer than this many seconds have their span tree
+# logged as json, a negative value turns it off
+SLOW_TRACE_SECONDS = float(os.getenv("LYRIX_SLOW_TRACE_SECONDS", "3"))
+# how far back /stats looks
+STATS_WINDOW = float(os.getenv("LYRIX_STATS_WINDOW", "900"))
+# latencies kept per command within the window
+STATS_SAMPLES = int(os.getenv("LYRIX_STATS_SAMPLES", "2048"))
+
+PERCENTILES = (50, 95, 99)
+
+logger = make_logger("trace")
+
+
+class Span:
+    """
+    A timed step of handling an update, with the steps it was made of
+    """
+
+    __slots__ = ("name", "attrs", "start", "end", "error", "children")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.error: Optional[str] = None
+        self.children: List["Span"] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.end = time.perf_counter()
+        if error is not None:
+            self.error = repr(error)
+
+    def to_dict(self, origin: float = None) -> dict:
+        origin = self.start if origin is None else origin
+        data = {
+            "name": self.name,
+            "offset_ms": round((self.start - origin) * 1e3, 3),
+            "duration_ms": round(self.duration * 1e3, 3),
+        }
+        if self.attrs:
+            data["attrs"] = self.attrs
+        if self.error is not None:
+            data["error"] = self.error
+        if self.end is None:
+            # a call that was still running, like one past a fan out deadline
+            data["unfinished"] = True
+        if self.children:
+            data["children"] = [child.to_dict(origin) for child in self.children]
+        return data
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "lyrix_span", default=None
+)
+
+
+def start_trace(name: str, **attrs) -> Tuple[Span, contextvars.Token]:
+    """
+    Starts the root span of an update. The token resets the context once
+    the handler returns, the span is finished with ``finish_trace``.
+    """
+    root = Span(name, attrs)
+    return root, _current.set(root)
+
+
+def detach(token: contextvars.Token) -> None:
+    """
+    Makes the span that was current before ``start_trace`` current again
+    """
+    _current.reset(token)
+
+
+def finish_trace(root: Span, error: Optional[BaseException] = None) -> None:
+    root.finish(error)
+    command_stats.record(root.name, root.duration, error is not None)
+    if 0 <= SLOW_TRACE_SECONDS < root.duration:
+        logger.warning(json.dumps({"slow_update": root.to_dict()}, default=str))
+
+
+def add_span(name: str, start: float, end: float, **attrs) -> Optional[Span]:
+    """
+    Adds a step that was timed without ``span`` to the current span, like
+    the imports that ran before the trace started
+    """
+    parent = _current.get()
+    if parent is None:
+        return None
+    child = Span(name, attrs)
+    child.start, child.end = start, end
+    parent.children.append(child)
+    return child
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """
+    Times a step as a child of the current span. Outside of an update it
+    does nothing, and yields None.
+    """
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, attrs)
+    parent.children.append(child)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.finish(e)
+        raise
+    else:
+        child.finish()
+    finally:
+        _current.reset(token)
+
+
+class LatencyWindow:
+    """
+    The latencies of every command over the last ``window`` seconds, keeping
+    at most ``samples`` of them per command
+    """
+
+    def __init__(self, window: float = STATS_WINDOW, samples: int = STATS_SAMPLES):
+        self.window = window
+        self.samples = samples
+        self._latencies: Dict[str, Deque[Tuple[float, float, bool]]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, error: bool = False) -> None:
+        with self._lock:
+            latencies = self._latencies.get(name)
+            if latencies is None:
+                latencies = self._latencies[name] = deque(maxlen=self.samples)
+            latencies.append((time.monotonic(), seconds, error))
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        The count, errors and percentiles of every command in the window
+        """
+        since = time.monotonic() - self.window
+        with self._lock:
+            windows = {
+                name: [s for s in latencies if s[0] >= since]
+                for name, latencies in self._latencies.items()
+            }
+        summary = {}
+        for name, samples in sorted(windows.items()):
+            if not samples:
+                continue
+            latencies = sorted(seconds for _, seconds, _ in samples)
+            stats = {
+                "count": len(samples),
+                "errors": sum(error for _, _, error in samples),
+            }
+            for percentile in PERCENTILES:
+                stats[f"p{percentile}"] = _percentile(latencies, percentile)
+            summary[name] = stats
+        return summary
+
+
+def _percentile(ordered: List[float], percentile: float) -> float:
+    # nearest rank
+    return ordered[max(0, math.ceil(percentile / 100 * len(ordered)) - 1)]
+
+
+command_stats = LatencyWindow()
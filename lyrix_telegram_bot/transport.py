@@ -0,0 +1,151 @@
+import contextvars
+import os
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.metrics import UPSTREAM_ERRORS, track_upstream, upstream_name
+from lyrix_telegram_bot.tracing import span
+
+# number of hosts to keep a connection pool for
+HTTP_POOL_CONNECTIONS = int(os.getenv("LYRIX_HTTP_POOL_CONNECTIONS", "16"))
+# number of connections kept alive per host
+HTTP_POOL_MAXSIZE = int(os.getenv("LYRIX_HTTP_POOL_MAXSIZE", "32"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("LYRIX_HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT = float(os.getenv("LYRIX_HTTP_READ_TIMEOUT", "10"))
+HTTP_RETRIES = int(os.getenv("LYRIX_HTTP_RETRIES", "3"))
+
+# the time.monotonic() the requests of the current call have to be done by
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "lyrix_deadline", default=None
+)
+
+
+def set_deadline(expires_at: float) -> None:
+    """
+    Caps the timeouts of the requests made in the current context, so that a
+    call that was given up on does not hold its thread past the deadline
+    """
+    _deadline.set(expires_at)
+
+
+class TransportSession(requests.Session):
+    """
+    A session shared by all the upstream clients. Requests without a timeout
+    get the transport timeouts, and the ones made under a deadline wait no
+    longer than the time left.
+    """
+
+    def __init__(self, timeout: Tuple[float, float]):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        expires_at = _deadline.get()
+        if expires_at is not None:
+            kwargs["timeout"] = _cap_timeout(
+                kwargs["timeout"], expires_at - time.monotonic()
+            )
+        upstream = upstream_name(url)
+        with span(upstream, method=method, path=urlsplit(url).path) as current:
+            with track_upstream(upstream):
+                response = super().request(method, url, **kwargs)
+            if current is not None:
+                current.attrs["status"] = response.status_code
+        if response.status_code >= 400:
+            UPSTREAM_ERRORS.inc(upstream)
+        return response
+
+    def close(self):
+        # spotipy closes the session it was given when the client is garbage
+        # collected, which would drop every pooled connection. The transport
+        # owns this session, and closes it with shutdown()
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+def _cap_timeout(timeout, remaining: float):
+    if remaining <= 0:
+        raise requests.Timeout("The deadline of the call passed")
+    if isinstance(timeout, tuple):
+        return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+class HttpTransport:
+    """
+    Central HTTP transport for Spotify, Last.fm and the lyrix backend, with a
+    keep-alive connection pool per host.
+    """
+
+    logger = make_logger("transport")
+
+    def __init__(
+        self,
+        pool_connections: int = HTTP_POOL_CONNECTIONS,
+        pool_maxsize: int = HTTP_POOL_MAXSIZE,
+        connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+        read_timeout: float = HTTP_READ_TIMEOUT,
+        retries: int = HTTP_RETRIES,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            # the requests that failed to connect never reached the upstream
+            # and are retried whatever their method. The ones that got an
+            # error status are only retried when sending them twice does no
+            # harm, a POST may have created a playlist or added its tracks.
+            # A 429 goes back to the caller rather than holding the thread
+            # for as long as Retry-After says.
+            max_retries=Retry(
+                total=retries,
+                connect=None,
+                read=False,
+                allowed_methods=frozenset(["GET", "PUT", "DELETE"]),
+                status=retries,
+                backoff_factor=0.3,
+                status_forcelist=(500, 502, 503, 504),
+                respect_retry_after_header=False,
+            ),
+        )
+        self.session = TransportSession(self.timeout)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Returns the usage of the connection pool of every host. A pool is
+        saturated when all its connections are checked out, and the next
+        request to that host opens a connection that is not kept alive.
+        """
+        pools = self.adapter.poolmanager.pools
+        stats = {}
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            in_use = pool.pool.maxsize - pool.pool.qsize()
+            stats[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+                "maxsize": pool.pool.maxsize,
+                "in_use": in_use,
+                "saturation": in_use / pool.pool.maxsize,
+                "connections": pool.num_connections,
+                "requests": pool.num_requests,
+            }
+        return stats
+
+    def shutdown(self) -> None:
+        self.session.shutdown()
+
+
+transport = HttpTransport()
@@ -0,0 +1,197 @@
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import threading
+from typing import Callable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import Updater
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+from lyrix_telegram_bot.logger import make_logger
+
+# "polling" pulls the updates with getUpdates, "webhook" runs an http endpoint
+# Telegram pushes the updates to
+INGEST = os.getenv("LYRIX_INGEST", "polling")
+WEBHOOK_LISTEN = os.getenv("LYRIX_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("LYRIX_WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("LYRIX_WEBHOOK_PATH", "/telegram")
+# the public https url Telegram sends the updates to, usually a reverse proxy
+# in front of WEBHOOK_LISTEN:WEBHOOK_PORT
+WEBHOOK_URL = os.getenv("LYRIX_WEBHOOK_URL")
+# replicas behind a load balancer must share the secret, otherwise a random
+# one is generated on every start
+WEBHOOK_SECRET = os.getenv("LYRIX_WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("LYRIX_WEBHOOK_MAX_CONNECTIONS", "40"))
+# updates waiting for the dispatcher, past which Telegram is asked to retry
+WEBHOOK_QUEUE_SIZE = int(os.getenv("LYRIX_WEBHOOK_QUEUE_SIZE", "1000"))
+
+# the update types the bot has handlers for, telegram does not send the others
+ALLOWED_UPDATES = [Update.MESSAGE, Update.INLINE_QUERY]
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def start_dispatcher(updater: Updater) -> None:
+    """
+    Starts the job queue and the dispatcher of ``updater`` for the updates
+    that are put on its queue by something else than its own polling
+    """
+    updater.job_queue.start()
+    dispatcher_ready = threading.Event()
+    threading.Thread(
+        target=updater.dispatcher.start,
+        kwargs={"ready": dispatcher_ready},
+        name="lyrix-dispatcher",
+        daemon=True,
+    ).start()
+    dispatcher_ready.wait()
+    # updater.idle() exits right away on a signal when the updater did not
+    # start anything itself, and stops it gracefully when it is running
+    updater.running = True
+
+
+class WebhookServer:
+    """
+    Receives the updates Telegram pushes to the webhook, and puts them on the
+    dispatcher's update queue. python-telegram-bot's own webhook server does
+    not check the secret token, so this one runs on tornado alongside the
+    Updater, on its own thread.
+
+    Requests without the secret token are refused, and when the dispatcher
+    falls behind by more than ``queue_size`` updates, the requests get a 503
+    so that Telegram delivers the update again later instead of the queue
+    growing without bound. With ``forward``, the updates are handed to it
+    before the request is answered, and only the ones it returns False for
+    are put on the queue.
+    """
+
+    logger = make_logger("webhook")
+
+    def __init__(
+        self,
+        updater: Updater,
+        url: str = WEBHOOK_URL,
+        listen: str = WEBHOOK_LISTEN,
+        port: int = WEBHOOK_PORT,
+        path: str = WEBHOOK_PATH,
+        secret: str = WEBHOOK_SECRET,
+        max_connections: int = WEBHOOK_MAX_CONNECTIONS,
+        queue_size: int = WEBHOOK_QUEUE_SIZE,
+        forward: Optional[Callable[[Update], bool]] = None,
+    ):
+        if not url:
+            raise ValueError("LYRIX_WEBHOOK_URL is required for the webhook mode")
+        self.updater = updater
+        self.url = url
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret or secrets.token_urlsafe(32)
+        self.max_connections = max_connections
+        self.queue_size = queue_size
+        self.forward = forward
+        self.received = 0
+        self.rejected = 0
+        self.overloaded = 0
+        self.loop = asyncio.new_event_loop()
+        self._http: Optional[HTTPServer] = None
+        self._sockets = []
+        self._thread = threading.Thread(
+            target=self._run, name="lyrix-webhook", daemon=True
+        )
+
+    @property
+    def bound_port(self) -> int:
+        """
+        The port the server listens on, which differs from ``port`` when it
+        is 0
+        """
+        return self._sockets[0].getsockname()[1]
+
+    def start(self, set_webhook: bool = True) -> None:
+        start_dispatcher(self.updater)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._listen(), self.loop).result()
+        self.logger.info(f"Listening for updates on {self.listen}:{self.bound_port}")
+
+        if set_webhook:
+            self.updater.bot.set_webhook(
+                self.url,
+                max_connections=self.max_connections,
+                allowed_updates=ALLOWED_UPDATES,
+                # python-telegram-bot 13.7 has no secret_token argument
+                api_kwargs={"secret_token": self.secret},
+            )
+            self.logger.info(f"Webhook set to {self.url}")
+
+    def stop(self) -> None:
+        """
+        Stops accepting updates, and then stops the dispatcher
+        """
+        if self._http is not None:
+            self.loop.call_soon_threadsafe(self._http.stop)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.updater.stop()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "received": self.received,
+            "rejected": self.rejected,
+            "overloaded": self.overloaded,
+            "queue_depth": self.updater.update_queue.qsize(),
+        }
+
+    def accept(self, secret: Optional[str], body: bytes) -> int:
+        """
+        Queues the update in the request body, and returns the http status
+        to answer Telegram with
+        """
+        if secret is None or not hmac.compare_digest(
+            secret.encode(), self.secret.encode()
+        ):
+            self.rejected += 1
+            return 403
+        if self.updater.update_queue.qsize() >= self.queue_size:
+            self.overloaded += 1
+            return 503
+        try:
+            update = Update.de_json(json.loads(body), self.updater.bot)
+        except (ValueError, TypeError, KeyError):
+            update = None
+        if update is None:
+            self.rejected += 1
+            return 400
+        self.received += 1
+        if self.forward is None or not self.forward(update):
+            self.updater.update_queue.put(update)
+        return 200
+
+    async def _listen(self) -> None:
+        app = Application(
+            [(self.path, _UpdateHandler, {"server": self})],
+            log_function=lambda handler: None,
+        )
+        self._sockets = bind_sockets(self.port, self.listen)
+        self._http = HTTPServer(app)
+        self._http.add_sockets(self._sockets)
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+class _UpdateHandler(RequestHandler):
+    def initialize(self, server: WebhookServer) -> None:
+        self.server = server
+
+    def post(self) -> None:
+        status = self.server.accept(
+            self.request.headers.get(SECRET_TOKEN_HEADER), self.request.body
+        )
+        self.set_status(status)
@@ -0,0 +1,302 @@
+import bisect
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+from multiprocessing.connection import Connection, wait
+from typing import Dict, Iterable, List, Optional
+
+from telegram import Update
+from telegram.ext import CallbackContext, Updater
+
+from lyrix_telegram_bot.logger import make_logger
+from lyrix_telegram_bot.metrics import metrics
+from lyrix_telegram_bot.webhook import start_dispatcher
+
+# the processes the handlers run in, each with its own interpreter. 0 runs
+# them in the process that takes the updates, like before.
+WORKERS = int(os.getenv("LYRIX_WORKERS", "0"))
+# points of every worker on the hash ring, the more there are the more
+# evenly the users are spread
+WORKER_VNODES = int(os.getenv("LYRIX_WORKER_VNODES", "64"))
+# how long the front waits for the workers to take updates when it starts
+WORKER_START_TIMEOUT = float(os.getenv("LYRIX_WORKER_START_TIMEOUT", "60"))
+# the longest a crashed worker waits to be started again, the wait doubles
+# with every crash up to it
+WORKER_MAX_BACKOFF = float(os.getenv("LYRIX_WORKER_MAX_BACKOFF", "30"))
+# a worker that ran this long before crashing is started again right away
+WORKER_STABLE_SECONDS = float(os.getenv("LYRIX_WORKER_STABLE_SECONDS", "60"))
+
+WORKER_RESTARTS = metrics.counter(
+    "lyrix_worker_restarts_total", "Workers started again after a crash", ("worker",)
+)
+
+# sent to a worker instead of an update to stop it
+_STOP = b""
+
+
+class HashRing:
+    """
+    Consistent hashing of keys over the nodes: every node has ``vnodes``
+    points on a ring, and a key belongs to the node of the first point after
+    its hash. Adding or removing a node only moves the keys of its points.
+    """
+
+    def __init__(self, nodes: Iterable[int], vnodes: int = WORKER_VNODES):
+        points = sorted(
+            (self._hash(f"{node}:{vnode}"), node)
+            for node in nodes
+            for vnode in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return zlib.crc32(key.encode())
+
+    def node_for(self, key) -> int:
+        i = bisect.bisect(self._hashes, self._hash(str(key)))
+        return self._nodes[i % len(self._nodes)]
+
+
+class _Worker:
+    __slots__ = (
+        "index",
+        "process",
+        "conn",
+        "ready",
+        "outbox",
+        "feeder",
+        "started_at",
+        "crashes",
+        "restarts",
+        "sent",
+    )
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn: Optional[Connection] = None
+        self.ready = None
+        # the updates waiting for the worker, so that a worker that is slow
+        # or being started again holds up its own users only
+        self.outbox: "queue.Queue[bytes]" = queue.Queue()
+        self.feeder: Optional[threading.Thread] = None
+        self.started_at = 0.0
+        self.crashes = 0
+        self.restarts = 0
+        self.sent = 0
+
+
+class WorkerPool:
+    """
+    Runs the handlers in worker processes, and hands every update to the
+    worker that owns its user. A user always goes to the same worker, so
+    that their caches stay warm, and the worker gets their updates in the
+    order the front took them. Its scheduler then runs the user's commands
+    one at a time and in that order on each of its pools; a slow command,
+    like a lyrics lookup, does not hold back a fast one sent after it.
+    The workers that crash are started again, and get the updates that were
+    waiting for them; the ones a worker had taken but not handled are lost.
+    """
+
+    logger = make_logger("workers")
+
+    def __init__(self, count: int = WORKERS):
+        # spawned rather than forked, the front process already runs threads
+        self._context = multiprocessing.get_context("spawn")
+        self.ring = HashRing(range(count))
+        self.workers = [_Worker(i) for i in range(count)]
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._supervisor = threading.Thread(
+            target=self._supervise, name="lyrix-supervisor", daemon=True
+        )
+
+    def start(self, timeout: float = WORKER_START_TIMEOUT) -> None:
+        """
+        Starts the workers, and returns once they all take updates
+        """
+        for worker in self.workers:
+            self._spawn(worker)
+            worker.feeder = threading.Thread(
+                target=self._feed,
+                args=(worker,),
+                name=f"lyrix-feeder-{worker.index}",
+                daemon=True,
+            )
+            worker.feeder.start()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if not worker.ready.wait(max(0.0, deadline - time.monotonic())):
+                raise TimeoutError(f"Worker {worker.index} did not start")
+        self._supervisor.start()
+        self.logger.info(f"{len(self.workers)} workers are taking updates")
+
+    def dispatch(self, update: Update, _: CallbackContext) -> None:
+        """
+        The handler of the front process: queues the update for its worker
+        """
+        user = update.effective_user
+        # the updates without a user, which the bot has no handlers for, are
+        # spread by their id
+        key = user.id if user is not None else update.update_id
+        worker = self.workers[self.ring.node_for(key)]
+        worker.outbox.put(json.dumps(update.to_dict()).encode())
+
+    def stop(self, timeout: float = 30) -> None:
+        """
+        Lets the workers handle the updates they were sent, and stops them
+        """
+        self._stopped.set()
+        for worker in self.workers:
+            worker.outbox.put(_STOP)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.feeder.join(max(0.0, deadline - time.monotonic()))
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                self.logger.warning(f"Worker {worker.index} did not stop, killing it")
+                worker.process.kill()
+                worker.process.join()
+        if self._supervisor.is_alive():
+            self._supervisor.join()
+
+    def stats(self) -> List[Dict[str, int]]:
+        return [
+            {
+                "queued": worker.outbox.qsize(),
+                "sent": worker.sent,
+                "restarts": worker.restarts,
+                "alive": int(worker.process.is_alive()),
+            }
+            for worker in self.workers
+        ]
+
+    def _spawn(self, worker: _Worker) -> None:
+        receiver, sender = self._context.Pipe(duplex=False)
+        ready = self._context.Event()
+        process = self._context.Process(
+            target=run_worker,
+            args=(worker.index, receiver, ready),
+            name=f"lyrix-worker-{worker.index}",
+            daemon=True,
+        )
+        process.start()
+        # only the worker reads, so that sending to it fails once it is gone
+        receiver.close()
+        with self._lock:
+            worker.process = process
+            worker.conn = sender
+            worker.ready = ready
+            worker.started_at = time.monotonic()
+        self.logger.info(f"Started worker {worker.index} as pid {process.pid}")
+
+    def _feed(self, worker: _Worker) -> None:
+        while True:
+            item = worker.outbox.get()
+            while True:
+                with self._lock:
+                    conn = worker.conn
+                try:
+                    conn.send_bytes(item)
+                    break
+                except OSError:
+                    if item == _STOP or self._stopped.is_set():
+                        return
+                    # the worker is gone, the update goes to the one that is
+                    # started in its place
+                    self._stopped.wait(0.1)
+            if item == _STOP:
+                return
+            worker.sent += 1
+
+    def _supervise(self) -> None:
+        while not self._stopped.is_set():
+            sentinels = {worker.process.sentinel: worker for worker in self.workers}
+            for sentinel in wait(list(sentinels), timeout=1):
+                if self._stopped.is_set():
+                    return
+                self._restart(sentinels[sentinel])
+
+    def _restart(self, worker: _Worker) -> None:
+        worker.process.join()
+        ran = time.monotonic() - worker.started_at
+        worker.crashes = 0 if ran >= WORKER_STABLE_SECONDS else worker.crashes + 1
+        backoff = 0.0
+        if worker.crashes:
+            backoff = min(WORKER_MAX_BACKOFF, 0.5 * 2 ** (worker.crashes - 1))
+        self.logger.error(
+            f"Worker {worker.index} exited with {worker.process.exitcode} after "
+            f"{ran:.0f}s, starting it again in {backoff:.1f}s"
+        )
+        if self._stopped.wait(backoff):
+            return
+        with self._lock:
+            worker.conn.close()
+        self._spawn(worker)
+        worker.restarts += 1
+        WORKER_RESTARTS.inc(str(worker.index))
+
+
+class WorkerInbox:
+    """
+    The updates a worker process gets from the front, put on the queue of
+    its dispatcher
+    """
+
+    logger = make_logger("workers")
+
+    def __init__(self, updater: Updater, conn: Connection, ready, index: int):
+        self.updater = updater
+        self.conn = conn
+        self.ready = ready
+        self.index = index
+        self.received = 0
+        self._thread = threading.Thread(
+            target=self._run, name="lyrix-inbox", daemon=True
+        )
+
+    def start(self) -> None:
+        start_dispatcher(self.updater)
+        self._thread.start()
+        self.ready.set()
+        self.logger.info(f"Worker {self.index} is taking updates")
+
+    def wait(self) -> None:
+        """
+        Returns once the front stopped the worker, or went away
+        """
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                data = self.conn.recv_bytes()
+            except (EOFError, OSError):
+                self.logger.warning(f"Worker {self.index} lost the front process")
+                return
+            if data == _STOP:
+                return
+            self.received += 1
+            self.updater.update_queue.put(
+                Update.de_json(json.loads(data), self.updater.bot)
+            )
+
+
+def run_worker(index: int, conn: Connection, ready) -> None:
+    """
+    The entry point of a worker process
+    """
+    # the front stops the workers, a Ctrl-C or a SIGTERM to the whole
+    # process group reaches it too
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    from lyrix_telegram_bot.bot import main
+
+    main(worker=index, conn=conn, ready=ready)